@@ -12,11 +12,14 @@
 ##############################################################################
 """ The ZODB-based MySQL Database Connection object
 """
-import six
+import json
+
 from six.moves._thread import allocate_lock
 
 from AccessControl.class_init import InitializeClass
 from AccessControl.Permissions import change_database_methods
+from AccessControl.Permissions import open_close_database_connection
+from AccessControl.Permissions import test_database_connections
 from AccessControl.Permissions import use_database_methods
 from AccessControl.Permissions import view_management_screens
 from AccessControl.SecurityInfo import ClassSecurityInfo
@@ -24,10 +27,20 @@ from AccessControl.SecurityInfo import ModuleSecurityInfo
 from App.special_dtml import HTMLFile
 from Persistence import Persistent
 from Shared.DC.ZRDB.Connection import Connection as ConnectionBase
+from zExceptions import NotFound
+from zope.interface import implementer
+from ZPublisher.Iterators import IStreamIterator
+from ZPublisher.Iterators import IUnboundStreamIterator
 
+from . import metrics
 from .db import DB
 from .db import DBPool
+from .db import check_isolation_level
+from .db import error_codes
+from .db import session_lines
+from .export import encoders
 from .permissions import add_zmysql_database_connections
+from .results import CompactResults
 from .utils import TableBrowser
 from .utils import table_icons
 
@@ -44,6 +57,74 @@ database_connection_pool = {}
 # DBPool_instance[thread id] == DB instance
 
 
+@implementer(IUnboundStreamIterator)
+class StreamIterator(object):
+    """ Publishes the chunks of ``iterable`` after the request ended,
+        without collecting them in the response first.
+    """
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._iterator)
+
+    next = __next__
+
+    def close(self):
+        close = getattr(self._iterator, 'close', None)
+        if close is not None:
+            close()
+
+
+@implementer(IStreamIterator)
+class SizedStreamIterator(StreamIterator):
+    """ A ``StreamIterator`` over ``length`` bytes.
+    """
+
+    def __init__(self, iterable, length):
+        super(SizedStreamIterator, self).__init__(iterable)
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+
+def _byte_range(header, length):
+    """ Return the ``(start, end)`` offsets of the single byte range asked
+        for by the HTTP Range ``header`` for a value of ``length`` bytes.
+
+        Returns None if the whole value should be sent, because there is no
+        usable header or several ranges are asked for, and False if the
+        range cannot be satisfied.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    first, last = first.strip(), last.strip()
+    if not sep or not (first or last) or \
+       (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        # A suffix range with the last bytes of the value
+        if not int(last) or not length:
+            return False
+        return max(length - int(last), 0), length - 1
+    start = int(first)
+    end = int(last) if last else length - 1
+    if last and end < start:
+        return None
+    if start >= length:
+        return False
+    return start, min(end, length - 1)
+
+
 class Connection(ConnectionBase):
     """ Zope database adapter for MySQL/MariaDB
     """
@@ -55,6 +136,14 @@ class Connection(ConnectionBase):
     use_unicode = False
     charset = None
     timeout = None
+    coalesce_selects = False
+    max_result_bytes = 0
+    session_statements = ()
+    isolation_level = None
+    lock_wait_timeout = 0
+    conflict_error_codes = ()
+    slow_transaction_threshold = 0
+    xa_transactions = False
     _v_connected = ''
     _isAnSQLConnection = 1
     info = None
@@ -69,9 +158,14 @@ class Connection(ConnectionBase):
     manage_properties._setName('manage_main')
     manage_main = manage_properties
 
+    security.declareProtected(view_management_screens,  # NOQA: D001
+                              'manage_pool')
+    manage_pool = HTMLFile('www/pool', globals())
+
     manage_options = (
         ConnectionBase.manage_options[1:] +
-        ({'label': 'Browse', 'action': 'manage_browse'},)
+        ({'label': 'Browse', 'action': 'manage_browse'},
+         {'label': 'Pool', 'action': 'manage_pool'})
         )
 
     def __init__(self, id, title, connection_string, check, use_unicode=None,
@@ -138,6 +232,23 @@ class Connection(ConnectionBase):
         """
         return self.getPhysicalPath()
 
+    def _pool_settings(self):
+        """ Return the keyword arguments for creating the connection pool.
+            An existing pool is only reused if its settings are the same.
+        """
+        return {'create_db': self.auto_create_db,
+                'use_unicode': self.use_unicode,
+                'charset': self.charset,
+                'timeout': self.timeout,
+                'coalesce_selects': self.coalesce_selects,
+                'max_result_bytes': self.max_result_bytes,
+                'session_statements': self.session_statements,
+                'isolation_level': self.isolation_level,
+                'lock_wait_timeout': self.lock_wait_timeout,
+                'conflict_error_codes': self.conflict_error_codes,
+                'slow_transaction_threshold': self.slow_transaction_threshold,
+                'xa_transactions': self.xa_transactions}
+
     def _getConnection(self):
         """ Helper method to retrieve an existing or create a new connection
         """
@@ -156,18 +267,19 @@ class Connection(ConnectionBase):
         """
         pool_key = self._pool_key()
         conn = database_connection_pool.get(pool_key)
+        settings = self._pool_settings()
 
-        if conn is not None and conn.connection == conn_string:
+        if conn is not None and conn.connection == conn_string and \
+           getattr(conn, '_da_settings', settings) == settings:
             self._v_database_connection = conn
             self._v_connected = conn.connected_timestamp
         else:
             if conn is not None:
                 conn.closeConnection()
 
-            conn_pool = DBPool(self.factory(), create_db=self.auto_create_db,
-                               use_unicode=self.use_unicode,
-                               charset=self.charset,
-                               timeout=self.timeout)
+            conn_pool = DBPool(self.factory(), path='/'.join(pool_key),
+                               **settings)
+            conn_pool._da_settings = settings
             database_connection_pool_lock.acquire()
             try:
                 conn = conn_pool(conn_string)
@@ -194,28 +306,256 @@ class Connection(ConnectionBase):
         :dict: escapes -- Additional escape transformations.
                           Default: empty ``dict``.
         """
+        return self._getConnection().quoter()(sql_str)
+
+    security.declareProtected(use_database_methods,  # NOQA: D001
+                              'sql_quote_many')
+
+    def sql_quote_many(self, values):
+        """ Quote a sequence of values for use in queries.
+
+        Faster than calling ``sql_quote__`` for each value because the
+        connection is only looked up once.
+
+        :list: values -- The raw SQL strings to transform.
+        """
+        quote = self._getConnection().quoter()
+        return [quote(value) for value in values]
+
+    security.declareProtected(test_database_connections,  # NOQA: D001
+                              'query_many')
+
+    def query_many(self, queries, max_rows=1000):
+        """ Run independent read-only queries concurrently.
+
+        Each query runs on its own pooled connection. Queries that may write
+        data are run one after the other within the current transaction.
+
+        :list: queries -- The SQL statements to run
+
+        :int: max_rows -- The maximum number of rows returned per query.
+                          Default: 1000
+
+        Returns a list of result objects in the order of ``queries``.
+        """
+        connection = self._getConnection()
+        return [CompactResults(result)
+                for result in connection.query_many(queries, max_rows)]
+
+    security.declareProtected(test_database_connections,  # NOQA: D001
+                              'query_in')
+
+    def query_in(self, query, values, max_rows=1000, parallel=False):
+        """ Run a query for a long list of values.
+
+        The values are quoted and split into IN lists that do not exceed
+        the server's ``max_allowed_packet``, and the results of all
+        statements are merged.
+
+        :string: query -- The SQL statement with a single ``%s`` placeholder
+                          for the IN list, e.g.
+                          ``SELECT * FROM t WHERE id IN %s``
+
+        :list: values -- The values for the IN list
+
+        :int: max_rows -- The maximum number of rows returned in total.
+                          Default: 1000
+
+        :bool: parallel -- Run the statements concurrently on separate
+                           pooled connections. Default: False
+
+        Returns a result object.
+        """
         connection = self._getConnection()
+        return CompactResults(connection.query_in(query, values, max_rows,
+                                                  parallel))
+
+    security.declareProtected(test_database_connections,  # NOQA: D001
+                              'paginate')
+
+    def paginate(self, query, key_columns, page_size, after=None,
+                 descending=False):
+        """ Return one page of a query result ordered by unique keys.
+
+        Pages are found by comparing the keys, not by skipping rows with
+        an OFFSET, so late pages of big results are as fast as the first.
+        This needs indexed key columns and a query the server can merge
+        into the paginating statement. Queries with GROUP BY, DISTINCT,
+        UNION, aggregate functions or LIMIT build their whole result for
+        every page.
+
+        :string: query -- The SELECT statement, without ORDER BY and LIMIT
+
+        :list: key_columns -- The result columns that identify a row
+
+        :int: page_size -- The number of rows per page
+
+        :string: after -- The token returned with the previous page.
+                          Default: None, for the first page
+
+        :bool: descending -- Order by descending keys. Default: False
+
+        Returns a tuple of the result object and the token for the next
+        page, which is None on the last page.
+        """
+        connection = self._getConnection()
+        items, rows, token = connection.paginate(query, key_columns,
+                                                 int(page_size), after,
+                                                 descending)
+        return CompactResults((items, rows)), token
+
+    security.declareProtected(test_database_connections,  # NOQA: D001
+                              'stream_blob')
+
+    def stream_blob(self, table, column, key, REQUEST,
+                    content_type='application/octet-stream', filename=None):
+        """ Stream a BLOB or TEXT value to the response in chunks.
+
+        The value is read in chunks of ``blob_chunk_size`` bytes while the
+        publisher sends the returned stream iterator, so memory use does not
+        depend on its size. The length and all chunks are read in one
+        consistent snapshot. InnoDB reads the whole value on the server for
+        every chunk, so values of many chunks are expensive to stream.
+        Single byte ranges requested with an HTTP ``Range`` header are
+        answered with partial content.
+
+        :string: table -- The table holding the value
 
-        if self.use_unicode and isinstance(sql_str, six.text_type):
-            # Confusing naming: unicode_literal does not return an unencoded
-            # ("unicode") string, but an encoded bytes string.
-            encoded = connection.unicode_literal(sql_str)
-
-            # If the SQL string was unencoded to begin with we want to make
-            # sure to return the same thing, so decode it here.
-            charset = self.charset or 'latin1'
-            if charset.startswith('utf8'):
-                charset = 'utf-8'
-            return encoded.decode(charset)
+        :string: column -- The column holding the value
+
+        :dict: key -- Column names and values identifying the row
+
+        :request: REQUEST -- A Zope REQUEST object
+
+        :string: content_type -- The content type of the response.
+                                 Default: ``application/octet-stream``
+
+        :string: filename -- Offer the value for download under this name.
+                             Default: None, to display the value inline
+        """
+        blob = self._getConnection().open_blob(table, column, key)
+        try:
+            return self._stream_blob(blob, table, column, REQUEST,
+                                     content_type, filename)
+        except Exception:
+            blob.close()
+            raise
+
+    def _stream_blob(self, blob, table, column, REQUEST, content_type,
+                     filename):
+        RESPONSE = REQUEST.RESPONSE
+        length = blob.length
+        if length is None:
+            raise NotFound('No value found in %s.%s' % (table, column))
+
+        RESPONSE.setHeader('Accept-Ranges', 'bytes')
+        byte_range = None
+        if not REQUEST.get_header('If-Range'):
+            byte_range = _byte_range(REQUEST.get_header('Range'), length)
+        if byte_range is False:
+            RESPONSE.setStatus(416)
+            RESPONSE.setHeader('Content-Range', 'bytes */%d' % length)
+            blob.close()
+            return ''
+        if byte_range is None:
+            start, end = 0, length - 1
         else:
-            return connection.string_literal(sql_str)
+            start, end = byte_range
+            RESPONSE.setStatus(206)
+            RESPONSE.setHeader('Content-Range',
+                               'bytes %d-%d/%d' % (start, end, length))
+
+        RESPONSE.setHeader('Content-Type', content_type)
+        RESPONSE.setHeader('Content-Length', str(end - start + 1))
+        if filename:
+            RESPONSE.setHeader('Content-Disposition',
+                               'attachment; filename="%s"' %
+                               filename.replace('"', ''))
+        if not length:
+            blob.close()
+            return ''
+        return SizedStreamIterator(blob.read(start, end), end - start + 1)
+
+    security.declareProtected(test_database_connections,  # NOQA: D001
+                              'export')
+
+    def export(self, query, format='csv', out=None, compress=False,
+               filename=None, REQUEST=None):
+        """ Stream all rows of a query result in CSV or NDJSON format.
+
+        Rows are encoded and written in batches as they are fetched, so
+        memory use does not depend on the result size. When writing to the
+        response, they are fetched while the publisher sends the returned
+        stream iterator.
+
+        :string: query -- The read-only SQL statement
+
+        :string: format -- ``csv`` for comma-separated values with a header
+                           line, ``ndjson`` for one JSON object per line.
+                           Default: ``csv``
+
+        :file: out -- A file-like object to write to. Default: None, to
+                      write to the response of ``REQUEST``
+
+        :bool: compress -- Compress the data with gzip. When writing to the
+                           response it is sent with ``Content-Encoding:
+                           gzip``. Default: False
+
+        :string: filename -- When writing to the response, offer the data
+                             for download under this name. Default: None
+
+        :request: REQUEST -- A Zope REQUEST object, needed if ``out`` is
+                             not given
+
+        Returns the number of rows written to ``out``, or the stream
+        iterator to publish.
+        """
+        encoder_class = encoders.get(format)
+        if encoder_class is None:
+            raise ValueError('Unknown export format %s' % format)
+        if out is None and REQUEST is None:
+            raise ValueError('Either a file or a request is needed to '
+                             'export to.')
+        connection = self._getConnection()
+        if out is not None:
+            return connection.export(query, out, format, bool(compress))
+
+        chunks = connection.iter_export(query, format, bool(compress))
+        RESPONSE = REQUEST.RESPONSE
+        RESPONSE.setHeader('Content-Type', encoder_class.content_type)
+        if compress:
+            RESPONSE.setHeader('Content-Encoding', 'gzip')
+        if filename:
+            RESPONSE.setHeader('Content-Disposition',
+                               'attachment; filename="%s"' %
+                               filename.replace('"', ''))
+        return StreamIterator(chunks)
+
+    security.declareProtected(use_database_methods,  # NOQA: D001
+                              'set_transaction_isolation')
+
+    def set_transaction_isolation(self, level):
+        """ Use another isolation level for the current transaction.
+
+        The database transaction is begun right away with this level, so
+        this must be called before the first query of the transaction.
+        The next transaction uses the level of the connection again.
+
+        :string: level -- ``READ UNCOMMITTED``, ``READ COMMITTED``,
+                          ``REPEATABLE READ`` or ``SERIALIZABLE``
+        """
+        self._getConnection().set_transaction_isolation(level)
 
     security.declareProtected(change_database_methods,  # NOQA: D001
                               'manage_edit')
 
     def manage_edit(self, title, connection_string, check=None,
                     use_unicode=None, charset=None, auto_create_db=None,
-                    timeout=None, REQUEST=None):
+                    timeout=None, coalesce_selects=None,
+                    max_result_bytes=None, session_statements=None,
+                    isolation_level=None, lock_wait_timeout=None,
+                    conflict_error_codes=None, slow_transaction_threshold=None,
+                    xa_transactions=None, REQUEST=None):
         """ Edit the connection attributes through the Zope ZMI.
 
         :string: title -- The title of the ZMySQLDA Connection
@@ -246,12 +586,63 @@ class Connection(ConnectionBase):
         :int: timeout -- The connect timeout for the connection in seconds.
                                  Default: None
 
+        :bool: coalesce_selects -- Let identical read-only SELECT statements
+                                   running at the same time in several
+                                   threads share a single query and result.
+                                   Only queries outside of a transaction
+                                   are shared, so that later queries see
+                                   the snapshot of their own transaction.
+                                   Default: False
+
+        :int: max_result_bytes -- Abort queries fetching more than this
+                                  number of bytes with a ``ResultTooLarge``
+                                  error. Default: None, no limit
+
+        :list: session_statements -- Statements run once on every new
+                                     server session, e.g. to set the time
+                                     zone or ``sql_mode``. Default: None
+
+        :string: isolation_level -- The transaction isolation level of the
+                                    database sessions, e.g.
+                                    ``READ COMMITTED``. Default: None, the
+                                    server default
+
+        :int: lock_wait_timeout -- Seconds to wait for the MySQL lock of a
+                                   connection string starting with
+                                   ``*lock_name``. Requests not getting it
+                                   in time raise a ``ConflictError`` and
+                                   are retried. Default: None, no waiting
+
+        :string: conflict_error_codes -- MySQL error codes raised as
+                                         ``ConflictError`` in transactions,
+                                         in addition to deadlocks (1213)
+                                         and lock wait timeouts (1205).
+                                         Default: None
+
+        :float: slow_transaction_threshold -- Log transactions open longer
+                                              than this many seconds with
+                                              their statements.
+                                              Default: None, no logging
+
+        :bool: xa_transactions -- Use XA transactions, prepared when the
+                                  Zope transaction votes and committed
+                                  with it. Default: False
+
         :request: REQUEST -- A Zope REQUEST object
         """
         self.use_unicode = bool(use_unicode)
         self.charset = charset
         self.auto_create_db = bool(auto_create_db)
         self.timeout = int(timeout) if timeout else None
+        self.coalesce_selects = bool(coalesce_selects)
+        self.max_result_bytes = int(max_result_bytes or 0)
+        self.session_statements = session_lines(session_statements)
+        self.isolation_level = check_isolation_level(isolation_level)
+        self.lock_wait_timeout = int(lock_wait_timeout or 0)
+        self.conflict_error_codes = error_codes(conflict_error_codes)
+        self.slow_transaction_threshold = float(slow_transaction_threshold
+                                                or 0)
+        self.xa_transactions = bool(xa_transactions)
 
         try:
             result = super(Connection, self).manage_edit(title,
@@ -269,6 +660,118 @@ class Connection(ConnectionBase):
             url = '%s/manage_properties?manage_tabs_message=%s'
             REQUEST.RESPONSE.redirect(url % (self.absolute_url(), msg))
 
+    def _getPool(self):
+        """ Helper method to retrieve the shared connection pool, if any,
+            without opening a new connection.
+        """
+        return database_connection_pool.get(self._pool_key())
+
+    security.declareProtected(view_management_screens,  # NOQA: D001
+                              'pool_statistics')
+
+    def pool_statistics(self):
+        """ Return statistics about the pooled per-thread connections
+
+        Used in the Zope ZMI ``Pool`` tab
+        """
+        pool = self._getPool()
+        if pool is None:
+            return {'connected': False, 'size': 0, 'coalesced_queries': 0,
+                    'connections': []}
+
+        connections = pool.connection_stats()
+        return {'connected': True,
+                'size': len(connections),
+                'coalesced_queries': pool.coalesced_queries,
+                'connections': connections}
+
+    security.declareProtected(view_management_screens,  # NOQA: D001
+                              'manage_poolJSON')
+
+    def manage_poolJSON(self, REQUEST=None):
+        """ Return the pool statistics as JSON for monitoring tools.
+
+        :request: REQUEST -- A Zope REQUEST object
+        """
+        if REQUEST is not None:
+            REQUEST.RESPONSE.setHeader('Content-Type', 'application/json')
+        return json.dumps(self.pool_statistics(), sort_keys=True)
+
+    security.declareProtected(open_close_database_connection,  # NOQA: D001
+                              'manage_drainPool')
+
+    def manage_drainPool(self, max_idle=0, REQUEST=None):
+        """ Close pooled connections that are idle and not in a transaction.
+
+        :int: max_idle -- Only close connections idle for at least this
+                          many seconds. Default: 0
+
+        :request: REQUEST -- A Zope REQUEST object
+        """
+        pool = self._getPool()
+        drained = pool.drain(int(max_idle or 0)) if pool is not None else 0
+        msg = '%d idle connection(s) closed.' % drained
+        return self._poolActionResult(drained, msg, REQUEST)
+
+    security.declareProtected(open_close_database_connection,  # NOQA: D001
+                              'manage_reconnectPool')
+
+    def manage_reconnectPool(self, REQUEST=None):
+        """ Force all pooled connections to reconnect before their next use.
+
+        :request: REQUEST -- A Zope REQUEST object
+        """
+        pool = self._getPool()
+        if pool is not None:
+            pool.reconnect_all()
+        msg = 'All connections will reconnect before their next use.'
+        return self._poolActionResult(None, msg, REQUEST)
+
+    security.declareProtected(open_close_database_connection,  # NOQA: D001
+                              'manage_resetPoolCounters')
+
+    def manage_resetPoolCounters(self, REQUEST=None):
+        """ Reset the reconnect and query counters of all pooled connections.
+
+        :request: REQUEST -- A Zope REQUEST object
+        """
+        pool = self._getPool()
+        if pool is not None:
+            pool.reset_counters()
+        return self._poolActionResult(None, 'Counters reset.', REQUEST)
+
+    security.declareProtected(view_management_screens,  # NOQA: D001
+                              'manage_metrics')
+
+    def manage_metrics(self, process=False, REQUEST=None):
+        """ Return performance counters in OpenMetrics text format.
+
+        :bool: process -- Cover all database connections in this process
+                          instead of just this one. Default: False
+
+        :request: REQUEST -- A Zope REQUEST object
+        """
+        if process:
+            pools = sorted(database_connection_pool.items())
+        else:
+            pool = self._getPool()
+            pools = [(self._pool_key(), pool)] if pool is not None else []
+
+        entries = [('/'.join(key), len(pool._db_pool), pool.metrics())
+                   for key, pool in pools]
+
+        if REQUEST is not None:
+            REQUEST.RESPONSE.setHeader('Content-Type', metrics.CONTENT_TYPE)
+        return metrics.render(entries)
+
+    def _poolActionResult(self, result, msg, REQUEST):
+        """ Return ``result`` or redirect back to the ``Pool`` tab.
+        """
+        if REQUEST is None:
+            return result
+        url = '%s/manage_pool?manage_tabs_message=%s'
+        REQUEST.RESPONSE.redirect(url % (self.absolute_url(), msg))
+
     security.declareProtected(view_management_screens,  # NOQA: D001
                               'tpValues')
 
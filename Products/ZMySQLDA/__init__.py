@@ -16,10 +16,14 @@ from App.ImageFile import ImageFile
 
 from . import DA
 from .permissions import add_zmysql_database_connections
+from .tracing import enable_opentelemetry
 
 
 def initialize(context):
 
+    # Report database operations as spans if OpenTelemetry is installed
+    enable_opentelemetry()
+
     context.registerClass(
         DA.Connection,
         permission=add_zmysql_database_connections,
@@ -10,8 +10,22 @@
 # FOR A PARTICULAR PURPOSE.
 #
 ##############################################################################
+import base64
+import binascii
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import math
+import os
+import re
+import shlex
+import socket
+import threading
 import time
+import uuid
+from collections import OrderedDict
 
 import MySQLdb
 import six
@@ -30,6 +44,13 @@ from Shared.DC.ZRDB.TM import TM
 from ZODB.POSException import ConflictError
 from ZODB.POSException import TransactionFailedError
 
+from .export import Chunks
+from .export import Output
+from .export import encoders
+from .metrics import ConnectionMetrics
+from .metrics import result_bytes
+from .results import Columns
+
 
 try:
     import _mysql
@@ -42,6 +63,17 @@ except ImportError:  # mysqlclient > 1.4
     from MySQLdb import OperationalError
     from MySQLdb import ProgrammingError
 
+try:
+    import asyncio
+except ImportError:  # Python 2
+    asyncio = None
+
+try:
+    from concurrent.futures import Future
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without the futures backport
+    Future = ThreadPoolExecutor = None
+
 
 LOG = logging.getLogger('ZMySQLDA')
 
@@ -54,6 +86,30 @@ hosed_connection = {
 
 query_syntax_error = (ER.BAD_FIELD_ERROR,)
 
+# Errors after which a transaction should be retried
+conflict_errors = (ER.LOCK_DEADLOCK, ER.LOCK_WAIT_TIMEOUT)
+
+# Format ID of the XIDs of XA transactions, 'ZMDA'
+XA_FORMAT_ID = 0x5A4D4441
+
+# XA transactions vote and finish after the ZODB storages
+xa_sort_key = '~zmysqlda'
+
+
+class ResultTooLarge(_mysql.Error):
+    """ A query result exceeded the configured byte budget
+    """
+
+
+# Statement types that never modify data
+read_only_types = ('SELECT', 'SHOW', 'DESCRIBE', 'DESC', 'EXPLAIN')
+
+# SELECTs that lock rows, write or depend on session state
+_not_coalescable = re.compile(r'\bFOR\s+(UPDATE|SHARE)\b|\bLOCK\s+IN\b|'
+                              r'\bINTO\b|\b(GET_LOCK|RELEASE_LOCK|FOUND_ROWS|'
+                              r'LAST_INSERT_ID|CONNECTION_ID)\b|@',
+                              re.IGNORECASE)
+
 key_types = {'PRI': 'PRIMARY KEY', 'MUL': 'INDEX', 'UNI': 'UNIQUE'}
 
 field_icons = 'bin', 'date', 'datetime', 'float', 'int', 'text', 'time'
@@ -93,6 +149,32 @@ type_xlate = {
 }
 
 
+_fingerprint_literals = re.compile(r"'(?:[^'\\]|\\.)*'|"
+                                   r'"(?:[^"\\]|\\.)*"|'
+                                   r'\b\d+(?:\.\d+)?\b')
+_fingerprint_lists = re.compile(r'\(\?(?:\s*,\s*\?)+\)')
+
+# Tokens needed to find the type of a statement
+_sql_tokens = re.compile(r"""
+    (?P<skip>\s+|(?:--\s|\#)[^\n]*|/\*.*?\*/|
+             '(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)
+    |(?P<open>\()
+    |(?P<close>\))
+    |(?P<word>[A-Za-z_]+)
+    |(?P<other>.)""", re.DOTALL | re.VERBOSE)
+
+# Statements that may follow common table expressions
+_cte_statements = ('SELECT', 'INSERT', 'REPLACE', 'UPDATE', 'DELETE',
+                   'TABLE', 'VALUES')
+
+# Placeholders of parameterized statements, ``%%`` is a literal percent sign
+_placeholders = re.compile(r'%(s|%)')
+
+# MySQL character set names that Python spells differently
+python_charsets = {'utf8': 'utf-8', 'utf8mb3': 'utf-8', 'utf8mb4': 'utf-8',
+                   'latin1': 'cp1252', 'koi8r': 'koi8_r', 'koi8u': 'koi8_u'}
+
+
 def DateTime_or_None(s):
     try:
         return DateTime(s)
@@ -100,6 +182,399 @@ def DateTime_or_None(s):
         return None
 
 
+def DateTime_to_literal(value, conv):
+    return _mysql.string_literal(value.ISO())
+
+
+def _option_bool(value):
+    value = value.lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError('not a boolean')
+
+
+def _option_seconds(value):
+    value = int(value)
+    if value < 1:
+        raise ValueError('not a positive number of seconds')
+    return value
+
+
+# ``name=value`` options of the connection string, mapped to the
+# keyword argument of ``MySQLdb.connect`` and a function converting
+# and validating the value. SSL options go into the ``ssl`` argument.
+connection_options = {
+    'compress': ('compress', _option_bool),
+    'connect_timeout': ('connect_timeout', _option_seconds),
+    'read_timeout': ('read_timeout', _option_seconds),
+    'write_timeout': ('write_timeout', _option_seconds),
+    'init_command': ('init_command', str),
+    'ssl_mode': ('ssl_mode', str),
+    'ssl_ca': ('ca', str),
+    'ssl_capath': ('capath', str),
+    'ssl_cert': ('cert', str),
+    'ssl_key': ('key', str),
+    'ssl_cipher': ('cipher', str),
+}
+
+
+def connection_option(item):
+    """ Return the name and value of the connection string option
+        ``item``, or None if ``item`` is no ``name=value`` pair with a
+        known name.
+    """
+    name, sep, value = item.partition('=')
+    if not sep or name not in connection_options:
+        return None
+    return name, value
+
+
+# Transaction isolation levels in increasing strictness
+isolation_levels = ('READ UNCOMMITTED', 'READ COMMITTED', 'REPEATABLE READ',
+                    'SERIALIZABLE')
+
+
+def check_isolation_level(level):
+    """ Return the transaction isolation ``level`` in the spelling of
+        ``isolation_levels``, or None for the server default.
+    """
+    if not level:
+        return None
+    normalized = ' '.join(level.replace('-', ' ').replace('_', ' ')
+                          .upper().split())
+    if normalized not in isolation_levels:
+        raise ValueError('Unknown transaction isolation level %s' % level)
+    return normalized
+
+
+def error_codes(codes):
+    """ Return the MySQL error ``codes`` as tuple of integers. ``codes``
+        may also be a string of codes separated by whitespace or commas.
+    """
+    if isinstance(codes, six.string_types):
+        codes = codes.replace(',', ' ').split()
+    return tuple(int(code) for code in codes or ())
+
+
+def xa_branch(path):
+    """ Return the XID branch qualifier for the DA at ``path`` in this
+        Zope instance. It tells the XA transactions of the DA apart from
+        those of other applications using the same database.
+    """
+    name = '%s:%s:%s' % (socket.gethostname(),
+                         os.environ.get('INSTANCE_HOME', ''), path or '')
+    return hashlib.sha1(name.encode('UTF-8')).hexdigest()
+
+
+def session_lines(statements):
+    """ Return the non-empty ``statements`` as tuple, without trailing
+        semicolons. ``statements`` may also be a string of lines.
+    """
+    if isinstance(statements, six.string_types):
+        statements = statements.splitlines()
+    statements = [statement.strip().rstrip(';').strip()
+                  for statement in statements or ()]
+    return tuple(statement for statement in statements if statement)
+
+
+def python_charset(charset):
+    """ Return the Python codec name for the MySQL ``charset``.
+    """
+    charset = charset or 'latin1'
+    return python_charsets.get(charset, charset)
+
+
+def coalescable(sql_string):
+    """ Return True if ``sql_string`` is a single read-only SELECT whose
+        result does not depend on the connection it runs on.
+    """
+    if '\0' in sql_string.strip('\0'):
+        return False
+    if statement_type(sql_string) != 'SELECT':
+        return False
+    return _not_coalescable.search(sql_string) is None
+
+
+def statement_type(sql_string):
+    """ Return the upper-cased type of the statement ``sql_string``.
+
+        Leading comments and parentheses are skipped. For statements with
+        common table expressions (``WITH ...``) the type of the main
+        statement after them is returned.
+    """
+    depth = 0
+    with_clause = False
+    for match in _sql_tokens.finditer(sql_string):
+        kind = match.lastgroup
+        if kind == 'open':
+            depth += 1
+        elif kind == 'close':
+            depth -= 1
+        elif kind == 'word':
+            word = match.group().upper()
+            if not with_clause:
+                if word != 'WITH':
+                    return word
+                with_clause = True
+            elif depth == 0 and word in _cte_statements:
+                return word
+    return 'WITH' if with_clause else ''
+
+
+def _closing(iterable, db):
+    """ Yield the items of ``iterable`` and close the connection ``db``
+        at the end, or when the iteration is abandoned.
+    """
+    try:
+        for item in iterable:
+            yield item
+    finally:
+        db.close()
+
+
+class BlobStream(object):
+    """ A BLOB or TEXT value read on its own connection inside a single
+        consistent snapshot, so that its ``length`` and all chunks belong
+        to the same version of the value, even if it is updated during a
+        download. The snapshot ends when the iterator returned by ``read``
+        is exhausted or abandoned, or with ``close``.
+    """
+
+    def __init__(self, db, length, chunks):
+        self._db = db
+        self.length = length
+        self._chunks = chunks
+
+    def read(self, start=0, end=None):
+        """ Yield the bytes ``start`` to ``end`` (inclusive, None for the
+            last byte) of the value and close the stream at the end.
+        """
+        try:
+            for chunk in self._chunks(start, end):
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        db, self._db = self._db, None
+        if db is None:
+            return
+        try:
+            db.query('COMMIT')
+        except Exception:
+            LOG.warning('Failed to end the snapshot of a BLOB stream.',
+                        exc_info=True)
+        finally:
+            db.close()
+
+
+def statement_types(sql_string):
+    """ Return the type of each statement in ``sql_string``, which may
+        contain several null-separated statements.
+    """
+    statements = filter(None, [q.strip() for q in sql_string.split('\0')])
+    return [statement_type(qs) for qs in statements]
+
+
+# Marks worker threads of the pools, which must not wait for each other
+_worker = threading.local()
+
+
+class _Job(object):
+    """ A query submitted to the worker threads of a pool
+    """
+
+    def __init__(self):
+        # server thread id of the worker's connection while it runs the job
+        self.thread_id = None
+        self.done = False
+        self.lock = allocate_lock()
+
+
+class _Flight(object):
+    """ A query in flight that other threads may wait for
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def fingerprint(sql):
+    """ Return ``sql`` with literal values replaced by ``?`` so that
+        statements differing only in their parameters look the same.
+    """
+    if isinstance(sql, six.binary_type):
+        sql = sql.decode('latin1')
+    sql = _fingerprint_literals.sub('?', sql)
+    sql = _fingerprint_lists.sub('(?+)', sql)
+    return ' '.join(sql.split())[:2000]
+
+
+def quote_identifier(name):
+    """ Return ``name`` quoted for use as MySQL identifier.
+    """
+    return '`%s`' % name.replace('`', '``')
+
+
+def _encode_token(values):
+    """ Return an opaque pagination token for the key ``values``.
+    """
+    typed = []
+    for value in values:
+        if value is None:
+            raise ProgrammingError('Key columns for pagination must not '
+                                   'be NULL.')
+        if isinstance(value, bool) or isinstance(value, six.integer_types):
+            typed.append(['i', int(value)])
+        elif isinstance(value, float):
+            typed.append(['f', value])
+        elif isinstance(value, six.text_type):
+            typed.append(['s', value])
+        elif isinstance(value, six.binary_type):
+            typed.append(['b', base64.b64encode(value).decode('ascii')])
+        elif isinstance(value, DateTime):
+            typed.append(['s', value.ISO()])
+        else:  # datetime, Decimal and the like
+            typed.append(['s', six.text_type(value)])
+    token = json.dumps(typed, separators=(',', ':')).encode('UTF-8')
+    return base64.urlsafe_b64encode(token).decode('ascii')
+
+
+def _decode_token(token, count):
+    """ Return the ``count`` key values of a pagination ``token``.
+
+        Tokens come from the client, so their values are checked and
+        converted to the expected types before they are used.
+    """
+    try:
+        if isinstance(token, six.text_type):
+            token = token.encode('ascii')
+        typed = json.loads(base64.urlsafe_b64decode(token).decode('UTF-8'))
+        if len(typed) != count:
+            raise ValueError(token)
+        values = []
+        for tag, value in typed:
+            if tag == 'i':
+                if isinstance(value, bool) or \
+                   not isinstance(value, six.integer_types):
+                    raise ValueError(value)
+                values.append(int(value))
+            elif tag == 'f':
+                value = float(value)
+                if math.isinf(value) or math.isnan(value):
+                    raise ValueError(value)
+                values.append(value)
+            elif tag == 's':
+                if not isinstance(value, six.text_type):
+                    raise ValueError(value)
+                values.append(value)
+            elif tag == 'b':
+                values.append(base64.b64decode(value.encode('ascii')))
+            else:
+                raise ValueError(tag)
+    except (ValueError, TypeError, AttributeError, binascii.Error):
+        raise ProgrammingError('Invalid page token.')
+    return values
+
+
+class TraceHooks(object):
+    """ Registry of tracing hooks called around database operations.
+
+        A hook provides ``before(operation, info)``, which returns a token,
+        and ``after(operation, token, info)``. ``info`` is a mapping with the
+        DA ``path``, the ``sql`` fingerprint for statements and, when passed
+        to ``after``, the ``duration`` in seconds, the number of ``rows``
+        and the ``error`` raised, if any.
+    """
+
+    def __init__(self):
+        self.hooks = ()
+
+    def register(self, hook):
+        if hook not in self.hooks:
+            self.hooks = self.hooks + (hook,)
+
+    def unregister(self, hook):
+        self.hooks = tuple(h for h in self.hooks if h is not hook)
+
+    def before(self, operation, info):
+        tokens = []
+        for hook in self.hooks:
+            try:
+                tokens.append((hook, hook.before(operation, info)))
+            except Exception:
+                LOG.error('tracing hook %r failed' % hook, exc_info=True)
+        return tokens
+
+    def after(self, operation, tokens, info):
+        for hook, token in reversed(tokens):
+            try:
+                hook.after(operation, token, info)
+            except Exception:
+                LOG.error('tracing hook %r failed' % hook, exc_info=True)
+
+
+trace_hooks = TraceHooks()
+
+
+def _row_count(result):
+    if isinstance(result, tuple) and len(result) == 2:
+        return len(result[1])
+    num_rows = getattr(result, 'num_rows', None)
+    if num_rows is not None:
+        return num_rows()
+    return None
+
+
+def traced(operation, with_sql=False):
+    """ Decorator reporting calls of a ``DB`` method to ``trace_hooks``.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kw):
+            if not trace_hooks.hooks:
+                return func(self, *args, **kw)
+
+            info = {'path': getattr(self, '_path', None)}
+            if with_sql:
+                info['sql'] = fingerprint(args[0] if args else
+                                          kw.get('sql_string',
+                                                 kw.get('query', '')))
+            tokens = trace_hooks.before(operation, info)
+            start = time.time()
+            try:
+                result = func(self, *args, **kw)
+            except Exception as exc:
+                info['error'] = exc
+                raise
+            else:
+                info['rows'] = _row_count(result)
+            finally:
+                info['duration'] = time.time() - start
+                trace_hooks.after(operation, tokens, info)
+            return result
+        return wrapper
+    return decorator
+
+
+class ColumnItem(dict):
+    """ Read-only column description shared by the results of a query
+    """
+
+    def _readonly(self, *args, **kw):
+        raise TypeError('Column descriptions are read-only.')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _readonly
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
 class DBPool(object):
     """
       This class is an interface to the database connection..
@@ -109,25 +584,75 @@ class DBPool(object):
 
     connected_timestamp = ''
     _create_db = False
+    _generation = 0
+    coalesce_selects = False
+    coalesced_queries = 0
+    max_workers = 4
+    _executor = None
     use_unicode = False
     charset = None
+    encoding = 'latin1'
     timeout = None
+    _max_allowed_packet = None
+    # Most values put into one IN list by ``query_in``, the optimizer
+    # tends to give up on index range access for longer lists
+    max_in_values = 5000
+    max_result_bytes = 0
+    # Bytes read per statement when streaming BLOB values with ``iter_blob``.
+    # InnoDB reads the whole value of an off-page BLOB for every chunk, so
+    # a value of n chunks costs n full reads on the server
+    blob_chunk_size = 1048576
 
     def __init__(self, db_cls, create_db=False, use_unicode=False,
-                 charset=None, timeout=None):
+                 charset=None, timeout=None, path=None,
+                 coalesce_selects=False, max_workers=None,
+                 max_result_bytes=0, session_statements=(),
+                 isolation_level=None, lock_wait_timeout=0,
+                 conflict_error_codes=(), slow_transaction_threshold=0,
+                 xa_transactions=False):
         """ Set transaction managed class for use in pool.
         """
         self._db_cls = db_cls
+        # path of the DA using this pool, passed to tracing hooks
+        self.path = path
         # pool of one db object/thread
         self._db_pool = {}
         self._db_lock = allocate_lock()
+        # counters of db objects no longer in the pool
+        self._retired_metrics = ConnectionMetrics()
         # auto-create db if not present on server
         self._create_db = create_db
         # unicode settings
         self.use_unicode = use_unicode
         self.charset = charset
+        if charset and charset.startswith('utf8'):
+            self.encoding = 'UTF-8'
+        else:
+            self.encoding = charset or 'latin1'
         # timeout setting
         self.timeout = int(timeout) if timeout else None
+        # share results of identical concurrent SELECTs between threads
+        self.coalesce_selects = bool(coalesce_selects)
+        self._flights = {}
+        self._flight_lock = allocate_lock()
+        # size of the worker thread pool used for asynchronous queries
+        if max_workers:
+            self.max_workers = int(max_workers)
+        # largest result in bytes a single query may fetch, 0 for no limit
+        self.max_result_bytes = int(max_result_bytes or 0)
+        # statements setting up each new server session
+        self.session_statements = session_lines(session_statements)
+        # transaction isolation level of the server sessions
+        self.isolation_level = check_isolation_level(isolation_level)
+        # seconds to wait for the MySQL lock of the connection string
+        self.lock_wait_timeout = int(lock_wait_timeout or 0)
+        # more errors raised as ConflictError in transactions
+        self.conflict_error_codes = error_codes(conflict_error_codes)
+        # log transactions open longer than this many seconds
+        self.slow_transaction_threshold = float(slow_transaction_threshold
+                                                or 0)
+        # use XA transactions prepared in the two-phase commit vote
+        self.xa_transactions = bool(xa_transactions)
 
     def __call__(self, connection):
         """ Parse the connection string.
@@ -142,6 +667,15 @@ class DBPool(object):
                                                          self.use_unicode,
                                                          charset=self.charset,
                                                          timeout=self.timeout)
+        db_flags['path'] = self.path
+        db_flags['max_result_bytes'] = self.max_result_bytes
+        db_flags['session_statements'] = self.session_statements
+        db_flags['isolation_level'] = self.isolation_level
+        db_flags['lock_wait_timeout'] = self.lock_wait_timeout
+        db_flags['conflict_error_codes'] = self.conflict_error_codes
+        db_flags['slow_transaction_threshold'] = \
+            self.slow_transaction_threshold
+        db_flags['xa_transactions'] = self.xa_transactions
         self._db_flags = db_flags
 
         # connect to server to determin tranasactional capabilities
@@ -178,6 +712,19 @@ class DBPool(object):
         if transactional or db_flags['mysql_lock']:
             db_flags['use_TM'] = True
 
+        if transactional and self.xa_transactions:
+            # Report XA transactions left behind by a crash, using a
+            # connection outside of the pool and the Zope transaction
+            db = self._db_cls(**db_flags)
+            try:
+                db.xa_recover()
+            except _mysql.Error:
+                # E.g. XA RECOVER needs XA_RECOVER_ADMIN since MySQL 8.0.19
+                LOG.warning('Failed to look for in-doubt XA transactions.',
+                            exc_info=True)
+            finally:
+                db.close()
+
         # will not be 100% accurate in regard to per thread connections
         # but as close as we're going to get it.
         self.connected_timestamp = DateTime()
@@ -204,7 +751,85 @@ class DBPool(object):
             dereferences the db_cls instances where they are then collected
             and closed.
         """
-        self._db_pool = {}
+        self._db_lock.acquire()
+        try:
+            for db in self._db_pool.values():
+                self._retire(db)
+            self._db_pool = {}
+            executor, self._executor = self._executor, None
+        finally:
+            self._db_lock.release()
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def connection_stats(self):
+        """ Return a list of statistics mappings, one per pooled
+            db_cls instance, sorted by thread id.
+        """
+        now = time.time()
+        thread_names = dict((t.ident, t.name) for t in threading.enumerate())
+        stats = []
+        for ident, db in sorted(self._db_pool.items()):
+            info = db.stats(now)
+            info['thread_id'] = ident
+            info['thread_name'] = thread_names.get(ident, '')
+            stats.append(info)
+        return stats
+
+    def drain(self, max_idle=0):
+        """ Remove pooled connections that have been idle for at least
+            ``max_idle`` seconds and are not part of a running transaction.
+            They are closed once the last reference to them goes away.
+            Returns the number of connections removed.
+        """
+        cutoff = time.time() - max_idle
+        drained = 0
+        for ident, db in list(self._db_pool.items()):
+            if db._registered or db._last_used > cutoff:
+                continue
+            try:
+                self._pool_del(ident)
+            except KeyError:
+                continue
+            drained += 1
+        return drained
+
+    def reconnect_all(self):
+        """ Force all pooled connections to reconnect.
+
+            Connections belong to their thread, so they cannot be reconnected
+            from here. Instead, each one reconnects the next time its own
+            thread uses it outside of a transaction.
+        """
+        self._db_lock.acquire()
+        try:
+            self._generation += 1
+        finally:
+            self._db_lock.release()
+
+    def metrics(self):
+        """ Return the performance counters of all connections ever
+            pooled here, merged into a single ``ConnectionMetrics`` object.
+        """
+        merged = ConnectionMetrics()
+        merged.merge(self._retired_metrics)
+        for db in list(self._db_pool.values()):
+            merged.merge(db._metrics)
+        return merged
+
+    def _retire(self, db):
+        """ Keep the counters of ``db`` when it leaves the pool so the
+            exposed totals never decrease. Call with the pool lock held.
+        """
+        metrics = getattr(db, '_metrics', None)
+        if metrics is not None:
+            self._retired_metrics.merge(metrics)
+
+    def reset_counters(self):
+        """ Reset the usage counters of all pooled connections.
+        """
+        for db in list(self._db_pool.values()):
+            db._reset_counters()
 
     def _pool_set(self, key, value):
         """ Add a db to pool.
@@ -225,7 +850,7 @@ class DBPool(object):
         """
         self._db_lock.acquire()
         try:
-            del self._db_pool[key]
+            self._retire(self._db_pool.pop(key))
         finally:
             self._db_lock.release()
 
@@ -245,8 +870,63 @@ class DBPool(object):
         return self._access_db(method_id='columns', args=args, kw=kw)
 
     def query(self, *args, **kw):
+        if self.coalesce_selects:
+            return self._coalesced_query(*args, **kw)
         return self._access_db(method_id='query', args=args, kw=kw)
 
+    def _coalesced_query(self, sql_string, max_rows=1000, params=None):
+        """ Run ``query``, but let identical read-only SELECTs issued by
+            several threads at the same time share the result of the first.
+            Threads inside a transaction always run their own query, so
+            that they see their own changes and the snapshot of their
+            transaction. Only the first query of a transaction is shared.
+        """
+        db = self._pool_get(get_ident())
+        if params is not None:
+            params = tuple(params)
+        if not coalescable(sql_string) or (db is not None and db._registered):
+            return self._access_db(method_id='query',
+                                   args=(sql_string, max_rows, params),
+                                   kw={})
+
+        key = (sql_string, max_rows, params)
+        self._flight_lock.acquire()
+        try:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        finally:
+            self._flight_lock.release()
+
+        if not leader:
+            flight.event.wait()
+            self._flight_lock.acquire()
+            try:
+                self.coalesced_queries += 1
+            finally:
+                self._flight_lock.release()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._access_db(method_id='query',
+                                            args=(sql_string, max_rows,
+                                                  params),
+                                            kw={})
+        except Exception as exc:
+            flight.error = exc
+            raise
+        finally:
+            self._flight_lock.acquire()
+            try:
+                del self._flights[key]
+            finally:
+                self._flight_lock.release()
+            flight.event.set()
+        return flight.result
+
     def string_literal(self, *args, **kw):
         return self._access_db(method_id='string_literal', args=args, kw=kw)
 
@@ -255,27 +935,493 @@ class DBPool(object):
             return self._access_db(method_id='unicode_literal',
                                    args=args, kw=kw)
         except AttributeError:  # mysqlclient > 1.3.11
-            if self.charset and self.charset.startswith('utf8'):
-                charset = 'UTF-8'
-            else:
-                charset = self.charset
             # This is modeled after code in MySQLdb.connections.__init__
-            new_args = (args[0].encode(charset or 'latin1'),) + args[1:]
+            new_args = (args[0].encode(self.encoding),) + args[1:]
             return self._access_db(method_id='string_literal',
                                    args=new_args, kw=kw)
 
-    def _access_db(self, method_id, args, kw):
+    def quoter(self):
+        """ Return a function quoting a single value for inclusion in a
+            query on the current thread's connection.
+
+            The connection and the character set are resolved once, so
+            the returned function is cheap to call for many values. It
+            must not be kept beyond the current request.
         """
-          Generic method to call pooled objects' methods.
-          When the current thread had never issued any call, create a db_cls
-          instance.
+        string_literal = self._get_db().db.string_literal
+        if not self.use_unicode:
+            return string_literal
+        encoding = self.encoding
+
+        def quote(value):
+            if isinstance(value, six.text_type):
+                # Return the same type of string that was passed in
+                return string_literal(value.encode(encoding)).decode(encoding)
+            return string_literal(value)
+
+        return quote
+
+    def aquery(self, sql_string, max_rows=1000):
+        """ Asyncio variant of ``query`` for use in a running event loop.
+
+            The query runs on one of the pool's worker threads, each of
+            which keeps its own connection and commits its own transaction.
+            Returns an awaitable resolving to ``(items, rows)``. Cancelling
+            it kills the query on the server if it already started.
+
+            Connections using a MySQL lock run the query right away on the
+            current thread instead, because worker threads would compete
+            for the lock. This blocks the event loop until the query is
+            done, like a call of ``query``, and the awaitable cannot be
+            cancelled any more.
+        """
+        if asyncio is None or ThreadPoolExecutor is None:
+            raise NotSupportedError('aquery requires asyncio')
+
+        if self._db_flags.get('mysql_lock'):
+            future = Future()
+            try:
+                future.set_result(self.query(sql_string, max_rows))
+            except Exception as exc:
+                future.set_exception(exc)
+            return asyncio.wrap_future(future)
+
+        job = _Job()
+        future = self._get_executor().submit(self._run_job, job, 'query',
+                                             (sql_string, max_rows), {})
+        async_future = asyncio.wrap_future(future)
+
+        def cancelled(async_future):
+            if async_future.cancelled():
+                self._cancel_job(job)
+
+        async_future.add_done_callback(cancelled)
+        return async_future
+
+    def query_columns(self, *args, **kw):
+        return self._access_db(method_id='query_columns', args=args, kw=kw)
+
+    def export(self, *args, **kw):
+        return self._access_db(method_id='export', args=args, kw=kw)
+
+    def set_transaction_isolation(self, *args, **kw):
+        return self._access_db(method_id='set_transaction_isolation',
+                               args=args, kw=kw)
+
+    def query_many(self, queries, max_rows=1000):
+        """ Run several independent ``queries`` concurrently on the pool's
+            worker threads and return their ``(items, rows)`` results in the
+            same order.
+
+            The queries are run one after the other on the current thread's
+            own connection instead if any of them may write, lock rows or
+            depend on session state, if the connection uses a MySQL lock,
+            or if the current thread already wrote data in its transaction,
+            so that they take part in the current Zope transaction.
+        """
+        queries = list(queries)
+        db = self._pool_get(get_ident())
+        serial = (len(queries) < 2 or ThreadPoolExecutor is None or
+                  getattr(_worker, 'active', False) or
+                  # Workers would compete for the MySQL lock
+                  self._db_flags.get('mysql_lock') or
+                  (db is not None and db._registered and db._wrote))
+        if not serial:
+            for sql_string in queries:
+                if _not_coalescable.search(sql_string) is not None:
+                    # Locks and session state belong to this connection
+                    serial = True
+                for qtype in statement_types(sql_string):
+                    if qtype not in read_only_types:
+                        serial = True
+        if serial:
+            return [self.query(sql_string, max_rows) for sql_string in queries]
+
+        executor = self._get_executor()
+        futures = [executor.submit(self._run_job, _Job(), 'query',
+                                   (sql_string, max_rows), {})
+                   for sql_string in queries]
+        return [future.result() for future in futures]
+
+    def query_in(self, sql_string, values, max_rows=1000, parallel=False):
+        """ Run ``sql_string`` for a possibly huge sequence of ``values``.
+
+            ``sql_string`` must contain a single ``%s`` placeholder that
+            takes an IN list like ``SELECT * FROM t WHERE id IN %s``, other
+            percent signs are doubled. The values are quoted and split into
+            IN lists small enough for the server's ``max_allowed_packet``.
+            The statements run one after the other, or concurrently via
+            ``query_many`` if ``parallel`` is true. Their results are merged
+            into a single ``(items, rows)`` result of at most ``max_rows``.
+        """
+        if _placeholders.findall(sql_string).count('s') != 1:
+            raise ProgrammingError('The statement needs exactly one %s '
+                                   'placeholder for the IN list.')
+        statements = [_placeholders.sub(
+            lambda match: in_list if match.group(1) == 's' else '%',
+            sql_string) for in_list in self._in_lists(sql_string, values)]
+
+        if parallel:
+            results = self.query_many(statements, max_rows)
+        else:
+            results = [self.query(statement, max_rows)
+                       for statement in statements]
+
+        items = ()
+        rows = []
+        for result_items, result_rows in results:
+            if not result_items:
+                continue
+            if items and [(i['name'], i['type']) for i in items] != \
+                    [(i['name'], i['type']) for i in result_items]:
+                raise ProgrammingError('Multiple select schema are not '
+                                       'allowed.')
+            items = result_items
+            rows.extend(result_rows)
+        if max_rows:
+            del rows[max_rows:]
+        return items, tuple(rows)
+
+    def max_allowed_packet(self):
+        """ Return the largest statement size in bytes the server accepts.
+        """
+        if self._max_allowed_packet is None:
+            items, rows = self._access_db(
+                method_id='query',
+                args=("SHOW VARIABLES LIKE 'max_allowed_packet'", 0), kw={})
+            # Fall back to the smallest default of supported servers
+            self._max_allowed_packet = int(rows[0][1]) if rows else 4194304
+        return self._max_allowed_packet
+
+    def _in_lists(self, sql_string, values):
+        """ Return the quoted ``values`` as parenthesized IN lists that each
+            fit into a statement with ``sql_string``.
+        """
+        # Leave room for the statement itself and the LIMIT clause
+        budget = self.max_allowed_packet() - len(sql_string) * 4 - 1024
+        quote = self.quoter()
+        in_list = []
+        size = 0
+        for value in values:
+            literal = self._literal(quote, value)
+            length = len(literal)
+            if isinstance(literal, six.text_type):
+                length = len(literal.encode(self.encoding))
+            if in_list and (size + length + 1 > budget or
+                            len(in_list) >= self.max_in_values):
+                yield '(%s)' % ','.join(in_list)
+                in_list = []
+                size = 0
+            in_list.append(literal)
+            size += length + 1
+        if in_list:
+            yield '(%s)' % ','.join(in_list)
+
+    def _literal(self, quote, value):
+        """ Return ``value`` as SQL literal using the ``quote`` function
+            returned by ``quoter``.
+        """
+        if isinstance(value, float):
+            return repr(value)
+        if isinstance(value, six.integer_types) and \
+           not isinstance(value, bool):
+            return str(value)
+        literal = quote(value)
+        if six.PY3 and isinstance(literal, six.binary_type):
+            try:
+                literal = literal.decode(self.encoding)
+            except UnicodeDecodeError:
+                if not isinstance(value, six.binary_type):
+                    raise
+                # Binary data that is no text in the connection charset
+                literal = "X'%s'" % binascii.hexlify(value).decode('ascii')
+        return literal
+
+    def paginate(self, sql_string, key_columns, page_size, after=None,
+                 descending=False):
+        """ Return one page of the result of the SELECT ``sql_string`` as
+            ``(items, rows, token)``.
+
+            The rows are ordered by ``key_columns``, which must be part of
+            the result and unique together. Instead of skipping rows with an
+            OFFSET the query only asks for rows after the last key of the
+            previous page, given by the ``token`` returned with it. ``token``
+            is None on the last page.
+
+            The query becomes a derived table of the paginating statement.
+            Every page only costs the same if the key columns are indexed
+            and the server merges the derived table into the outer query.
+            It does not for queries with GROUP BY, DISTINCT, UNION,
+            aggregate functions or LIMIT, whose whole result is built for
+            every page.
+        """
+        sql_string = sql_string.strip().rstrip(';').strip()
+        if statement_types(sql_string) != ['SELECT']:
+            raise ProgrammingError('Only single SELECT statements can be '
+                                   'paginated.')
+        if isinstance(key_columns, six.string_types):
+            key_columns = [key_columns]
+        key_columns = list(key_columns)
+        if not key_columns or page_size < 1:
+            raise ProgrammingError('Pagination needs key columns and a '
+                                   'positive page size.')
+
+        columns = ', '.join(quote_identifier(name) for name in key_columns)
+        direction = ' DESC' if descending else ''
+        where = ''
+        if after:
+            quote = self.quoter()
+            values = [self._literal(quote, value)
+                      for value in _decode_token(after, len(key_columns))]
+            if len(values) == 1:
+                where = ' WHERE %s %s %s' % (columns, '<' if descending
+                                             else '>', values[0])
+            else:
+                where = ' WHERE (%s) %s (%s)' % (columns, '<' if descending
+                                                 else '>', ', '.join(values))
+        statement = 'SELECT * FROM (%s) AS zmysqlda_page%s ORDER BY %s' % (
+            sql_string, where, ', '.join(quote_identifier(name) + direction
+                                         for name in key_columns))
+
+        items, rows = self.query(statement, page_size + 1)
+        token = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            names = [item['name'] for item in items]
+            try:
+                positions = [names.index(name) for name in key_columns]
+            except ValueError:
+                raise ProgrammingError('The key columns must be part of the '
+                                       'result.')
+            token = _encode_token([rows[-1][i] for i in positions])
+        return items, rows, token
+
+    def _blob_where(self, key):
+        """ Return the condition selecting the row identified by the
+            ``key`` mapping of column names to values.
+        """
+        if not key:
+            raise ProgrammingError('A key is needed to select a value.')
+        quote = self.quoter()
+        return ' AND '.join('%s = %s' % (quote_identifier(name),
+                                         self._literal(quote, key[name]))
+                            for name in sorted(key))
+
+    def _blob_statement(self, expression, table, where):
+        """ Return a SELECT of ``expression`` from the single row of
+            ``table`` matching the condition ``where``.
+        """
+        return 'SELECT %s FROM %s WHERE %s LIMIT 1' % (
+            expression, quote_identifier(table), where)
+
+    def blob_length(self, table, column, key):
+        """ Return the length in bytes of the value of ``column`` in the
+            row of ``table`` identified by ``key``, or None if there is no
+            such row or the value is NULL.
+        """
+        return self._blob_length(self.query, table, column,
+                                 self._blob_where(key))
+
+    def _blob_length(self, query, table, column, where):
+        items, rows = query(self._blob_statement(
+            'OCTET_LENGTH(%s)' % quote_identifier(column), table, where))
+        if not rows or rows[0][0] is None:
+            return None
+        return int(rows[0][0])
+
+    def iter_blob(self, table, column, key, start=0, end=None,
+                  chunk_size=None):
+        """ Yield the bytes ``start`` to ``end`` (inclusive, None for the
+            last byte) of the BLOB or TEXT value of ``column`` in the row of
+            ``table`` identified by ``key``.
+
+            Every chunk of at most ``chunk_size`` bytes is read with its own
+            ``SUBSTRING`` query, so the whole value is never held in the
+            client's memory. The server may read the whole value for every
+            chunk, see ``blob_chunk_size``.
+        """
+        return self._blob_chunks(self.query, table, column,
+                                 self._blob_where(key), start, end,
+                                 chunk_size)
+
+    def open_blob(self, table, column, key, chunk_size=None):
+        """ Return a ``BlobStream`` over the value of ``column`` in the
+            row of ``table`` identified by ``key``. Its ``length`` is None
+            if there is no such row or the value is NULL.
+
+            The value is read on a new connection outside of the pool and
+            of the Zope transaction, inside a consistent snapshot started
+            right away. The stream can still be read after the request
+            ended, e.g. by the publisher.
+        """
+        where = self._blob_where(key)
+        db = self._stream_db()
+        try:
+            db.query('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+            length = self._blob_length(db.query, table, column, where)
+        except Exception:
+            db.close()
+            raise
+
+        def chunks(start, end):
+            return self._blob_chunks(db.query, table, column, where, start,
+                                     end, chunk_size)
+
+        return BlobStream(db, length, chunks)
+
+    def iter_export(self, sql_string, format='csv', compress=False):
+        """ Return an iterator over the data written by ``DB.export``.
+
+            The statement runs right away on a new connection outside of
+            the pool and of the Zope transaction, which is closed at the
+            end. The rows are fetched while the iterator is read, which may
+            happen after the request ended, e.g. by the publisher.
+        """
+        db = self._stream_db()
+        try:
+            chunks = db.iter_export(sql_string, format, compress)
+        except Exception:
+            db.close()
+            raise
+        return _closing(chunks, db)
+
+    def _stream_db(self):
+        """ Return a new db_cls instance for reading a result after the
+            request ended, when the thread's connection may be in use by
+            the next request or the Zope transaction is over.
+        """
+        db_flags = dict(self._db_flags, use_TM=False, transactions=False,
+                        mysql_lock=None, xa_transactions=False)
+        return self._db_cls(**db_flags)
+
+    def _blob_chunks(self, query, table, column, where, start, end,
+                     chunk_size):
+        chunk_size = chunk_size or self.blob_chunk_size
+        column = 'CAST(%s AS BINARY)' % quote_identifier(column)
+        offset = start
+        while end is None or offset <= end:
+            size = chunk_size
+            if end is not None:
+                size = min(size, end - offset + 1)
+            expression = 'SUBSTRING(%s, %d, %d)' % (column, offset + 1, size)
+            items, rows = query(self._blob_statement(expression, table,
+                                                     where))
+            chunk = rows[0][0] if rows else None
+            if not chunk:
+                return
+            yield chunk
+            offset += len(chunk)
+
+    def kill_query(self, thread_id):
+        """ Kill the statement running on the server connection with
+            the given ``thread_id`` using a separate connection.
+        """
+        connection = MySQLdb.connect(**self._db_flags['kw_args'])
+        try:
+            connection.query('KILL QUERY %d' % int(thread_id))
+        finally:
+            connection.close()
+
+    def _get_executor(self):
+        """ Return the worker thread pool, creating it on first use.
+        """
+        self._db_lock.acquire()
+        try:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers)
+            return self._executor
+        finally:
+            self._db_lock.release()
+
+    def _run_job(self, job, method_id, args, kw):
+        """ Call a method of the worker thread's db_cls instance inside
+            its own Zope transaction.
+        """
+        db = self._get_db()
+        _worker.active = True
+        transaction.begin()
+        try:
+            # The ping when beginning may reconnect with a new thread id
+            db._use_TM and db._register()
+            job.lock.acquire()
+            try:
+                job.thread_id = db.db.thread_id()
+            finally:
+                job.lock.release()
+            result = getattr(db, method_id)(*args, **kw)
+            transaction.commit()
+        except Exception:
+            transaction.abort()
+            raise
+        finally:
+            # The connection may run the next job from now on
+            job.lock.acquire()
+            try:
+                job.done = True
+                job.thread_id = None
+            finally:
+                job.lock.release()
+            _worker.active = False
+        return result
+
+    def _cancel_job(self, job):
+        """ Kill the query of a cancelled job that is still running.
+        """
+        thread_id = job.thread_id
+        if job.done or thread_id is None:
+            return
+
+        def kill():
+            try:
+                self._kill_job(job)
+            except Exception:
+                LOG.warning('failed to kill query on connection %s' %
+                            thread_id, exc_info=True)
+
+        # Do not block the event loop while connecting to the server
+        killer = threading.Thread(target=kill)
+        killer.daemon = True
+        killer.start()
+
+    def _kill_job(self, job):
+        """ Kill the query of ``job`` using a separate connection, unless
+            the job finished while connecting. Its worker's connection may
+            already run the next job then.
+        """
+        connection = MySQLdb.connect(**self._db_flags['kw_args'])
+        try:
+            job.lock.acquire()
+            try:
+                if not job.done and job.thread_id is not None:
+                    connection.query('KILL QUERY %d' % job.thread_id)
+            finally:
+                job.lock.release()
+        finally:
+            connection.close()
+
+    def _get_db(self):
+        """ Return the current thread's db_cls instance, creating it
+            when the current thread had never issued any call.
         """
         ident = get_ident()
         db = self._pool_get(ident)
         if db is None:
             db = self._db_cls(**self._db_flags)
+            db._generation = self._generation
             self._pool_set(ident, db)
-        return getattr(db, method_id)(*args, **kw)
+        elif db._generation != self._generation and not db._registered:
+            db._forceReconnection()
+            db._generation = self._generation
+        db._last_used = time.time()
+        return db
+
+    def _access_db(self, method_id, args, kw):
+        """
+          Generic method to call pooled objects' methods.
+          When the current thread had never issued any call, create a db_cls
+          instance.
+        """
+        return getattr(self._get_db(), method_id)(*args, **kw)
 
 
 class DB(TM):
@@ -306,21 +1452,79 @@ class DB(TM):
     conv[FIELD_TYPE.DECIMAL] = float
     conv[FIELD_TYPE.NEWDECIMAL] = float
     del conv[FIELD_TYPE.TIME]
+    conv[DateTime] = DateTime_to_literal
 
     _p_oid = _p_changed = None
     _sort_key = '1'
     _registered = False
     _finalize = False
+    _generation = 0
+    _created = _last_used = 0
+    _reconnects = _queries = 0
+    _wrote = False
+    _statement_counter = 0
+
+    # Server-side prepared statements kept per connection
+    prepared_cache_size = 64
+    # Rows fetched at once when building columnar results
+    fetch_batch_size = 1000
+    # Result descriptions with cached column items per connection
+    items_cache_size = 128
+    # Largest result in bytes a single query may fetch, 0 for no limit
+    max_result_bytes = 0
+    # Bytes collected before exported data is written out
+    export_buffer_size = 65536
+    # Statements run on every new server session
+    session_statements = ()
+    _session_thread_id = None
+    # Transaction isolation level of the session, None for the default
+    isolation_level = None
+    # Isolation level requested for the next transaction only
+    _transaction_isolation = None
+    # Seconds to wait for the MySQL lock when a transaction begins
+    lock_wait_timeout = 0
+    # Errors raised as ConflictError in transactions, so Zope retries them
+    conflict_errors = conflict_errors
+    # Log transactions open longer than this many seconds, 0 to disable
+    slow_transaction_threshold = 0
+    # Statements of a transaction kept for the slow transaction log
+    max_logged_statements = 50
+    _transaction_start = None
+    # Use XA transactions, prepared when the Zope transaction votes
+    xa_transactions = False
+    # XID and state of the running XA transaction
+    _xid = None
+    _xa_state = None
 
     unicode_charset = 'utf8'  # hardcoded for now
 
     def __init__(self, connection=None, kw_args=None, use_TM=None,
-                 mysql_lock=None, transactions=None):
+                 mysql_lock=None, transactions=None, path=None,
+                 max_result_bytes=0, session_statements=(),
+                 isolation_level=None, lock_wait_timeout=0,
+                 conflict_error_codes=(), slow_transaction_threshold=0,
+                 xa_transactions=False):
         self.connection = connection  # backwards compat
         self._kw_args = kw_args
+        self._path = path
+        self.max_result_bytes = max_result_bytes
+        self.session_statements = tuple(session_statements)
+        self.isolation_level = isolation_level
+        self.lock_wait_timeout = lock_wait_timeout
+        if conflict_error_codes:
+            self.conflict_errors = conflict_errors + tuple(
+                conflict_error_codes)
+        self.slow_transaction_threshold = slow_transaction_threshold
         self._mysql_lock = mysql_lock
         self._use_TM = use_TM
         self._transactions = transactions
+        if xa_transactions and transactions:
+            self.xa_transactions = True
+            self._xa_branch = xa_branch(path)
+            self.setSortKey(xa_sort_key)
+        self._created = self._last_used = time.time()
+        self._metrics = ConnectionMetrics()
+        self._items_cache = {}
         self._forceReconnection()
 
     def close(self):
@@ -332,17 +1536,103 @@ class DB(TM):
 
     __del__ = close
 
+    @traced('connect')
     def _forceReconnection(self):
         """ (Re)Connect to database.
         """
+        if getattr(self, 'db', None) is not None:
+            self._reconnects += 1
         try:  # try to clean up first
             self.db.close()
         except Exception:
             pass
         self.db = MySQLdb.connect(**self._kw_args)
+        # Prepared statements and session settings do not survive the
+        # connection
+        self._prepared = OrderedDict()
+        self._select_limit = None
         # Newer mysqldb requires ping argument to attmept a reconnect.
         # This setting is persistent, so only needed once per connection.
         self.db.ping(True)
+        self._init_session()
+
+    def _session_setup(self):
+        """ Return the statements setting up a new server session.
+        """
+        statements = list(self.session_statements)
+        if self.isolation_level:
+            statements.insert(0, 'SET SESSION TRANSACTION ISOLATION LEVEL %s'
+                              % self.isolation_level)
+        return statements
+
+    def _init_session(self):
+        """ Set up the server session of the current connection in a
+            single round trip.
+        """
+        self._session_thread_id = self.db.thread_id()
+        statements = self._session_setup()
+        if not statements:
+            return
+        try:
+            self.db.query(';\n'.join(statements))
+        except (OperationalError, ProgrammingError):
+            LOG.error('statement failed:\n%s' % statements[0])
+            raise
+        self._next_results(statements, self.db.store_result())
+        # Results of stored procedures called by the statements
+        while self.db.next_result() == 0:
+            self.db.store_result()
+
+    def _next_results(self, statements, result):
+        """ Read the results of the ``statements`` after the first one,
+            which were sent together, and return the last result.
+
+            Every statement has its own result, and errors of the statements
+            after the first one are raised when reaching their result.
+        """
+        for statement in statements[1:]:
+            try:
+                self.db.next_result()
+            except (OperationalError, ProgrammingError) as exc:
+                self._check_conflict(exc)
+                LOG.error('statement failed:\n%s' % statement)
+                raise
+            result = self.db.store_result()
+        return result
+
+    def _query_batch(self, statements):
+        """ Send the ``statements`` in a single round trip and return the
+            result of the last one.
+        """
+        return self._next_results(statements,
+                                  self._query(';\n'.join(statements)))
+
+    def set_transaction_isolation(self, level):
+        """ Run the current transaction with the isolation ``level``
+            instead of the level of the session.
+
+            The transaction is begun right away, so this must be called
+            before its first statement.
+        """
+        level = check_isolation_level(level)
+        if not self._transactions:
+            raise NotSupportedError('Isolation levels need a transactional '
+                                    'connection.')
+        if getattr(self, '_transaction_begun', False):
+            raise ProgrammingError('The isolation level must be set before '
+                                   'the first statement of a transaction.')
+        self._transaction_isolation = level
+        self._use_TM and self._register()
+
+    def _check_session(self):
+        """ Set up the server session again if the client library
+            reconnected on its own, e.g. during ``ping``.
+        """
+        if self.db.thread_id() != self._session_thread_id:
+            LOG.info('Connection was reestablished by the client library.')
+            self._prepared.clear()
+            self._select_limit = None
+            self._init_session()
 
     @classmethod
     def _parse_connection_string(cls, connection, use_unicode=False,
@@ -361,7 +1651,14 @@ class DB(TM):
             kw_args['charset'] = cls.unicode_charset
         if charset:
             kw_args['charset'] = charset
-        items = connection.split()
+        items = []
+        for match in re.finditer(r'\S+', connection):
+            if connection_option(match.group()) is not None:
+                # Option values may be quoted to include whitespace
+                options = shlex.split(connection[match.start():])
+                cls._parse_connection_options(options, kw_args)
+                break
+            items.append(match.group())
         flags['use_TM'] = None
         if _mysql.get_client_info()[0] >= '5':
             kw_args['client_flag'] = CLIENT.MULTI_STATEMENTS
@@ -401,14 +1698,43 @@ class DB(TM):
 
         return flags
 
+    @classmethod
+    def _parse_connection_options(cls, options, kw_args):
+        """ Validate the ``name=value`` ``options`` that end a connection
+            string and add them to the ``kw_args`` for ``MySQLdb.connect``.
+        """
+        for item in options:
+            option = connection_option(item)
+            if option is None:
+                raise ValueError('Unknown connection string option %s, '
+                                 'options must follow all other parts of '
+                                 'the connection string.' % item)
+            name, value = option
+            key, convert = connection_options[name]
+            try:
+                value = convert(value)
+            except ValueError as exc:
+                raise ValueError('Invalid value for connection string '
+                                 'option %s: %s' % (name, exc))
+            if name.startswith('ssl_') and name != 'ssl_mode':
+                kw_args.setdefault('ssl', {})[key] = value
+            else:
+                kw_args[key] = value
+
+    def _charset(self):
+        """ Return the Python codec for strings fetched as bytes.
+        """
+        charset = self._kw_args.get('charset', 'UTF-8')
+        if charset.startswith('utf8'):
+            charset = 'UTF-8'
+        return charset
+
     def tables(self, rdb=0, _care=('TABLE', 'VIEW')):
         """ Returns list of tables.
         """
         t_list = []
         db_result = self._query('SHOW TABLE STATUS')
-        charset = self._kw_args.get('charset', 'UTF-8')
-        if charset.startswith('utf8'):
-            charset = 'UTF-8'
+        charset = self._charset()
 
         for row in db_result.fetch_row(0):
             variables = {}
@@ -438,9 +1764,7 @@ class DB(TM):
             LOG.warning('columns query for non-existing table %s' % table_name)
             return ()
 
-        charset = self._kw_args.get('charset', 'UTF-8')
-        if charset.startswith('utf8'):
-            charset = 'UTF-8'
+        charset = self._charset()
 
         for Field, Type, Null, Key, Default, Extra in db_result.fetch_row(0):
 
@@ -514,7 +1838,8 @@ class DB(TM):
         variables = self._query('SHOW VARIABLES')
         return dict((name, value) for name, value in variables.fetch_row(0))
 
-    def _query(self, query, force_reconnect=False):
+    @traced('statement', with_sql=True)
+    def _query(self, query, force_reconnect=False, unbuffered=False):
         """
           Send a query to MySQL server.
           It reconnects automaticaly if needed and the following conditions are
@@ -525,9 +1850,13 @@ class DB(TM):
              because they are bound to the connection. This check can be
              overridden by passing force_reconnect with True value.
         """
+        if self._transaction_start is not None and \
+           self.slow_transaction_threshold:
+            self._log_statement(query)
         try:
             self.db.query(query)
         except OperationalError as exc:
+            self._check_conflict(exc)
             if exc.args[0] in query_syntax_error:
                 raise OperationalError(exc.args[0],
                                        '%s: %s' % (exc.args[1], query))
@@ -546,13 +1875,20 @@ class DB(TM):
             if exc.args[0] in hosed_connection:
                 msg = '%s Forcing a reconnect.' % hosed_connection[exc.args[0]]
                 LOG.error(msg)
+                self._metrics.reconnects += 1
+            limit = self._select_limit
             self._forceReconnection()
+            if limit is not None:
+                # The new session has no row limit yet
+                self._set_select_limit(limit)
             self.db.query(query)
         except ProgrammingError as exc:
+            self._check_conflict(exc)
             if exc.args[0] in hosed_connection:
                 self._forceReconnection()
                 msg = '%s Forcing a reconnect.' % hosed_connection[exc.args[0]]
                 LOG.error(msg)
+                self._metrics.reconnects += 1
             else:
                 if len(query) > 2000:
                     msg = '%s... (truncated at 2000 chars)' % query[:2000]
@@ -561,20 +1897,72 @@ class DB(TM):
                 LOG.warning('query failed:\n%s' % msg)
             raise
 
+        except _mysql.Error as exc:
+            self._check_conflict(exc)
+            raise
+
+        if unbuffered:
+            return self.db.use_result()
         return self.db.store_result()
 
-    def query(self, sql_string, max_rows=1000):
+    def _observe_query(self, qtype, duration, rows=0, nbytes=0):
+        """ Record a statement in the metrics and the time spent on it
+            in the running transaction.
+        """
+        self._metrics.observe_query(qtype, duration, rows, nbytes)
+        if self._transaction_start is not None:
+            self._transaction_busy += duration
+
+    def _log_statement(self, query):
+        """ Keep ``query`` for the log of a slow transaction.
+        """
+        if len(self._transaction_statements) < self.max_logged_statements:
+            if isinstance(query, six.binary_type):
+                query = query.decode('UTF-8', 'replace')
+            self._transaction_statements.append(query)
+        else:
+            self._transaction_skipped += 1
+
+    def _check_conflict(self, exc):
+        """ Raise a ``ConflictError`` for the database error ``exc`` if
+            it is one of the ``conflict_errors`` and Zope can retry the
+            transaction.
+        """
+        if not self._transactions or not exc.args or \
+           exc.args[0] not in self.conflict_errors:
+            return
+        self._metrics.observe_conflict(exc.args[0])
+        LOG.info('Raising ConflictError for MySQL error %s' % (exc.args,))
+        raise ConflictError('MySQL error %s: %s' % (exc.args[0],
+                                                    exc.args[1:]))
+
+    @traced('query', with_sql=True)
+    def query(self, sql_string, max_rows=1000, params=None):
         """ Execute ``sql_string`` and return at most ``max_rows``.
+
+        If ``params`` is given, ``sql_string`` must be a single statement
+        with a ``%s`` placeholder for each of them.
         """
+        if params is not None:
+            return self._execute(sql_string, params, max_rows)
         self._use_TM and self._register()
+        self._queries += 1
+        # The client library may have reconnected without the session
+        # settings, e.g. the select limit, outside of transactions, too
+        self._check_session()
         desc = None
         rows = ()
 
         for qs in filter(None, [q.strip() for q in sql_string.split('\0')]):
-            qtype = qs.split(None, 1)[0].upper()
-            if qtype == 'SELECT' and max_rows:
-                qs = '%s LIMIT %d' % (qs, max_rows)
-            db_results = self._query(qs)
+            qtype = statement_type(qs)
+            if qtype not in read_only_types:
+                self._wrote = True
+            if qtype == 'SELECT':
+                self._set_select_limit(max_rows)
+            start = time.time()
+            # Do not buffer results in the client that may be too large
+            db_results = self._query(qs, unbuffered=bool(
+                self.max_result_bytes and qtype in read_only_types))
 
             if desc is not None and \
                db_results and \
@@ -584,9 +1972,12 @@ class DB(TM):
 
             if db_results:
                 desc = db_results.describe()
-                rows = db_results.fetch_row(max_rows)
+                rows, nbytes = self._fetch(db_results, max_rows, qs)
+                self._observe_query(qtype, time.time() - start,
+                                    len(rows), nbytes)
             else:
                 desc = None
+                self._observe_query(qtype, time.time() - start)
 
             if qtype == 'CALL':
                 # For stored procedures, skip the status result
@@ -595,14 +1986,364 @@ class DB(TM):
         if desc is None:
             return (), ()
 
-        items = []
-        for info in desc:
-            items.append({'name': info[0],
-                          'type': self.defs.get(info[1], 't'),
-                          'width': info[2],
-                          'null': info[6]})
+        return self._result_items(desc), rows
+
+    def _fetch(self, db_results, max_rows, statement):
+        """ Return at most ``max_rows`` rows of ``db_results`` and the
+            number of bytes of their string values, which is only counted
+            if ``max_result_bytes`` is set.
+        """
+        if not self.max_result_bytes:
+            # Measuring every value costs more than the counter is worth
+            return db_results.fetch_row(max_rows), 0
+        rows = []
+        nbytes = 0
+        for batch, batch_bytes in self._fetch_batches(db_results, max_rows,
+                                                      statement):
+            rows.extend(batch)
+            nbytes += batch_bytes
+        return tuple(rows), nbytes
+
+    def _fetch_batches(self, db_results, max_rows, statement):
+        """ Yield batches of at most ``fetch_batch_size`` rows of
+            ``db_results`` together with the number of bytes in them, or
+            0 if ``max_result_bytes`` is not set.
+
+            Raises ``ResultTooLarge`` as soon as more than
+            ``max_result_bytes`` were fetched in total. Unbuffered results
+            are read to their end in both cases, so that the connection
+            can run the next statement.
+        """
+        fetched = nbytes = 0
+        while True:
+            batch_size = self.fetch_batch_size
+            if max_rows:
+                batch_size = min(batch_size, max_rows - fetched)
+                if not batch_size:
+                    self._drain(db_results)
+                    return
+            rows = db_results.fetch_row(batch_size)
+            if not rows:
+                return
+            fetched += len(rows)
+            if not self.max_result_bytes:
+                yield rows, 0
+                continue
+            batch_bytes = result_bytes(rows)
+            nbytes += batch_bytes
+            if nbytes > self.max_result_bytes:
+                if len(statement) > 2000:
+                    statement = '%s... (truncated at 2000 chars)' % (
+                        statement[:2000])
+                msg = 'Result exceeded %d bytes after %d rows, query ' \
+                      'aborted:\n' % (self.max_result_bytes, fetched)
+                LOG.error(msg + statement)
+                self._drain(db_results)
+                raise ResultTooLarge('Result exceeded the limit of %d bytes.'
+                                     % self.max_result_bytes)
+            yield rows, batch_bytes
+
+    def _drain(self, db_results):
+        """ Read and drop the remaining rows of ``db_results``. The
+            server sends all rows of an unbuffered result, and no other
+            statement can run before the client read them.
+        """
+        try:
+            while db_results.fetch_row(self.fetch_batch_size):
+                pass
+        except _mysql.Error:
+            LOG.warning('Failed to read the rest of a result.', exc_info=True)
+
+    def _set_select_limit(self, max_rows):
+        """ Make the server return at most ``max_rows`` rows for SELECTs
+            without LIMIT clause, or all rows if ``max_rows`` is 0.
+
+            The limit is kept in the session, so it is only sent when it
+            changes. Unlike an appended LIMIT clause it is known to the
+            server when planning and respects existing LIMIT clauses.
+        """
+        limit = max_rows or None
+        if limit != self._select_limit:
+            self._query('SET SESSION sql_select_limit = %s' % (
+                int(limit) if limit else 'DEFAULT'))
+            self._select_limit = limit
+
+    def _result_items(self, desc):
+        """ Return the Zope column descriptions for a result description.
+
+            The descriptions are immutable and cached per connection, as
+            the same statements return the same description over and over.
+        """
+        items = self._items_cache.get(desc)
+        if items is None:
+            items = tuple(ColumnItem(name=info[0],
+                                     type=self.defs.get(info[1], 't'),
+                                     width=info[2],
+                                     null=info[6])
+                          for info in desc)
+            if len(self._items_cache) >= self.items_cache_size:
+                self._items_cache.clear()
+            self._items_cache[desc] = items
+        return items
+
+    def _execute(self, sql_string, params, max_rows):
+        """ Execute the single statement ``sql_string`` with its ``%s``
+            placeholders bound to ``params``.
+
+            The statement is prepared on the server once and kept in a
+            per-connection LRU cache, so executing it again only ships the
+            parameter values. Preparing costs an extra round trip the first
+            time a connection runs the statement, so this pays off for
+            statements run repeatedly. Statements the server cannot prepare
+            fall back to client-side escaping.
+        """
+        sql_string = sql_string.strip('\0').strip()
+        if '\0' in sql_string:
+            raise ProgrammingError('Parameters are only supported for '
+                                   'single statements.')
+        params = tuple(params)
+        placeholders = _placeholders.findall(sql_string).count('s')
+        if placeholders != len(params):
+            raise ProgrammingError('Statement expects %d parameters, %d given.'
+                                   % (placeholders, len(params)))
 
-        return items, rows
+        self._use_TM and self._register()
+        self._queries += 1
+        self._check_session()
+        qtype = statement_type(sql_string)
+        if qtype not in read_only_types:
+            self._wrote = True
+        if qtype == 'SELECT':
+            self._set_select_limit(max_rows)
+
+        encoding = getattr(self.db, 'encoding', None) or \
+            python_charset(self._kw_args.get('charset'))
+        literals = [self.db.literal(param) for param in params]
+        start = time.time()
+        try:
+            db_results = self._execute_prepared(sql_string, literals, encoding)
+        except (OperationalError, ProgrammingError) as exc:
+            if exc.args[0] != ER.UNKNOWN_STMT_HANDLER:
+                raise
+            # The connection was replaced while the statement was sent
+            self._prepared.clear()
+            db_results = self._execute_prepared(sql_string, literals, encoding)
+
+        if not db_results:
+            self._observe_query(qtype, time.time() - start)
+            return (), ()
+        desc = db_results.describe()
+        rows, nbytes = self._fetch(db_results, max_rows, sql_string)
+        self._observe_query(qtype, time.time() - start, len(rows), nbytes)
+        return self._result_items(desc), rows
+
+    def _execute_prepared(self, sql_string, literals, encoding):
+        name = self._prepare(sql_string, encoding)
+        if name is None:
+            statement = sql_string.encode(encoding)
+            return self._query(statement % tuple(literals))
+        if not literals:
+            return self._query(b'EXECUTE ' + name)
+
+        variables = [b'@zmysqlda_p%d' % i for i in range(len(literals))]
+        # The values must not stay readable by later statements, which may
+        # run for other requests on the pooled connection
+        clear = b'SET ' + b', '.join(variable + b' = NULL'
+                                     for variable in variables)
+        self._query(b'SET ' +
+                    b', '.join(variable + b' = ' + literal
+                               for variable, literal
+                               in zip(variables, literals)) +
+                    b'; EXECUTE ' + name + b' USING ' + b', '.join(variables) +
+                    b'; ' + clear)
+        try:
+            result = self._next_results((None, name), None)
+        except _mysql.Error as exc:
+            # The statements after a failing one do not run
+            try:
+                self._query(clear)
+            except _mysql.Error:
+                LOG.warning('Failed to clear the parameter values.',
+                            exc_info=True)
+            raise exc
+        self._next_results((name, clear), None)
+        return result
+
+    def _prepare(self, sql_string, encoding):
+        """ Return the name of the server-side prepared statement for
+            ``sql_string``, preparing it if needed, or None if the server
+            cannot prepare it. Statements containing a literal ``?``, which
+            the server would take for a placeholder, are not prepared.
+        """
+        if sql_string in self._prepared:
+            name = self._prepared.pop(sql_string)
+            self._prepared[sql_string] = name
+            return name
+
+        name = None
+        if '?' not in sql_string:
+            statement = _placeholders.sub(
+                lambda match: '?' if match.group(1) == 's' else '%',
+                sql_string)
+            self._statement_counter += 1
+            try:
+                candidate = b'zmysqlda_stmt_%d' % self._statement_counter
+                self._query(b'PREPARE ' + candidate + b' FROM ' +
+                            self.db.string_literal(
+                                statement.encode(encoding)))
+                name = candidate
+            except (OperationalError, ProgrammingError) as exc:
+                if exc.args[0] != ER.UNSUPPORTED_PS:
+                    raise
+
+        self._prepared[sql_string] = name
+        while len(self._prepared) > self.prepared_cache_size:
+            evicted = self._prepared.popitem(last=False)[1]
+            if evicted is not None:
+                self._query(b'DEALLOCATE PREPARE ' + evicted)
+        return name
+
+    @traced('query', with_sql=True)
+    def query_columns(self, sql_string, max_rows=1000, use_numpy=False):
+        """ Execute the single statement ``sql_string`` and return at most
+            ``max_rows`` as ``(items, columns)`` with one sequence per
+            result column instead of one tuple per row.
+
+            Numeric columns are returned as ``array.array``, or as NumPy
+            arrays if ``use_numpy`` is true and NumPy is installed. Rows are
+            fetched in batches, so the tuples of all rows never exist at
+            the same time.
+        """
+        sql_string = sql_string.strip('\0').strip()
+        if '\0' in sql_string:
+            raise ProgrammingError('Columnar results are only supported for '
+                                   'single statements.')
+        self._use_TM and self._register()
+        self._queries += 1
+        self._check_session()
+        qtype = statement_type(sql_string)
+        if qtype not in read_only_types:
+            self._wrote = True
+        if qtype == 'SELECT':
+            self._set_select_limit(max_rows)
+        start = time.time()
+        db_results = self._query(sql_string, unbuffered=bool(
+            self.max_result_bytes and qtype in read_only_types))
+        if not db_results:
+            self._observe_query(qtype, time.time() - start)
+            return (), ()
+
+        items = self._result_items(db_results.describe())
+        columns = Columns(items)
+        fetched = nbytes = 0
+        for rows, batch_bytes in self._fetch_batches(db_results, max_rows,
+                                                     sql_string):
+            columns.extend(rows)
+            fetched += len(rows)
+            nbytes += batch_bytes
+        self._observe_query(qtype, time.time() - start, fetched, nbytes)
+        return items, columns.finish(use_numpy)
+
+    @traced('query', with_sql=True)
+    def export(self, sql_string, out, format='csv', compress=False):
+        """ Write all rows of the read-only statement ``sql_string`` to
+            the file-like object ``out`` in ``format``, ``csv`` or
+            ``ndjson``, gzip-compressed if ``compress`` is true.
+
+            Rows are fetched in batches from an unbuffered result and
+            written out whenever ``export_buffer_size`` bytes were
+            collected, so memory use does not depend on the result size.
+            Returns the number of rows written.
+        """
+        output = Output(out, compress, self.export_buffer_size)
+        return sum(self._export_batches(sql_string, format, output))
+
+    def iter_export(self, sql_string, format='csv', compress=False):
+        """ Return an iterator over the chunks of at least
+            ``export_buffer_size`` bytes ``export`` would write.
+
+            The statement runs right away, its rows are fetched while the
+            iterator is read.
+        """
+        chunks = Chunks()
+        batches = self._export_batches(sql_string, format,
+                                       Output(chunks, compress,
+                                              self.export_buffer_size))
+        # Run the statement now to raise its errors to the caller
+        batches = itertools.chain([next(batches, 0)], batches)
+        return self._pop_chunks(batches, chunks)
+
+    def _pop_chunks(self, batches, chunks):
+        for _ in batches:
+            while chunks:
+                yield chunks.pop(0)
+
+    def _export_batches(self, sql_string, format, output):
+        """ Run the ``export`` of ``sql_string`` to ``output`` and yield
+            the number of rows written with every batch.
+        """
+        encoder_class = encoders.get(format)
+        if encoder_class is None:
+            raise ProgrammingError('Unknown export format %s.' % format)
+        sql_string = sql_string.strip('\0').strip()
+        qtype = statement_type(sql_string)
+        if '\0' in sql_string or qtype not in read_only_types:
+            raise ProgrammingError('Only single read-only statements can be '
+                                   'exported.')
+        self._use_TM and self._register()
+        self._queries += 1
+        self._check_session()
+        if qtype == 'SELECT':
+            self._set_select_limit(0)
+        start = time.time()
+        db_results = self._query(sql_string, unbuffered=True)
+        if not db_results:
+            self._observe_query(qtype, time.time() - start)
+            return
+
+        names = [item['name'] for item in
+                 self._result_items(db_results.describe())]
+        encoder = encoder_class(names, self._charset())
+        fetched = nbytes = 0
+        try:
+            output.write(encoder.header())
+            yield 0
+            while True:
+                rows = db_results.fetch_row(self.fetch_batch_size)
+                if not rows:
+                    break
+                output.write(encoder.encode(rows))
+                fetched += len(rows)
+                if self.max_result_bytes:
+                    nbytes += result_bytes(rows)
+                yield len(rows)
+            output.close()
+        except Exception:
+            # E.g. the client went away while writing
+            self._drain(db_results)
+            raise
+        self._observe_query(qtype, time.time() - start, fetched, nbytes)
+        yield 0
+
+    def stats(self, now=None):
+        """ Return a mapping of usage statistics for this connection.
+        """
+        if now is None:
+            now = time.time()
+        return {'created': self._created,
+                'age': now - self._created,
+                'last_used': self._last_used,
+                'idle': now - self._last_used,
+                'reconnects': self._reconnects,
+                'queries': self._queries,
+                'in_transaction': bool(self._registered),
+                'transaction_age': None if self._transaction_start is None
+                else now - self._transaction_start}
+
+    def _reset_counters(self):
+        """ Reset the reconnect and query counters.
+        """
+        self._reconnects = self._queries = 0
 
     def string_literal(self, sql_str):
         """ Called from zope to quote/escape strings for inclusion
@@ -644,6 +2385,7 @@ class DB(TM):
                 self._registered = True
                 self._finalize = False
 
+    @traced('begin')
     def _begin(self, *ignored):
         """ Begin a transaction, if transactions are enabled.
 
@@ -651,15 +2393,66 @@ class DB(TM):
         """
         try:
             self._transaction_begun = True
+            self._wrote = False
             self.db.ping()
+            self._check_session()
+            # One round trip for all statements
+            statements = []
             if self._transactions:
-                self._query('BEGIN')
+                if self._transaction_isolation:
+                    # Only applies to the next transaction
+                    statements.append('SET TRANSACTION ISOLATION LEVEL %s'
+                                      % self._transaction_isolation)
+                if self.xa_transactions:
+                    self._xid = "'%s','%s',%d" % (uuid.uuid4().hex,
+                                                  self._xa_branch,
+                                                  XA_FORMAT_ID)
+                    statements.append('XA START %s' % self._xid)
+                    self._xa_state = 'ACTIVE'
+                else:
+                    statements.append('BEGIN')
             if self._mysql_lock:
-                self._query("SELECT GET_LOCK('%s',0)" % self._mysql_lock)
+                statements.append("SELECT GET_LOCK('%s',%d)" % (
+                    self._mysql_lock, self.lock_wait_timeout))
+            start = time.time()
+            result = statements and self._query_batch(statements)
+            if statements:
+                # Track the time the server holds the transaction open
+                self._transaction_start = start
+                self._transaction_busy = time.time() - start
+                self._transaction_statements = []
+                self._transaction_skipped = 0
+            if self._transactions:
+                self._metrics.transactions['begun'] += 1
+            if self._mysql_lock:
+                self._check_lock(result, time.time() - start)
+        except ConflictError:
+            raise
         except Exception:
             LOG.error('exception during _begin', exc_info=True)
             raise ConflictError
-
+        finally:
+            self._transaction_isolation = None
+
+    @traced('vote')
+    def tpc_vote(self, *ignored):
+        """ End the XA transaction and prepare it for the commit, so that
+            the server can still commit it if the connection gets lost.
+            Transactions that did not write are committed in one phase
+            instead, without preparing them.
+        """
+        TM.tpc_vote(self, *ignored)
+        if self._xa_state != 'ACTIVE':
+            return
+        # The state must follow every statement, an abort after a failed
+        # prepare may not end the transaction again
+        self._query('XA END %s' % self._xid)
+        self._xa_state = 'IDLE'
+        if self._wrote:
+            self._query('XA PREPARE %s' % self._xid)
+            self._xa_state = 'PREPARED'
+
+    @traced('commit')
     def _finish(self, *ignored):
         """ Commit a transaction, if transactions are enabled and the
         Zope transaction has committed successfully.
@@ -667,15 +2460,16 @@ class DB(TM):
         if not self._transaction_begun:
             return
         self._transaction_begun = False
+        self._wrote = False
         try:
-            if self._mysql_lock:
-                self._query("SELECT RELEASE_LOCK('%s')" % self._mysql_lock)
+            self._end_transaction('COMMIT')
             if self._transactions:
-                self._query('COMMIT')
+                self._metrics.transactions['committed'] += 1
         except Exception:
             LOG.error('exception during _finish', exc_info=True)
             raise ConflictError
 
+    @traced('abort')
     def _abort(self, *ignored):
         """ Roll back the database transaction if the Zope transaction
         has been aborted, usually due to a transaction error.
@@ -683,13 +2477,117 @@ class DB(TM):
         if not self._transaction_begun:
             return
         self._transaction_begun = False
-        if self._mysql_lock:
-            self._query("SELECT RELEASE_LOCK('%s')" % self._mysql_lock)
+        self._wrote = False
+        self._end_transaction('ROLLBACK')
         if self._transactions:
-            self._query('ROLLBACK')
+            self._metrics.transactions['aborted'] += 1
         else:
             LOG.error('aborting when non-transactional')
 
+    def _check_lock(self, result, duration):
+        """ Raise a ``ConflictError``, so that Zope retries the request,
+            if the ``GET_LOCK`` statement with the ``result`` did not get
+            the MySQL lock.
+        """
+        rows = result.fetch_row(1) if result else ()
+        acquired = bool(rows) and rows[0][0] == 1
+        self._metrics.observe_lock(self._mysql_lock, duration, acquired)
+        if not acquired:
+            raise ConflictError('MySQL lock %s not acquired within %d '
+                                'seconds.' % (self._mysql_lock,
+                                              self.lock_wait_timeout))
+
+    def _end_transaction(self, statement):
+        """ Release the MySQL lock and end the transaction with
+            ``statement``, ``COMMIT`` or ``ROLLBACK``, in one round trip.
+        """
+        statements = []
+        if self._mysql_lock and self._xid is None:
+            statements.append("SELECT RELEASE_LOCK('%s')" % self._mysql_lock)
+        if self._xid is not None:
+            statements.extend(self._xa_end_statements(statement))
+            if self._mysql_lock:
+                # Nothing else may run before the XA transaction ended
+                statements.append("SELECT RELEASE_LOCK('%s')"
+                                  % self._mysql_lock)
+        elif self._transactions:
+            statements.append(statement)
+        start = self._transaction_start
+        self._transaction_start = None
+        end = time.time()
+        try:
+            if statements:
+                self._query_batch(statements)
+        finally:
+            if start is not None:
+                now = time.time()
+                self._transaction_ended(now - start,
+                                        self._transaction_busy + now - end)
+
+    def _xa_end_statements(self, statement):
+        """ Return the statements ending the XA transaction in its
+            current state with ``statement``, ``COMMIT`` or ``ROLLBACK``.
+        """
+        xid, state = self._xid, self._xa_state
+        self._xid = self._xa_state = None
+        statements = []
+        if state == 'ACTIVE':
+            statements.append('XA END %s' % xid)
+        if statement == 'ROLLBACK':
+            statements.append('XA ROLLBACK %s' % xid)
+        elif state == 'PREPARED':
+            statements.append('XA COMMIT %s' % xid)
+        else:
+            statements.append('XA COMMIT %s ONE PHASE' % xid)
+        return statements
+
+    def xa_recover(self):
+        """ Log the prepared XA transactions of this DA still open on
+            the server, e.g. after a crash between the vote and the commit
+            of a Zope transaction, and return their XIDs.
+
+            They are left to an operator: the ZODB may have committed the
+            Zope transaction before the crash, and other processes of the
+            Zope instance may be committing them right now.
+        """
+        result = self._query('XA RECOVER')
+        xids = []
+        for format_id, gtrid_length, bqual_length, data in \
+                (result.fetch_row(0) if result else ()):
+            if isinstance(data, six.binary_type):
+                data = data.decode('latin-1')
+            gtrid = data[:gtrid_length]
+            bqual = data[gtrid_length:gtrid_length + bqual_length]
+            if int(format_id) != XA_FORMAT_ID or bqual != self._xa_branch:
+                continue
+            xid = "'%s','%s',%d" % (gtrid, bqual, XA_FORMAT_ID)
+            LOG.warning('In-doubt XA transaction %s is prepared on the '
+                        'server. Unless a running Zope process commits it, '
+                        'end it with XA COMMIT if its ZODB transaction '
+                        'committed, with XA ROLLBACK otherwise.' % xid)
+            xids.append(xid)
+        return xids
+
+    def _transaction_ended(self, duration, busy):
+        """ Record a transaction that was open for ``duration`` seconds
+            and spent ``busy`` seconds of them on statements. Transactions
+            longer than ``slow_transaction_threshold`` are logged with
+            their statements.
+        """
+        idle = max(duration - busy, 0.0)
+        slow = bool(self.slow_transaction_threshold) and \
+            duration > self.slow_transaction_threshold
+        self._metrics.observe_transaction(duration, idle, slow)
+        if slow:
+            statements = self._transaction_statements
+            if self._transaction_skipped:
+                statements = statements + ['... %d more statements' %
+                                           self._transaction_skipped]
+            LOG.warning('Transaction open for %.3f seconds, %.3f seconds '
+                        'idle between statements:\n%s' % (
+                            duration, idle, '\n'.join(statements)))
+        self._transaction_statements = []
+
     def _mysql_version(self):
         """ Return mysql server version.
         """
@@ -697,6 +2595,7 @@ class DB(TM):
             self._version = self.variables().get('version')
         return self._version
 
+    @traced('savepoint')
     def savepoint(self):
         """ Basic savepoint support.
         """
@@ -716,5 +2615,10 @@ class _SavePoint(object):
         self.ident = str(time.time()).replace('.', 'sp')
         db_conn._query('SAVEPOINT %s' % self.ident)
 
+    @property
+    def _path(self):
+        return getattr(self.db_conn, '_path', None)
+
+    @traced('savepoint_rollback')
     def rollback(self):
         self.db_conn._query('ROLLBACK TO %s' % self.ident)
@@ -0,0 +1,171 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Incremental encoders for exporting query results
+"""
+import csv
+import json
+import zlib
+
+import six
+
+
+class Encoder(object):
+    """ Base class of the export encoders.
+
+        An encoder turns batches of result rows into UTF-8 encoded bytes.
+        String values fetched as bytes are decoded with ``encoding``, the
+        Python codec of the connection character set.
+    """
+
+    content_type = 'application/octet-stream'
+
+    def __init__(self, names, encoding):
+        self.names = names
+        self.encoding = encoding
+
+    def _text(self, value):
+        if isinstance(value, six.binary_type):
+            return value.decode(self.encoding, 'replace')
+        return value
+
+    def header(self):
+        """ Return the bytes written before the first row.
+        """
+        return b''
+
+    def encode(self, rows):
+        """ Return the bytes for a batch of ``rows``.
+        """
+        raise NotImplementedError
+
+
+class CSVEncoder(Encoder):
+    """ Comma-separated values with a header line of column names.
+        NULL is written as an empty field.
+    """
+
+    content_type = 'text/csv; charset=utf-8'
+
+    def __init__(self, names, encoding):
+        super(CSVEncoder, self).__init__(names, encoding)
+        self._buffer = six.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\r\n')
+
+    def _value(self, value):
+        if value is None:
+            return ''
+        value = self._text(value)
+        if six.PY2 and isinstance(value, six.text_type):
+            # The Python 2 csv module only handles byte strings
+            value = value.encode('UTF-8')
+        return value
+
+    def _encode(self, rows):
+        self._writer.writerows([[self._value(value) for value in row]
+                                for row in rows])
+        data = self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        if isinstance(data, six.text_type):
+            data = data.encode('UTF-8')
+        return data
+
+    def header(self):
+        return self._encode([self.names])
+
+    def encode(self, rows):
+        return self._encode(rows)
+
+
+class NDJSONEncoder(Encoder):
+    """ One JSON object per line, mapping the column names to the values.
+        Values without JSON representation, like dates, are written as
+        strings.
+    """
+
+    content_type = 'application/x-ndjson'
+
+    def _default(self, value):
+        value = self._text(value)
+        if isinstance(value, six.text_type):
+            return value
+        return str(value)
+
+    def encode(self, rows):
+        lines = []
+        for row in rows:
+            line = json.dumps(dict(zip(self.names,
+                                       [self._text(value) for value in row])),
+                              default=self._default, ensure_ascii=False,
+                              sort_keys=True)
+            if isinstance(line, six.text_type):
+                line = line.encode('UTF-8')
+            lines.append(line + b'\n')
+        return b''.join(lines)
+
+
+class Chunks(list):
+    """ A file-like list collecting the chunks written by an ``Output``.
+    """
+
+    def write(self, data):
+        self.append(data)
+
+
+encoders = {'csv': CSVEncoder,
+            'ndjson': NDJSONEncoder}
+
+
+class Output(object):
+    """ Collects encoded data and writes it to ``out`` in chunks of at
+        least ``buffer_size`` bytes, optionally compressed with gzip.
+        Objects with a ``flush`` method are flushed after every chunk.
+    """
+
+    def __init__(self, out, compress=False, buffer_size=65536):
+        self.out = out
+        self.buffer_size = buffer_size
+        self.bytes_written = 0
+        self._chunks = []
+        self._size = 0
+        self._compressor = None
+        if compress:
+            # wbits 16 + MAX_WBITS writes a gzip header and trailer
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                                16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._chunks:
+            data = b''.join(self._chunks)
+            self._chunks = []
+            self._size = 0
+            self.out.write(data)
+            self.bytes_written += len(data)
+        flush = getattr(self.out, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def close(self):
+        if self._compressor is not None:
+            self._chunks.append(self._compressor.flush())
+            self._compressor = None
+        self.flush()
@@ -0,0 +1,291 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Performance counters and their OpenMetrics text exposition
+
+Every pooled ``DB`` instance owns a ``ConnectionMetrics`` object that only
+its own thread writes to, so the counters are sharded per thread and need
+no locking on the query path. Readers merge the shards when rendering.
+"""
+from bisect import bisect_left
+
+import six
+
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# Upper bounds in seconds for the query latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds in seconds for the transaction duration histogram buckets
+TRANSACTION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                       30.0, 60.0, 300.0)
+
+TRANSACTION_STATES = ('begun', 'committed', 'aborted')
+
+sized_types = (six.binary_type, six.text_type)
+
+
+def result_bytes(rows):
+    """ Return the total length of all string values in ``rows``.
+    """
+    return sum(len(value) for row in rows for value in row
+               if isinstance(value, sized_types))
+
+
+class Histogram(object):
+    """ Cumulative-on-render histogram of observed values
+    """
+
+    buckets = LATENCY_BUCKETS
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(list(other.counts)):
+            self.counts[i] += count
+        self.sum += other.sum
+
+
+class TransactionHistogram(Histogram):
+    """ Histogram with buckets for the time transactions are open
+    """
+
+    buckets = TRANSACTION_BUCKETS
+
+
+class ConnectionMetrics(object):
+    """ Counters for a single database connection
+    """
+
+    def __init__(self):
+        self.queries = {}
+        self.reconnects = 0
+        self.transactions = dict.fromkeys(TRANSACTION_STATES, 0)
+        self.rows = 0
+        self.bytes = 0
+        self.lock_waits = {}
+        self.lock_failures = {}
+        self.conflicts = {}
+        self.transaction_durations = TransactionHistogram()
+        self.transaction_idle = TransactionHistogram()
+        self.slow_transactions = 0
+
+    def observe_query(self, qtype, duration, rows=0, nbytes=0):
+        """ Record one statement of type ``qtype``.
+        """
+        histogram = self.queries.get(qtype)
+        if histogram is None:
+            histogram = self.queries[qtype] = Histogram()
+        histogram.observe(duration)
+        self.rows += rows
+        self.bytes += nbytes
+
+    def observe_lock(self, name, duration, acquired):
+        """ Record an attempt to get the MySQL lock ``name``.
+        """
+        histogram = self.lock_waits.get(name)
+        if histogram is None:
+            histogram = self.lock_waits[name] = Histogram()
+        histogram.observe(duration)
+        if not acquired:
+            self.lock_failures[name] = self.lock_failures.get(name, 0) + 1
+
+    def observe_conflict(self, code):
+        """ Record a database error with the ``code`` that was raised as
+            ``ConflictError``.
+        """
+        self.conflicts[code] = self.conflicts.get(code, 0) + 1
+
+    def observe_transaction(self, duration, idle, slow=False):
+        """ Record a transaction that was open for ``duration`` seconds,
+            ``idle`` of them between statements.
+        """
+        self.transaction_durations.observe(duration)
+        self.transaction_idle.observe(idle)
+        if slow:
+            self.slow_transactions += 1
+
+    def merge(self, other):
+        """ Add the counters of ``other`` to this instance.
+        """
+        for qtype, histogram in list(other.queries.items()):
+            mine = self.queries.get(qtype)
+            if mine is None:
+                mine = self.queries[qtype] = Histogram()
+            mine.merge(histogram)
+        self.reconnects += other.reconnects
+        for state, count in list(other.transactions.items()):
+            self.transactions[state] += count
+        self.rows += other.rows
+        self.bytes += other.bytes
+        for name, histogram in list(other.lock_waits.items()):
+            mine = self.lock_waits.get(name)
+            if mine is None:
+                mine = self.lock_waits[name] = Histogram()
+            mine.merge(histogram)
+        for name, count in list(other.lock_failures.items()):
+            self.lock_failures[name] = self.lock_failures.get(name, 0) + count
+        for code, count in list(other.conflicts.items()):
+            self.conflicts[code] = self.conflicts.get(code, 0) + count
+        self.transaction_durations.merge(other.transaction_durations)
+        self.transaction_idle.merge(other.transaction_idle)
+        self.slow_transactions += other.slow_transactions
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (key, _escape(str(value)))
+                    for key, value in sorted(labels.items()))
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render(entries):
+    """ Render OpenMetrics text for ``entries``, a sequence of
+        ``(da_path, pool_size, ConnectionMetrics)`` tuples.
+    """
+    lines = []
+    add = lines.append
+
+    add('# TYPE zmysqlda_query_duration_seconds histogram')
+    add('# HELP zmysqlda_query_duration_seconds '
+        'Query latency by statement type.')
+    add('# UNIT zmysqlda_query_duration_seconds seconds')
+    for path, size, metrics in entries:
+        for qtype, histogram in sorted(metrics.queries.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',),
+                                    histogram.counts):
+                cumulative += count
+                add('zmysqlda_query_duration_seconds_bucket{%s} %d' % (
+                    _labels(da=path, qtype=qtype, le=bound), cumulative))
+            labels = _labels(da=path, qtype=qtype)
+            add('zmysqlda_query_duration_seconds_count{%s} %d' % (
+                labels, cumulative))
+            add('zmysqlda_query_duration_seconds_sum{%s} %s' % (
+                labels, _number(histogram.sum)))
+
+    add('# TYPE zmysqlda_reconnects counter')
+    add('# HELP zmysqlda_reconnects Reconnects forced by a lost connection.')
+    for path, size, metrics in entries:
+        add('zmysqlda_reconnects_total{%s} %d' % (_labels(da=path),
+                                                  metrics.reconnects))
+
+    add('# TYPE zmysqlda_transactions counter')
+    add('# HELP zmysqlda_transactions Database transactions by outcome.')
+    for path, size, metrics in entries:
+        for state in TRANSACTION_STATES:
+            add('zmysqlda_transactions_total{%s} %d' % (
+                _labels(da=path, state=state), metrics.transactions[state]))
+
+    for name, attr, description in (
+            ('zmysqlda_transaction_duration_seconds', 'transaction_durations',
+             'Time from BEGIN to COMMIT or ROLLBACK.'),
+            ('zmysqlda_transaction_idle_seconds', 'transaction_idle',
+             'Time transactions were open without running a statement.')):
+        add('# TYPE %s histogram' % name)
+        add('# HELP %s %s' % (name, description))
+        add('# UNIT %s seconds' % name)
+        for path, size, metrics in entries:
+            histogram = getattr(metrics, attr)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',),
+                                    histogram.counts):
+                cumulative += count
+                add('%s_bucket{%s} %d' % (name, _labels(da=path, le=bound),
+                                          cumulative))
+            labels = _labels(da=path)
+            add('%s_count{%s} %d' % (name, labels, cumulative))
+            add('%s_sum{%s} %s' % (name, labels, _number(histogram.sum)))
+
+    add('# TYPE zmysqlda_slow_transactions counter')
+    add('# HELP zmysqlda_slow_transactions '
+        'Transactions open longer than the slow transaction threshold.')
+    for path, size, metrics in entries:
+        add('zmysqlda_slow_transactions_total{%s} %d' % (
+            _labels(da=path), metrics.slow_transactions))
+
+    add('# TYPE zmysqlda_rows_fetched counter')
+    add('# HELP zmysqlda_rows_fetched Result rows fetched from the server.')
+    for path, size, metrics in entries:
+        add('zmysqlda_rows_fetched_total{%s} %d' % (_labels(da=path),
+                                                    metrics.rows))
+
+    add('# TYPE zmysqlda_fetched_bytes counter')
+    add('# HELP zmysqlda_fetched_bytes Bytes of string values fetched, '
+        'counted if max_result_bytes is set.')
+    add('# UNIT zmysqlda_fetched_bytes bytes')
+    for path, size, metrics in entries:
+        add('zmysqlda_fetched_bytes_total{%s} %d' % (_labels(da=path),
+                                                     metrics.bytes))
+
+    add('# TYPE zmysqlda_lock_wait_seconds histogram')
+    add('# HELP zmysqlda_lock_wait_seconds '
+        'Time spent getting the MySQL lock at transaction begin.')
+    add('# UNIT zmysqlda_lock_wait_seconds seconds')
+    for path, size, metrics in entries:
+        for name, histogram in sorted(metrics.lock_waits.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',),
+                                    histogram.counts):
+                cumulative += count
+                add('zmysqlda_lock_wait_seconds_bucket{%s} %d' % (
+                    _labels(da=path, lock=name, le=bound), cumulative))
+            labels = _labels(da=path, lock=name)
+            add('zmysqlda_lock_wait_seconds_count{%s} %d' % (
+                labels, cumulative))
+            add('zmysqlda_lock_wait_seconds_sum{%s} %s' % (
+                labels, _number(histogram.sum)))
+
+    add('# TYPE zmysqlda_lock_failures counter')
+    add('# HELP zmysqlda_lock_failures '
+        'MySQL locks not acquired within the lock wait timeout.')
+    for path, size, metrics in entries:
+        for name in sorted(metrics.lock_waits):
+            add('zmysqlda_lock_failures_total{%s} %d' % (
+                _labels(da=path, lock=name),
+                metrics.lock_failures.get(name, 0)))
+
+    add('# TYPE zmysqlda_conflict_errors counter')
+    add('# HELP zmysqlda_conflict_errors '
+        'Database errors raised as ConflictError to retry the request.')
+    for path, size, metrics in entries:
+        for code, count in sorted(metrics.conflicts.items()):
+            add('zmysqlda_conflict_errors_total{%s} %d' % (
+                _labels(da=path, code=code), count))
+
+    add('# TYPE zmysqlda_pool_connections gauge')
+    add('# HELP zmysqlda_pool_connections Pooled per-thread connections.')
+    for path, size, metrics in entries:
+        add('zmysqlda_pool_connections{%s} %d' % (_labels(da=path), size))
+
+    add('# EOF')
+    return '\n'.join(lines) + '\n'
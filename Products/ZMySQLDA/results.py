@@ -0,0 +1,199 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Alternative representations of query results
+"""
+from array import array
+from collections import OrderedDict
+
+import six
+from six.moves import zip
+from six.moves._thread import allocate_lock
+
+from Shared.DC.ZRDB.Results import Results
+
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional
+    numpy = None
+
+
+def _supported(typecode):
+    try:
+        array(typecode)
+    except ValueError:  # 'q' needs Python 3
+        return None
+    return typecode
+
+
+# array typecodes for the Zope column types of ``DB.defs``
+column_typecodes = {'i': 'l', 'l': _supported('q'), 'n': 'd'}
+
+
+class Columns(object):
+    """ Collects result rows as one sequence per column.
+
+        Numeric columns are stored in an ``array.array``, which holds
+        unboxed values. A numeric column that contains NULL or values out
+        of range for the array turns into a list, as do all other columns.
+    """
+
+    def __init__(self, items):
+        self.columns = []
+        for item in items:
+            typecode = column_typecodes.get(item['type'])
+            self.columns.append(array(typecode) if typecode else [])
+
+    def extend(self, rows):
+        """ Append a batch of ``rows``.
+        """
+        for i, values in enumerate(zip(*rows)):
+            column = self.columns[i]
+            if isinstance(column, array):
+                size = len(column)
+                try:
+                    column.extend(values)
+                    continue
+                except (TypeError, OverflowError):
+                    del column[size:]
+                    column = self.columns[i] = column.tolist()
+            column.extend(values)
+
+    def finish(self, use_numpy=False):
+        """ Return the list of columns. Arrays are turned into NumPy arrays
+            without copying if ``use_numpy`` is true and NumPy is installed.
+        """
+        if not use_numpy or numpy is None:
+            return self.columns
+        return [numpy.frombuffer(column, dtype=column.typecode)
+                if isinstance(column, array) else column
+                for column in self.columns]
+
+
+class Row(object):
+    """ Base class of the compact result records.
+
+        A record only holds a reference to the row tuple fetched from the
+        database. The column names, their index and the converters are
+        shared by all records of a result schema.
+    """
+
+    __slots__ = ('_values',)
+    __allow_access_to_unprotected_subobjects__ = 1
+
+    _names = ()
+    _index = {}
+    _converters = None
+
+    def __init__(self, values):
+        self._values = values
+
+    def _get(self, i):
+        value = self._values[i]
+        if self._converters is not None and value is not None:
+            converter = self._converters[i]
+            if converter is not None:
+                value = converter(value)
+        return value
+
+    def __getattr__(self, name):
+        try:
+            return self._get(self._index[name])
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        if isinstance(key, six.string_types):
+            return self._get(self._index[key])
+        return self._get(key)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        for i in range(len(self._names)):
+            yield self._get(i)
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, tuple(self))
+
+
+_row_classes = OrderedDict()
+_row_classes_lock = allocate_lock()
+
+# Most row classes kept for reuse
+row_classes_size = 256
+
+
+def row_class(names, converters=None):
+    """ Return the record class for the column ``names``, where
+        ``converters`` optionally maps column names to functions applied
+        to non-NULL values when they are accessed.
+    """
+    if converters:
+        converters = tuple(converters.get(name) for name in names)
+    else:
+        converters = None
+    key = (names, converters)
+    _row_classes_lock.acquire()
+    try:
+        cls = _row_classes.pop(key, None)
+        if cls is None:
+            index = {}
+            for i, name in enumerate(names):
+                index.setdefault(name.lower(), i)
+                index.setdefault(name.upper(), i)
+            index.update((name, i) for i, name in enumerate(names))
+            cls = type('Row', (Row,), {'__slots__': (),
+                                       '_names': names,
+                                       '_index': index,
+                                       '_converters': converters})
+        _row_classes[key] = cls
+        while len(_row_classes) > row_classes_size:
+            _row_classes.popitem(last=False)
+    finally:
+        _row_classes_lock.release()
+    return cls
+
+
+class CompactResults(Results):
+    """ Query results with compact, slot-based records.
+
+        Compatible with the results of ZSQL methods for attribute and item
+        access to the columns, but the records do not copy the row values
+        and do not take part in acquisition. Column values can be
+        converted lazily on access by passing ``converters``.
+    """
+
+    def __init__(self, items_data, parent=None, converters=None):
+        items, data = items_data
+        self._data = data
+        self.__items__ = items
+        self._parent = parent
+        self._names = []
+        self._schema = {}
+        self._data_dictionary = {}
+        for i, item in enumerate(items):
+            name = item['name'].strip()
+            if not name:
+                raise ValueError('Empty column name, %s' % name)
+            if name in self._schema:
+                raise ValueError('Duplicate column name, %s' % name)
+            self._schema[name] = i
+            self._data_dictionary[name] = item
+            self._names.append(name)
+        self._nv = len(self._names)
+        self._class = row_class(tuple(self._names), converters)
+
+    def __getitem__(self, index):
+        return self._class(self._data[index])
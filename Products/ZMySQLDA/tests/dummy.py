@@ -38,12 +38,22 @@ class FakeColumns(object):
 
 class FakeResults:
 
-    def __init__(self, results, **kw):
+    def __init__(self, results, description=(), **kw):
         self.results = results
+        self.description = description
         self.next_index = 0
 
+    def describe(self):
+        return self.description
+
     def fetch_row(self, count):
-        return self.results
+        start = self.next_index
+        if count:
+            rows = self.results[start:start + count]
+        else:
+            rows = self.results[start:]
+        self.next_index += len(rows)
+        return rows
 
 
 class FakeConnection:
@@ -52,6 +62,7 @@ class FakeConnection:
         self.server_capabilities = 0
         self.last_results = None
         self.last_query = None
+        self.queries = []
         self.string_literal_called = False
         self.unicode_literal_called = False
 
@@ -61,10 +72,17 @@ class FakeConnection:
     def ping(self, *args):
         pass
 
+    def thread_id(self):
+        return 42
+
     def query(self, sql):
         self.last_query = sql
+        self.queries.append(sql)
         sql = sql.lower()
-        self.last_results = FakeResults(RESULTS.get(sql, []))
+        if isinstance(sql, str) and 'get_lock(' in sql:
+            self.last_results = FakeResults([(1,)])
+        else:
+            self.last_results = FakeResults(RESULTS.get(sql, []))
         return self.last_results
 
     _query = query
@@ -72,9 +90,19 @@ class FakeConnection:
     def store_result(self):
         return self.last_results
 
+    def use_result(self):
+        self.unbuffered = True
+        return self.last_results
+
+    def next_result(self):
+        return -1
+
     def close(self):
         pass
 
+    def literal(self, value):
+        return ("'%s'" % value).encode('UTF-8')
+
     def string_literal(self, txt):
         self.string_literal_called = txt
         return txt
@@ -52,6 +52,34 @@ class ConnectionTests(unittest.TestCase):
         self.assertTrue(conn.auto_create_db)
         self.assertEqual(conn.timeout, 3)
 
+    def test_raw_sql_permission(self):
+        from AccessControl.Permissions import test_database_connections
+        klass = self._getTargetClass()
+        # Methods taking SQL or table and column names need the permission
+        # for running statements in the Test tab, not just for ZSQL methods
+        for name in ('query_many', 'query_in', 'paginate', 'stream_blob',
+                     'export'):
+            roles = getattr(klass, '%s__roles__' % name)
+            self.assertEqual(roles.__name__, test_database_connections)
+
+    def test_byte_range(self):
+        from Products.ZMySQLDA.DA import _byte_range
+        self.assertIsNone(_byte_range(None, 10))
+        self.assertEqual(_byte_range('bytes=0-4', 10), (0, 4))
+        self.assertEqual(_byte_range('bytes=5-', 10), (5, 9))
+        self.assertEqual(_byte_range('bytes=5-100', 10), (5, 9))
+        self.assertEqual(_byte_range('bytes=-3', 10), (7, 9))
+        self.assertEqual(_byte_range('bytes=-30', 10), (0, 9))
+        self.assertFalse(_byte_range('bytes=10-', 10))
+        self.assertFalse(_byte_range('bytes=-0', 10))
+        self.assertFalse(_byte_range('bytes=-5', 0))
+        # Unusable headers send the whole value
+        self.assertIsNone(_byte_range('bytes=0-1,4-5', 10))
+        self.assertIsNone(_byte_range('items=0-4', 10))
+        self.assertIsNone(_byte_range('bytes=4-1', 10))
+        self.assertIsNone(_byte_range('bytes=a-b', 10))
+        self.assertIsNone(_byte_range('bytes=-', 10))
+
     def test_factory(self):
         from Products.ZMySQLDA.db import DB
         conn = self._simpleMakeOne()
@@ -80,10 +108,25 @@ class ConnectionTests(unittest.TestCase):
         self.assertIsNone(conn.charset)
         self.assertFalse(conn.connected())
         self.assertEqual(conn.timeout, 3)
+        self.assertFalse(conn.coalesce_selects)
+        self.assertEqual(conn.max_result_bytes, 0)
+        self.assertEqual(conn.session_statements, ())
+        self.assertIsNone(conn.isolation_level)
+        self.assertEqual(conn.lock_wait_timeout, 0)
+        self.assertEqual(conn.conflict_error_codes, ())
+        self.assertEqual(conn.slow_transaction_threshold, 0)
+        self.assertFalse(conn.xa_transactions)
 
         conn.manage_edit('Another Title', 'another_conn_string', check=True,
                          use_unicode=None, auto_create_db=None, charset='utf8',
-                         timeout=20)
+                         timeout=20, coalesce_selects=True,
+                         max_result_bytes='1048576',
+                         session_statements=['SET a = 1;', ''],
+                         isolation_level='read committed',
+                         lock_wait_timeout='3',
+                         conflict_error_codes='1180, 1412',
+                         slow_transaction_threshold='2.5',
+                         xa_transactions=True)
         self.assertEqual(conn.title, 'Another Title')
         self.assertEqual(conn.connection_string, 'another_conn_string')
         self.assertFalse(conn.use_unicode)
@@ -91,6 +134,14 @@ class ConnectionTests(unittest.TestCase):
         self.assertFalse(conn.auto_create_db)
         self.assertTrue(conn.connected())
         self.assertEqual(conn.timeout, 20)
+        self.assertTrue(conn.coalesce_selects)
+        self.assertEqual(conn.max_result_bytes, 1048576)
+        self.assertEqual(conn.session_statements, ('SET a = 1',))
+        self.assertEqual(conn.isolation_level, 'READ COMMITTED')
+        self.assertEqual(conn.lock_wait_timeout, 3)
+        self.assertEqual(conn.conflict_error_codes, (1180, 1412))
+        self.assertEqual(conn.slow_transaction_threshold, 2.5)
+        self.assertTrue(conn.xa_transactions)
 
         Connection.connect = old_connect
 
@@ -159,6 +210,87 @@ class PatchedConnectionTests(PatchedConnectionTestsBase):
         self.assertEqual(vals[0].__name__, 'table1')
         self.assertEqual(vals[0].icon, 'table')
 
+    def test_pool_statistics(self):
+        import json
+        self.conn = self._simpleMakeOne()
+        self.assertEqual(self.conn.pool_statistics(),
+                         {'connected': False, 'size': 0,
+                          'coalesced_queries': 0, 'connections': []})
+
+        self.conn.tpValues()
+        stats = self.conn.pool_statistics()
+        self.assertTrue(stats['connected'])
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['connections'][0]['thread_id'], get_ident())
+        from_json = json.loads(self.conn.manage_poolJSON())
+        self.assertEqual(from_json['size'], 1)
+        self.assertEqual(from_json['connections'][0]['thread_id'],
+                         get_ident())
+
+    def test_pool_actions(self):
+        self.conn = self._simpleMakeOne()
+        self.assertEqual(self.conn.manage_drainPool(), 0)
+
+        self.conn.tpValues()
+        pool = self.conn._v_database_connection
+        self.conn.manage_reconnectPool()
+        self.assertEqual(pool._generation, 1)
+        self.conn.manage_resetPoolCounters()
+        self.assertEqual(self.conn.manage_drainPool(), 1)
+        self.assertEqual(self.conn.pool_statistics()['size'], 0)
+
+    def test_manage_metrics(self):
+        self.conn = self._simpleMakeOne()
+        self.assertNotIn('zmysqlda_pool_connections{',
+                         self.conn.manage_metrics())
+
+        self.conn.tpValues()
+        text = self.conn.manage_metrics()
+        self.assertIn('zmysqlda_pool_connections{da="conn_id"} 1', text)
+        self.assertIn('zmysqlda_pool_connections{da="conn_id"} 1',
+                      self.conn.manage_metrics(process=True))
+
+    def test_connect_settings_changed(self):
+        self.conn = self._simpleMakeOne()
+        self.conn.connect(self.conn.connection_string)
+        pool = self.conn._v_database_connection
+        self.assertFalse(pool.coalesce_selects)
+
+        # Same settings reuse the pool, changed settings replace it
+        self.conn.connect(self.conn.connection_string)
+        self.assertIs(self.conn._v_database_connection, pool)
+        self.conn.coalesce_selects = True
+        self.conn.connect(self.conn.connection_string)
+        self.assertIsNot(self.conn._v_database_connection, pool)
+        self.assertTrue(self.conn._v_database_connection.coalesce_selects)
+
+    def test_query_many(self):
+        self.conn = self._simpleMakeOne()
+        results = self.conn.query_many(['SHOW VARIABLES', 'SELECT 1'])
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(results[0]), 2)
+        self.assertEqual(len(results[1]), 0)
+        self.conn._v_database_connection.close()
+
+    def test_query_in(self):
+        self.conn = self._simpleMakeOne()
+        self.conn.connect(self.conn.connection_string)
+        results = self.conn.query_in('SHOW VARIABLES WHERE a IN %s', [1, 2])
+        self.assertEqual(len(results), 0)
+        internal_conn = self.conn._v_database_connection._db_pool.get(
+            get_ident()).db
+        self.assertEqual(internal_conn.last_query,
+                         'SHOW VARIABLES WHERE a IN (1,2)')
+        self.conn._v_database_connection.close()
+
+    def test_paginate(self):
+        self.conn = self._simpleMakeOne()
+        self.conn.connect(self.conn.connection_string)
+        results, token = self.conn.paginate('SELECT * FROM t', 'id', '10')
+        self.assertEqual(len(results), 0)
+        self.assertIsNone(token)
+        self.conn._v_database_connection.close()
+
     def test_sql_quote__no_unicode(self):
         self.conn = self._simpleMakeOne()
 
@@ -179,6 +311,159 @@ class PatchedConnectionTests(PatchedConnectionTestsBase):
         # should return the same type of string.
         self.assertEqual(self.conn.sql_quote__(unencoded), unencoded)
 
+    def test_sql_quote_many(self):
+        self.conn = self._makeOne('conn_id', 'Conn Title', 'db_conn_string',
+                                  False, use_unicode=True)
+
+        quoted = self.conn.sql_quote_many([u'foo', b'bar', u'\xfc'])
+        self.assertEqual(quoted, [u'foo', b'bar', u'\xfc'])
+
+        db_pool = self.conn._v_database_connection._db_pool
+        internal_conn = db_pool.get(get_ident()).db
+        self.assertEqual(internal_conn.string_literal_called, b'\xfc')
+
+    def _blobRequest(self, **headers):
+        class DummyResponse(object):
+            def __init__(self):
+                self.status = 200
+                self.headers = {}
+                self.body = b''
+
+            def setStatus(self, status):
+                self.status = status
+
+            def setHeader(self, name, value):
+                self.headers[name] = value
+
+            def write(self, data):
+                self.body += data
+
+        class DummyRequest(object):
+            RESPONSE = DummyResponse()
+
+            def get_header(self, name):
+                return headers.get(name)
+
+        return DummyRequest()
+
+    def _blobConnection(self, value):
+        import re
+        self.conn = self._simpleMakeOne()
+        self.conn.connect(self.conn.connection_string)
+        pool = self.conn._v_database_connection
+        pool.blob_chunk_size = 4
+        statements = []
+
+        def query(sql_string, max_rows=1000):
+            statements.append(sql_string)
+            if value is None or not sql_string.startswith('SELECT'):
+                return (), ()
+            if sql_string.startswith('SELECT OCTET_LENGTH'):
+                return (), ((len(value),),)
+            start, size = re.search(r', (\d+), (\d+)\)', sql_string).groups()
+            start = int(start) - 1
+            return (), ((value[start:start + int(size)],),)
+
+        class StreamDB(object):
+            def query(self, sql_string, max_rows=1000):
+                return query(sql_string, max_rows)
+
+            def close(self):
+                statements.append('closed')
+
+        pool._stream_db = StreamDB
+        return statements
+
+    def test_stream_blob(self):
+        from ZPublisher.Iterators import IStreamIterator
+        statements = self._blobConnection(b'0123456789')
+        req = self._blobRequest()
+        body = self.conn.stream_blob('files', 'data', {'id': 1}, req,
+                                     filename='a.bin')
+        # The value is read while the publisher sends it
+        self.assertTrue(IStreamIterator.providedBy(body))
+        self.assertEqual(len(body), 10)
+        # The length is read inside the snapshot the value is read in
+        self.assertEqual(statements, [
+            'START TRANSACTION WITH CONSISTENT SNAPSHOT',
+            'SELECT OCTET_LENGTH(`data`) FROM `files` WHERE `id` = 1 '
+            'LIMIT 1'])
+        response = req.RESPONSE
+        self.assertEqual(response.status, 200)
+        self.assertEqual(b''.join(body), b'0123456789')
+        self.assertEqual(response.headers['Content-Length'], '10')
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertEqual(response.headers['Content-Disposition'],
+                         'attachment; filename="a.bin"')
+        # The value is read in chunks
+        self.assertEqual(statements[2],
+                         'SELECT SUBSTRING(CAST(`data` AS BINARY), 1, 4) '
+                         'FROM `files` WHERE `id` = 1 LIMIT 1')
+        self.assertEqual(len(statements), 7)
+        # The snapshot ends and the connection is closed at the end
+        self.assertEqual(statements[-2:], ['COMMIT', 'closed'])
+
+    def test_stream_blob_range(self):
+        statements = self._blobConnection(b'0123456789')
+        req = self._blobRequest(Range='bytes=3-8')
+        body = self.conn.stream_blob('files', 'data', {'id': 1}, req)
+        response = req.RESPONSE
+        self.assertEqual(response.status, 206)
+        self.assertEqual(len(body), 6)
+        self.assertEqual(b''.join(body), b'345678')
+        self.assertEqual(response.headers['Content-Range'], 'bytes 3-8/10')
+        self.assertEqual(response.headers['Content-Length'], '6')
+
+        req = self._blobRequest(Range='bytes=20-')
+        self.assertEqual(self.conn.stream_blob('files', 'data', {'id': 1},
+                                               req), '')
+        self.assertEqual(req.RESPONSE.status, 416)
+        self.assertEqual(req.RESPONSE.headers['Content-Range'], 'bytes */10')
+        # Nothing is streamed, the connection is closed right away
+        self.assertEqual(statements[-2:], ['COMMIT', 'closed'])
+
+        # Ranges are ignored if the client asks for a validator
+        req = self._blobRequest(Range='bytes=3-8', **{'If-Range': 'x'})
+        body = self.conn.stream_blob('files', 'data', {'id': 1}, req)
+        self.assertEqual(req.RESPONSE.status, 200)
+        self.assertEqual(b''.join(body), b'0123456789')
+
+    def test_export(self):
+        self.conn = self._simpleMakeOne()
+        self.conn.connect(self.conn.connection_string)
+        pool = self.conn._v_database_connection
+        calls = []
+        pool.export = lambda *args: calls.append(args) or 7
+        pool.iter_export = lambda *args: calls.append(args) or iter([b'x'])
+
+        from ZPublisher.Iterators import IUnboundStreamIterator
+        req = self._blobRequest()
+        body = self.conn.export('SELECT * FROM t', 'ndjson', compress=True,
+                                filename='t.json', REQUEST=req)
+        self.assertTrue(IUnboundStreamIterator.providedBy(body))
+        self.assertEqual(list(body), [b'x'])
+        headers = req.RESPONSE.headers
+        self.assertEqual(headers['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Content-Disposition'],
+                         'attachment; filename="t.json"')
+        self.assertEqual(calls, [('SELECT * FROM t', 'ndjson', True)])
+
+        out = object()
+        self.assertEqual(self.conn.export('SELECT * FROM t', out=out), 7)
+        self.assertEqual(calls[-1], ('SELECT * FROM t', out, 'csv', False))
+        self.assertRaises(ValueError, self.conn.export, 'SELECT 1', 'xml',
+                          out=out)
+        # There must be somewhere to write to
+        self.assertRaises(ValueError, self.conn.export, 'SELECT 1')
+
+    def test_stream_blob_not_found(self):
+        from zExceptions import NotFound
+        statements = self._blobConnection(None)
+        self.assertRaises(NotFound, self.conn.stream_blob, 'files', 'data',
+                          {'id': 1}, self._blobRequest())
+        self.assertEqual(statements[-2:], ['COMMIT', 'closed'])
+
 
 @unittest.skipUnless(have_test_database(), NO_MYSQL_MSG)
 class RealConnectionTests(unittest.TestCase):
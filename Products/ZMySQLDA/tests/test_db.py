@@ -14,6 +14,7 @@
 """
 import unittest
 
+import six
 from six.moves._thread import get_ident
 
 from .base import DB_CONN_STRING
@@ -41,6 +42,152 @@ class DbFunctionsTests(unittest.TestCase):
                               DateTime)
         self.assertIsNone(DateTime_or_None(''))
 
+    def test_check_isolation_level(self):
+        from Products.ZMySQLDA.db import check_isolation_level
+        self.assertIsNone(check_isolation_level(None))
+        self.assertIsNone(check_isolation_level(''))
+        self.assertEqual(check_isolation_level('read committed'),
+                         'READ COMMITTED')
+        self.assertEqual(check_isolation_level('READ-UNCOMMITTED'),
+                         'READ UNCOMMITTED')
+        self.assertEqual(check_isolation_level(' Repeatable_Read '),
+                         'REPEATABLE READ')
+        self.assertRaises(ValueError, check_isolation_level, 'READ')
+
+    def test_session_lines(self):
+        from Products.ZMySQLDA.db import session_lines
+        self.assertEqual(session_lines(None), ())
+        self.assertEqual(session_lines(['SET a = 1;', ' ', 'SET b = 2 ']),
+                         ('SET a = 1', 'SET b = 2'))
+        self.assertEqual(session_lines('SET a = 1\n\nSET b = 2;\n'),
+                         ('SET a = 1', 'SET b = 2'))
+
+    def test_fingerprint(self):
+        from Products.ZMySQLDA.db import fingerprint
+
+        self.assertEqual(fingerprint("SELECT * FROM t WHERE a = 'x\\'y'"),
+                         'SELECT * FROM t WHERE a = ?')
+        self.assertEqual(fingerprint('SELECT  *\nFROM t2 WHERE id IN '
+                                     '(1, 2,3) AND b = "z" LIMIT 10'),
+                         'SELECT * FROM t2 WHERE id IN (?+) AND b = ? '
+                         'LIMIT ?')
+        self.assertEqual(fingerprint(b'DELETE FROM t WHERE id=5'),
+                         'DELETE FROM t WHERE id=?')
+
+    def test_quote_identifier(self):
+        from Products.ZMySQLDA.db import quote_identifier
+
+        self.assertEqual(quote_identifier('id'), '`id`')
+        self.assertEqual(quote_identifier('a`b'), '`a``b`')
+
+    def test_page_token(self):
+        from DateTime.DateTime import DateTime
+        from Products.ZMySQLDA.db import _decode_token
+        from Products.ZMySQLDA.db import _encode_token
+
+        token = _encode_token([5, 1.5, u'\xfc', b'\x00\xff',
+                               DateTime('2020-01-02 03:04:05')])
+        self.assertEqual(_decode_token(token, 5),
+                         [5, 1.5, u'\xfc', b'\x00\xff',
+                          u'2020-01-02 03:04:05'])
+
+    def test_page_token_invalid(self):
+        import base64
+
+        from Products.ZMySQLDA.db import ProgrammingError
+        from Products.ZMySQLDA.db import _decode_token
+        from Products.ZMySQLDA.db import _encode_token
+
+        def token(text):
+            return base64.urlsafe_b64encode(text).decode('ascii')
+
+        self.assertRaises(ProgrammingError, _encode_token, [None])
+        self.assertRaises(ProgrammingError, _decode_token,
+                          _encode_token([1]), 2)
+        for invalid in ('!', token(b'{}'), token(b'[["i", "1 OR 1"]]'),
+                        token(b'[["f", "NaN"]]'), token(b'[["s", 1]]'),
+                        token(b'[["x", 1]]'), token(b'[["i", true]]')):
+            self.assertRaises(ProgrammingError, _decode_token, invalid, 1)
+
+    def test_statement_type(self):
+        from Products.ZMySQLDA.db import statement_type
+
+        self.assertEqual(statement_type(''), '')
+        self.assertEqual(statement_type('select 1'), 'SELECT')
+        self.assertEqual(statement_type('/* a */ -- b\n# c\n SELECT 1'),
+                         'SELECT')
+        self.assertEqual(statement_type('(SELECT 1) UNION (SELECT 2)'),
+                         'SELECT')
+        self.assertEqual(statement_type(
+            'WITH a AS (SELECT 1), b (x) AS (SELECT ")") SELECT * FROM a'),
+            'SELECT')
+        self.assertEqual(statement_type(
+            'WITH RECURSIVE c AS (SELECT 1 UNION ALL SELECT n + 1 FROM c) '
+            'DELETE FROM t'), 'DELETE')
+        self.assertEqual(statement_type('WITH'), 'WITH')
+
+    def test_statement_types(self):
+        from Products.ZMySQLDA.db import statement_types
+
+        self.assertEqual(statement_types(''), [])
+        self.assertEqual(statement_types('select 1'), ['SELECT'])
+        self.assertEqual(statement_types('\0 select 1\0\nupdate t\0'),
+                         ['SELECT', 'UPDATE'])
+
+    def test_coalescable(self):
+        from Products.ZMySQLDA.db import coalescable
+
+        self.assertTrue(coalescable('SELECT * FROM t'))
+        self.assertTrue(coalescable(' select a FROM t WHERE b = 1\0'))
+        self.assertFalse(coalescable(''))
+        self.assertFalse(coalescable('UPDATE t SET a = 1'))
+        self.assertFalse(coalescable('SELECT 1\0SELECT 2'))
+        self.assertFalse(coalescable('SELECT * FROM t FOR UPDATE'))
+        self.assertFalse(coalescable('SELECT * FROM t LOCK IN SHARE MODE'))
+        self.assertFalse(coalescable('SELECT a INTO @x FROM t'))
+        self.assertFalse(coalescable('SELECT LAST_INSERT_ID()'))
+        self.assertTrue(coalescable('WITH a AS (SELECT 1) SELECT * FROM a'))
+        self.assertFalse(coalescable('WITH a AS (SELECT 1) DELETE FROM t'))
+
+
+class RecordingHook(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def before(self, operation, info):
+        self.calls.append(('before', operation, dict(info)))
+        return len(self.calls)
+
+    def after(self, operation, token, info):
+        self.calls.append(('after', operation, token, dict(info)))
+
+
+class TraceHooksTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from Products.ZMySQLDA.db import TraceHooks
+        return TraceHooks()
+
+    def test_register_unregister(self):
+        hooks = self._makeOne()
+        hook = RecordingHook()
+        self.assertFalse(hooks.hooks)
+        hooks.register(hook)
+        hooks.register(hook)
+        self.assertEqual(hooks.hooks, (hook,))
+        hooks.unregister(hook)
+        self.assertFalse(hooks.hooks)
+
+    def test_failing_hook(self):
+        hooks = self._makeOne()
+        hook = RecordingHook()
+        hooks.register(object())
+        hooks.register(hook)
+        tokens = hooks.before('query', {})
+        hooks.after('query', tokens, {})
+        self.assertEqual([c[0] for c in hook.calls], ['before', 'after'])
+
 
 class DBPoolTests(unittest.TestCase):
 
@@ -121,6 +268,656 @@ class PatchedDBPoolTests(PatchedConnectionTestsBase):
         self.assertEqual(pool.variables(),
                          {'var1': 'val1', 'version': '5.5.5'})
 
+    def test_encoding(self):
+        self.assertEqual(self._makeOne().encoding, 'latin1')
+        self.assertEqual(self._makeOne(charset='utf8mb4').encoding, 'UTF-8')
+        self.assertEqual(self._makeOne(charset='cp1250').encoding, 'cp1250')
+
+    def test_quoter(self):
+        pool = self._makeOne(use_unicode=True, charset='utf8')
+        pool._db_flags = {'kw_args': {}}
+
+        quote = pool.quoter()
+        self.assertEqual(quote(u'\xfc'), u'\xfc')
+        db = pool._db_pool[get_ident()]
+        self.assertEqual(db.db.string_literal_called, u'\xfc'.encode('UTF-8'))
+        self.assertEqual(quote(b'foo'), b'foo')
+
+    def test_max_result_bytes(self):
+        pool = self._makeOne(max_result_bytes='100')
+        pool('test')
+        self.assertEqual(pool._db_flags['max_result_bytes'], 100)
+        pool.query('SELECT 1')
+        db = pool._db_pool[get_ident()]
+        self.assertEqual(db.max_result_bytes, 100)
+
+    def test_session_statements(self):
+        pool = self._makeOne(session_statements=['SET a = 1;', ''])
+        self.assertEqual(pool.session_statements, ('SET a = 1',))
+        pool('test')
+        pool.query('SELECT 1')
+        db = pool._db_pool[get_ident()]
+        self.assertEqual(db.session_statements, ('SET a = 1',))
+        self.assertEqual(db.db.queries[0], 'SET a = 1')
+
+    def test_lock_wait_timeout(self):
+        pool = self._makeOne(lock_wait_timeout='10')
+        pool('test')
+        self.assertEqual(pool._db_flags['lock_wait_timeout'], 10)
+
+    def test_conflict_error_codes(self):
+        pool = self._makeOne(conflict_error_codes='1180 1412')
+        pool('test')
+        self.assertEqual(pool._db_flags['conflict_error_codes'], (1180, 1412))
+
+    def test_slow_transaction_threshold(self):
+        pool = self._makeOne(slow_transaction_threshold='1.5')
+        pool('test')
+        self.assertEqual(pool._db_flags['slow_transaction_threshold'], 1.5)
+
+    def test_xa_recover_on_connect(self):
+        from MySQLdb import OperationalError
+        from MySQLdb.constants import CLIENT
+
+        from Products.ZMySQLDA.db import DB
+        from Products.ZMySQLDA.db import DBPool
+        from Products.ZMySQLDA.db import MySQLdb
+
+        recovered = []
+
+        class RecordingDB(DB):
+            def xa_recover(self):
+                recovered.append(self.xa_transactions)
+                return []
+
+        MySQLdb.connect = lambda **kw: FakeConnection(
+            server_capabilities=CLIENT.TRANSACTIONS, **kw)
+        DBPool(RecordingDB)('test')
+        self.assertEqual(recovered, [])
+
+        pool = DBPool(RecordingDB, xa_transactions=True)
+        pool('test')
+        self.assertTrue(pool._db_flags['xa_transactions'])
+        self.assertEqual(recovered, [True])
+        # The connection used for recovery is not pooled
+        self.assertEqual(pool._db_pool, {})
+
+        # Without transactions there are no XA transactions to recover
+        DBPool(RecordingDB, xa_transactions=True)('-test')
+        self.assertEqual(recovered, [True])
+
+        class UnprivilegedDB(DB):
+            def xa_recover(self):
+                raise OperationalError(1227, 'Access denied; you need (at '
+                                       'least one of) the XA_RECOVER_ADMIN '
+                                       'privilege(s)')
+
+        # Failing to look for in-doubt transactions does not stop connecting
+        pool = DBPool(UnprivilegedDB, xa_transactions=True)
+        self.assertIs(pool('test'), pool)
+
+    def test_connection_stats(self):
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        self.assertEqual(pool.connection_stats(), [])
+
+        pool.query('SELECT 1')
+        pool.query('SELECT 2')
+        stats = pool.connection_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['thread_id'], get_ident())
+        self.assertTrue(stats[0]['thread_name'])
+        self.assertEqual(stats[0]['queries'], 2)
+        self.assertEqual(stats[0]['reconnects'], 0)
+        self.assertFalse(stats[0]['in_transaction'])
+
+        pool.reset_counters()
+        self.assertEqual(pool.connection_stats()[0]['queries'], 0)
+
+    def test_drain(self):
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        pool.variables()
+        self.assertEqual(pool.drain(max_idle=3600), 0)
+        self.assertEqual(len(pool._db_pool), 1)
+
+        # Connections in a transaction are never drained
+        pool._db_pool[get_ident()]._registered = True
+        self.assertEqual(pool.drain(), 0)
+        pool._db_pool[get_ident()]._registered = False
+        self.assertEqual(pool.drain(), 1)
+        self.assertEqual(pool._db_pool, {})
+
+    def test_metrics(self):
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        pool.query('SELECT 1')
+        pool.query('UPDATE foo SET bar=1')
+        metrics = pool.metrics()
+        self.assertEqual(metrics.queries['SELECT'].count, 1)
+        self.assertEqual(metrics.queries['UPDATE'].count, 1)
+
+        # Counters survive removing connections from the pool
+        pool.closeConnection()
+        self.assertEqual(pool.metrics().queries['SELECT'].count, 1)
+        pool.query('SELECT 1')
+        pool.close()
+        self.assertEqual(pool.metrics().queries['SELECT'].count, 2)
+
+    def test_coalesced_query(self):
+        import threading
+        import time
+        pool = self._makeOne(coalesce_selects=True)
+        pool._db_flags = {'kw_args': {}}
+        self.assertTrue(pool.coalesce_selects)
+
+        # Make the leader block until all followers wait for it
+        started = threading.Event()
+        proceed = threading.Event()
+        calls = []
+        result = ([{'name': 'a'}], ((1,),))
+
+        def slow_query(sql_string, max_rows=1000, params=None):
+            calls.append(sql_string)
+            started.set()
+            proceed.wait(5)
+            return result
+
+        def run(results):
+            results.append(pool.query('SELECT a FROM t'))
+
+        pool._access_db = lambda method_id, args, kw: slow_query(*args)
+        results = []
+        leader = threading.Thread(target=run, args=(results,))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=run, args=(results,))
+                     for i in range(3)]
+        for follower in followers:
+            follower.start()
+        time.sleep(0.1)
+        proceed.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(r is result for r in results))
+        self.assertGreater(pool.coalesced_queries, 0)
+        self.assertEqual(len(calls) + pool.coalesced_queries, 4)
+        self.assertEqual(pool._flights, {})
+
+    def test_coalesced_query_errors_and_writes(self):
+        pool = self._makeOne(coalesce_selects=True)
+        pool._db_flags = {'kw_args': {}}
+
+        self.assertEqual(pool.query('SELECT 1'), ((), []))
+        self.assertEqual(pool._flights, {})
+
+        def broken(*args, **kw):
+            raise ValueError('broken')
+
+        db = pool._db_pool[get_ident()]
+        db.db.query = broken
+        self.assertRaises(ValueError, pool.query, 'SELECT 1')
+        self.assertEqual(pool._flights, {})
+
+        # A thread that wrote in its transaction does not coalesce
+        db._registered = db._wrote = True
+        self.assertRaises(ValueError, pool.query, 'SELECT 1')
+        self.assertEqual(pool.coalesced_queries, 0)
+
+        # Neither does a thread reading in the snapshot of its transaction
+        from Products.ZMySQLDA.db import _Flight
+        db._wrote = False
+        pool._flights[('SELECT 1', 1000, None)] = _Flight()
+        pool._access_db = lambda method_id, args, kw: 'own result'
+        self.assertEqual(pool.query('SELECT 1'), 'own result')
+        self.assertEqual(pool.coalesced_queries, 0)
+
+    def _runInLoop(self, func, *args):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return func(loop, *args)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    @unittest.skipIf(six.PY2, 'asyncio is not available')
+    def test_aquery(self):
+        pool = self._makeOne(max_workers=2)
+        pool._db_flags = {'kw_args': {}}
+        self.assertEqual(pool.max_workers, 2)
+
+        def run(loop):
+            return loop.run_until_complete(pool.aquery('SELECT 1'))
+
+        self.assertEqual(self._runInLoop(run), ((), []))
+        # The query ran on a worker thread with its own connection
+        self.assertNotIn(get_ident(), pool._db_pool)
+        self.assertEqual(len(pool._db_pool), 1)
+        pool.close()
+        self.assertIsNone(pool._executor)
+
+    @unittest.skipIf(six.PY2, 'asyncio is not available')
+    def test_aquery_mysql_lock(self):
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}, 'mysql_lock': 'foo_lock'}
+
+        def run(loop):
+            return loop.run_until_complete(pool.aquery('SELECT 1'))
+
+        self.assertEqual(self._runInLoop(run), ((), []))
+        # The query ran on this thread, which may hold the lock
+        self.assertEqual(list(pool._db_pool.keys()), [get_ident()])
+        self.assertIsNone(pool._executor)
+
+    @unittest.skipIf(six.PY2, 'asyncio is not available')
+    def test_aquery_cancel(self):
+        import asyncio
+        import threading
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        started = threading.Event()
+        proceed = threading.Event()
+        killed = []
+
+        def run_job(job, method_id, args, kw):
+            job.thread_id = 7
+            started.set()
+            proceed.wait(5)
+            job.done = True
+
+        pool._run_job = run_job
+        pool._kill_job = lambda job: killed.append(job.thread_id)
+
+        def run(loop):
+            future = pool.aquery('SELECT SLEEP(10)')
+            started.wait(5)
+            future.cancel()
+            loop.run_until_complete(asyncio.sleep(0.1))
+
+        self._runInLoop(run)
+        proceed.set()
+        self.assertEqual(killed, [7])
+        pool.close()
+
+    def test_query_many(self):
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        self.assertEqual(pool.query_many(['SELECT 1', 'SHOW VARIABLES']),
+                         [((), []), ((), [('var1', 'val1'),
+                                          ('version', '5.5.5')])])
+        # The queries ran on worker threads
+        self.assertNotIn(get_ident(), pool._db_pool)
+        pool.close()
+
+    def test_query_many_serial(self):
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+
+        # A single query or queries that may write run on this thread
+        self.assertEqual(pool.query_many(['SELECT 1']), [((), [])])
+        self.assertEqual(pool.query_many(['SELECT 1', 'DELETE FROM t']),
+                         [((), []), ((), [])])
+        self.assertEqual(list(pool._db_pool.keys()), [get_ident()])
+        self.assertIsNone(pool._executor)
+
+        # So do SELECTs locking rows or using session state
+        for sql_string in ('SELECT a FROM t FOR UPDATE',
+                           'SELECT a FROM t LOCK IN SHARE MODE',
+                           "SELECT GET_LOCK('x', 1)", 'SELECT @x := 1'):
+            pool.query_many(['SELECT 1', sql_string])
+            self.assertIsNone(pool._executor)
+
+        # So do all queries of connections using a MySQL lock
+        pool._db_flags['mysql_lock'] = 'foo_lock'
+        pool.query_many(['SELECT 1', 'SELECT 2'])
+        pool.query_in('SELECT a FROM t WHERE a IN %s', [1, 2],
+                      parallel=True)
+        self.assertIsNone(pool._executor)
+        del pool._db_flags['mysql_lock']
+
+        # So do all queries after this thread wrote in its transaction
+        db = pool._db_pool[get_ident()]
+        db._registered = db._wrote = True
+        self.assertEqual(pool.query_many(['SELECT 1', 'SELECT 2']),
+                         [((), []), ((), [])])
+        self.assertIsNone(pool._executor)
+
+    def test_query_in(self):
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        # Leaves room for about 770 bytes of values per statement
+        pool._max_allowed_packet = 2000
+        statements = []
+
+        def query(sql_string, max_rows=1000):
+            statements.append(sql_string)
+            return [{'name': 'id', 'type': 'i'}], ((len(statements),),)
+
+        pool.query = query
+        items, rows = pool.query_in(
+            'SELECT id FROM t WHERE id IN %s AND a LIKE "x%%"', range(300))
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(items, [{'name': 'id', 'type': 'i'}])
+        self.assertEqual(rows, ((1,), (2,)))
+        values = []
+        for statement in statements:
+            self.assertTrue(statement.startswith(
+                'SELECT id FROM t WHERE id IN ('))
+            self.assertTrue(statement.endswith(') AND a LIKE "x%"'))
+            values.extend(statement[30:-17].split(','))
+        self.assertEqual(values, [str(i) for i in range(300)])
+
+        # The number of values per statement is limited as well
+        del statements[:]
+        pool.max_in_values = 100
+        items, rows = pool.query_in('SELECT id FROM t WHERE id IN %s',
+                                    range(300), max_rows=2)
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(rows, ((1,), (2,)))
+
+        # Nothing to do for no values
+        del statements[:]
+        self.assertEqual(pool.query_in('SELECT id FROM t WHERE id IN %s',
+                                       []), ((), ()))
+        self.assertEqual(statements, [])
+
+    def test_query_in_errors(self):
+        from Products.ZMySQLDA.db import ProgrammingError
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        pool.max_in_values = 1
+        results = [([{'name': 'a', 'type': 'i'}], ((1,),)),
+                   ([{'name': 'b', 'type': 'i'}], ((2,),))]
+        pool.query = lambda sql_string, max_rows: results.pop(0)
+
+        self.assertRaises(ProgrammingError, pool.query_in,
+                          'SELECT a FROM t WHERE a IN %s', [1, 2])
+        self.assertRaises(ProgrammingError, pool.query_in,
+                          'SELECT a FROM t WHERE a = 1', [1, 2])
+        self.assertRaises(ProgrammingError, pool.query_in,
+                          'SELECT a FROM t WHERE a IN %s OR b IN %s', [1])
+
+    def test_paginate(self):
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        statements = []
+        items = [{'name': 'id', 'type': 'i'}, {'name': 'name', 'type': 's'}]
+
+        def query(sql_string, max_rows=1000):
+            statements.append((sql_string, max_rows))
+            return items, ((1, 'a'), (2, 'b'), (3, 'c'))
+
+        pool.query = query
+        result_items, rows, token = pool.paginate('SELECT * FROM t;', 'id', 2)
+        self.assertEqual(statements, [
+            ('SELECT * FROM (SELECT * FROM t) AS zmysqlda_page '
+             'ORDER BY `id`', 3)])
+        self.assertEqual(result_items, items)
+        self.assertEqual(rows, ((1, 'a'), (2, 'b')))
+        self.assertTrue(token)
+
+        pool.paginate('SELECT * FROM t', ['id'], 2, after=token)
+        self.assertEqual(statements[-1][0],
+                         'SELECT * FROM (SELECT * FROM t) AS zmysqlda_page '
+                         'WHERE `id` > 2 ORDER BY `id`')
+
+        # Several key columns are compared as a row
+        result_items, rows, token = pool.paginate(
+            'SELECT * FROM t', ['name', 'id'], 2, descending=True)
+        pool.paginate('SELECT * FROM t', ['name', 'id'], 2, after=token,
+                      descending=True)
+        self.assertEqual(statements[-1][0],
+                         'SELECT * FROM (SELECT * FROM t) AS zmysqlda_page '
+                         'WHERE (`name`, `id`) < (b, 2) '
+                         'ORDER BY `name` DESC, `id` DESC')
+
+        # There is no token for the last page
+        self.assertIsNone(pool.paginate('SELECT * FROM t', 'id', 3)[2])
+
+        # Leading comments and common table expressions are fine
+        pool.paginate('/* list */ SELECT * FROM t', 'id', 2)
+        pool.paginate('WITH u AS (SELECT 1) SELECT * FROM t', 'id', 2)
+        self.assertEqual(statements[-1][0],
+                         'SELECT * FROM (WITH u AS (SELECT 1) SELECT * FROM '
+                         't) AS zmysqlda_page ORDER BY `id`')
+
+    def test_iter_blob(self):
+        from Products.ZMySQLDA.db import ProgrammingError
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        statements = []
+        chunks = [((b'abc',),), ((b'de',),), ((b'',),)]
+
+        def query(sql_string, max_rows=1000):
+            statements.append(sql_string)
+            return (), chunks.pop(0)
+
+        pool.query = query
+        self.assertEqual(list(pool.iter_blob('t', 'data', {'id': 1, 'k': 2},
+                                             chunk_size=3)),
+                         [b'abc', b'de'])
+        self.assertEqual(statements, [
+            'SELECT SUBSTRING(CAST(`data` AS BINARY), %d, 3) FROM `t` '
+            'WHERE `id` = 1 AND `k` = 2 LIMIT 1' % start
+            for start in (1, 4, 6)])
+
+        # A range stops after its last byte
+        del statements[:]
+        chunks = [((b'bc',),)]
+        self.assertEqual(list(pool.iter_blob('t', 'data', {'id': 1}, 1, 2)),
+                         [b'bc'])
+        self.assertEqual(statements, [
+            'SELECT SUBSTRING(CAST(`data` AS BINARY), 2, 2) FROM `t` '
+            'WHERE `id` = 1 LIMIT 1'])
+
+        pool.query = lambda sql_string: ((), ((5,),))
+        self.assertEqual(pool.blob_length('t', 'data', {'id': 1}), 5)
+        pool.query = lambda sql_string: ((), ())
+        self.assertIsNone(pool.blob_length('t', 'data', {'id': 1}))
+        self.assertRaises(ProgrammingError, pool.blob_length, 't', 'data', {})
+
+    def test_stream_db(self):
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}, 'use_TM': True, 'transactions': True,
+                          'mysql_lock': 'lock', 'xa_transactions': True}
+        statements = []
+
+        class StreamDB(object):
+            def __init__(self, **kw):
+                statements.append(kw)
+
+            def query(self, sql_string, max_rows=1000):
+                statements.append(sql_string)
+                if 'OCTET_LENGTH' in sql_string:
+                    return (), ((2,),)
+                return (), ((b'ab',),)
+
+            def iter_export(self, sql_string, format, compress):
+                statements.append(sql_string)
+                return iter([b'id\r\n', b'1\r\n'])
+
+            def close(self):
+                statements.append('closed')
+
+        pool._db_cls = StreamDB
+        pool.quoter = lambda: repr
+        blob = pool.open_blob('t', 'data', {'id': 1})
+        # The connection is not pooled and does not join transactions
+        self.assertEqual(statements[0], {'kw_args': {}, 'use_TM': False,
+                                         'transactions': False,
+                                         'mysql_lock': None,
+                                         'xa_transactions': False})
+        # The length and the chunks are read in the same snapshot
+        self.assertEqual(statements[1],
+                         'START TRANSACTION WITH CONSISTENT SNAPSHOT')
+        self.assertEqual(blob.length, 2)
+        self.assertEqual(list(blob.read(0, 1)), [b'ab'])
+        self.assertEqual(statements[-2:], ['COMMIT', 'closed'])
+        self.assertEqual(pool._db_pool, {})
+        # Closing twice does no harm
+        blob.close()
+        self.assertEqual(statements[-2:], ['COMMIT', 'closed'])
+
+        # Abandoned reads end the snapshot, too
+        del statements[:]
+        chunks = pool.open_blob('t', 'data', {'id': 1}).read()
+        next(chunks)
+        chunks.close()
+        self.assertEqual(statements[-2:], ['COMMIT', 'closed'])
+
+        del statements[:]
+        chunks = pool.iter_export('SELECT id FROM t')
+        # The statement runs right away
+        self.assertEqual(statements[1], 'SELECT id FROM t')
+        self.assertEqual(list(chunks), [b'id\r\n', b'1\r\n'])
+        self.assertEqual(statements[-1], 'closed')
+
+        # Abandoned streams close their connection, too
+        del statements[:]
+        chunks = pool.iter_export('SELECT id FROM t')
+        next(chunks)
+        chunks.close()
+        self.assertEqual(statements[-1], 'closed')
+
+    def test_paginate_errors(self):
+        from Products.ZMySQLDA.db import ProgrammingError
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        pool.query = lambda sql_string, max_rows: (
+            [{'name': 'id', 'type': 'i'}], ((1,), (2,)))
+
+        self.assertRaises(ProgrammingError, pool.paginate,
+                          'DELETE FROM t', 'id', 1)
+        self.assertRaises(ProgrammingError, pool.paginate,
+                          'WITH u AS (SELECT 1) DELETE FROM t', 'id', 1)
+        self.assertRaises(ProgrammingError, pool.paginate,
+                          'SELECT 1\0SELECT 2', 'id', 1)
+        self.assertRaises(ProgrammingError, pool.paginate,
+                          'SELECT * FROM t', [], 1)
+        self.assertRaises(ProgrammingError, pool.paginate,
+                          'SELECT * FROM t', 'id', 0)
+        self.assertRaises(ProgrammingError, pool.paginate,
+                          'SELECT * FROM t', 'other', 1)
+        self.assertRaises(ProgrammingError, pool.paginate,
+                          'SELECT * FROM t', 'id', 1, after='invalid')
+
+    def test_max_allowed_packet(self):
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        # The dummy connection does not know the variable
+        self.assertEqual(pool.max_allowed_packet(), 4194304)
+        db = pool._db_pool[get_ident()]
+        self.assertEqual(db.db.last_query,
+                         "SHOW VARIABLES LIKE 'max_allowed_packet'")
+
+    def test_cancel_job_finished(self):
+        from Products.ZMySQLDA.db import _Job
+        pool = self._makeOne()
+        pool._kill_job = self.fail
+        job = _Job()
+        pool._cancel_job(job)
+        job.thread_id = 7
+        job.done = True
+        pool._cancel_job(job)
+
+    def test_kill_query(self):
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        queries = []
+        from Products.ZMySQLDA.db import MySQLdb
+        connect = MySQLdb.connect
+
+        def recording_connect(**kw):
+            conn = connect(**kw)
+            conn.query = queries.append
+            return conn
+
+        MySQLdb.connect = recording_connect
+        try:
+            pool.kill_query('12')
+        finally:
+            MySQLdb.connect = connect
+        self.assertEqual(queries, ['KILL QUERY 12'])
+
+    def test_kill_job(self):
+        from Products.ZMySQLDA.db import MySQLdb
+        from Products.ZMySQLDA.db import _Job
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        queries = []
+        job = _Job()
+        job.thread_id = 12
+        connect = MySQLdb.connect
+
+        def recording_connect(**kw):
+            conn = connect(**kw)
+            conn.query = queries.append
+            return conn
+
+        MySQLdb.connect = recording_connect
+        try:
+            pool._kill_job(job)
+            self.assertEqual(queries, ['KILL QUERY 12'])
+
+            def finishing_connect(**kw):
+                # The job finishes while connecting and its connection
+                # starts the next job
+                job.done = True
+                return recording_connect(**kw)
+
+            MySQLdb.connect = finishing_connect
+            pool._kill_job(job)
+            self.assertEqual(queries, ['KILL QUERY 12'])
+        finally:
+            MySQLdb.connect = connect
+
+    def test_run_job_thread_id(self):
+        from Products.ZMySQLDA.db import _Job
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}, 'use_TM': True}
+        job = _Job()
+        thread_ids = []
+        db = pool._get_db()
+        db.db.thread_id = lambda: 43 if db._registered else 42
+
+        def query(*args):
+            thread_ids.append(job.thread_id)
+
+        db.query = query
+        pool._run_job(job, 'query', ('SELECT 1',), {})
+        # The thread id is taken after beginning, which may reconnect
+        self.assertEqual(thread_ids, [43])
+        # and cleared when the connection is free for the next job
+        self.assertTrue(job.done)
+        self.assertIsNone(job.thread_id)
+
+    def test_reconnect_all(self):
+        pool = self._makeOne()
+        pool._db_flags = {'kw_args': {}}
+        pool.variables()
+        db = pool._db_pool[get_ident()]
+        old_conn = db.db
+
+        pool.reconnect_all()
+        # Connections inside a transaction keep their connection
+        db._registered = True
+        pool.variables()
+        self.assertIs(db.db, old_conn)
+
+        db._registered = False
+        pool.variables()
+        self.assertIsNot(db.db, old_conn)
+        self.assertEqual(db._reconnects, 1)
+
+        # Only reconnects once per reconnect_all call
+        new_conn = db.db
+        pool.variables()
+        self.assertIs(db.db, new_conn)
+
 
 @unittest.skipUnless(have_test_database(), NO_MYSQL_MSG)
 class RealConnectionDBPoolTests(unittest.TestCase):
@@ -186,6 +983,16 @@ class RealConnectionDBPoolTests(unittest.TestCase):
         self.dbpool = self._makeOne(charset='utf8mb4')
         self.assertEqual(self.dbpool.unicode_literal(u'foo'), b"'foo'")
 
+    def test_quoter(self):
+        self.dbpool = self._makeOne()
+        quote = self.dbpool.quoter()
+        self.assertEqual(quote(b"it's"), b"'it\\'s'")
+
+        self.dbpool = self._makeOne(use_unicode=True, charset='utf8mb4')
+        quote = self.dbpool.quoter()
+        self.assertEqual(quote(u"\xfc'"), u"'\xfc\\''")
+        self.assertEqual(quote(b'foo'), b"'foo'")
+
 
 class DBTests(PatchedConnectionTestsBase):
 
@@ -211,11 +1018,396 @@ class DBTests(PatchedConnectionTestsBase):
         self.assertTrue(db._use_TM)
         self.assertTrue(db._transactions)
 
+    def test_session_statements(self):
+        db = self._makeOne(kw_args={},
+                           session_statements=("SET time_zone = '+00:00'",
+                                               'SET sql_mode = ANSI'))
+        session = "SET time_zone = '+00:00';\nSET sql_mode = ANSI"
+        self.assertEqual(db.db.queries, [session])
+
+        # Reconnects set up the new session
+        db._forceReconnection()
+        self.assertEqual(db.db.queries, [session])
+
+        # The session is not set up again for a new transaction
+        db._begin()
+        self.assertEqual(db.db.queries, [session])
+
+        # unless the client library reconnected on its own
+        db._select_limit = 1000
+        db.db.thread_id = lambda: 43
+        db._begin()
+        self.assertEqual(db.db.queries, [session, session])
+        self.assertIsNone(db._select_limit)
+
+    def test_isolation_level(self):
+        db = self._makeOne(kw_args={}, isolation_level='READ COMMITTED',
+                           session_statements=('SET a = 1',))
+        self.assertEqual(db.db.queries, [
+            'SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED;\n'
+            'SET a = 1'])
+
+    def test_set_transaction_isolation(self):
+        import transaction
+        from Products.ZMySQLDA.db import NotSupportedError
+        from Products.ZMySQLDA.db import ProgrammingError
+        db = self._makeOne(kw_args={}, transactions=True)
+        db.set_transaction_isolation('read uncommitted')
+        db._begin()
+        self.assertEqual(db.db.last_query,
+                         'SET TRANSACTION ISOLATION LEVEL READ UNCOMMITTED;'
+                         '\nBEGIN')
+        self.assertIsNone(db._transaction_isolation)
+        self.assertRaises(ProgrammingError, db.set_transaction_isolation,
+                          'SERIALIZABLE')
+        db._finish()
+
+        # The next transaction uses the session level again
+        db._begin()
+        self.assertEqual(db.db.last_query, 'BEGIN')
+        db._finish()
+
+        # The transaction is begun right away with the transaction manager
+        db = self._makeOne(kw_args={}, transactions=True, use_TM=True)
+        try:
+            db.set_transaction_isolation('SERIALIZABLE')
+            self.assertTrue(db._transaction_begun)
+            self.assertEqual(db.db.last_query,
+                             'SET TRANSACTION ISOLATION LEVEL SERIALIZABLE;'
+                             '\nBEGIN')
+        finally:
+            transaction.abort()
+
+        db = self._makeOne(kw_args={})
+        self.assertRaises(NotSupportedError, db.set_transaction_isolation,
+                          'SERIALIZABLE')
+        self.assertRaises(ValueError, db.set_transaction_isolation, 'DIRTY')
+
+    def test_session_statements_error(self):
+        from Products.ZMySQLDA.db import OperationalError
+        db = self._makeOne(kw_args={})
+        db.session_statements = ('SET a = 1', 'SET b = 2')
+
+        def next_result():
+            raise OperationalError(1193, "Unknown system variable 'b'")
+
+        db.db.next_result = next_result
+        self.assertRaises(OperationalError, db._init_session)
+
     def test_close(self):
         db = self._makeOne(kw_args={})
         db.close()
         self.assertIsNone(db.db)
 
+    def test_select_limit(self):
+        db = self._makeOne(kw_args={})
+
+        db.query('SELECT a FROM t')
+        db.query('SELECT a FROM t LIMIT 5, 10')
+        db.query('/* list */ WITH c AS (SELECT 1) SELECT * FROM c', 10)
+        db.query('DELETE FROM t', 10)
+        db.query('SELECT a FROM t', 0)
+        self.assertEqual(db.db.queries, [
+            'SET SESSION sql_select_limit = 1000',
+            'SELECT a FROM t',
+            'SELECT a FROM t LIMIT 5, 10',
+            'SET SESSION sql_select_limit = 10',
+            '/* list */ WITH c AS (SELECT 1) SELECT * FROM c',
+            'DELETE FROM t',
+            'SET SESSION sql_select_limit = DEFAULT',
+            'SELECT a FROM t'])
+
+        # A new connection starts with the default
+        db._forceReconnection()
+        db.query('SELECT a FROM t', 0)
+        self.assertEqual(db.db.queries, ['SELECT a FROM t'])
+
+    def test_select_limit_reconnect(self):
+        from Products.ZMySQLDA.db import CR
+        from Products.ZMySQLDA.db import OperationalError
+        db = self._makeOne(kw_args={})
+        db.query('SELECT a FROM t', 10)
+
+        def gone(sql):
+            raise OperationalError(CR.SERVER_GONE_ERROR, 'gone away')
+
+        db.db.query = gone
+        db.query('SELECT a FROM t', 10)
+        # The retried statement is limited on the new connection as well
+        self.assertEqual(db.db.queries, ['SET SESSION sql_select_limit = 10',
+                                         'SELECT a FROM t'])
+        self.assertEqual(db._select_limit, 10)
+
+    def test_select_limit_silent_reconnect(self):
+        db = self._makeOne(kw_args={}, session_statements=('SET a = 1',))
+        db.query('SELECT a FROM t', 10)
+        self.assertEqual(db._select_limit, 10)
+        # The client library reconnected on its own, e.g. in a ping, on a
+        # connection that never begins transactions
+        db.db.thread_id = lambda: 43
+        db.query('SELECT a FROM t', 10)
+        self.assertEqual(db.db.queries[-3:], [
+            'SET a = 1', 'SET SESSION sql_select_limit = 10',
+            'SELECT a FROM t'])
+
+    def test_result_items(self):
+        import copy
+
+        from Products.ZMySQLDA.db import FIELD_TYPE
+        db = self._makeOne(kw_args={})
+        desc = (('id', FIELD_TYPE.LONG, 11, 11, 11, 0, 0),
+                ('name', FIELD_TYPE.VAR_STRING, 20, 20, 20, 0, 1))
+
+        items = db._result_items(desc)
+        self.assertEqual(items, ({'name': 'id', 'type': 'i', 'width': 11,
+                                  'null': 0},
+                                 {'name': 'name', 'type': 't', 'width': 20,
+                                  'null': 1}))
+        self.assertIs(db._result_items(desc), items)
+        self.assertRaises(TypeError, items[0].__setitem__, 'name', 'x')
+        self.assertRaises(TypeError, items[0].update, {'name': 'x'})
+        self.assertEqual(copy.deepcopy(items), items)
+
+        # The cache is bounded
+        db.items_cache_size = 1
+        db._result_items(desc[:1])
+        self.assertEqual(list(db._items_cache.keys()), [desc[:1]])
+        self.assertIsNot(db._result_items(desc), items)
+
+    def test_query_columns(self):
+        from array import array
+
+        from Products.ZMySQLDA.db import FIELD_TYPE
+        from Products.ZMySQLDA.db import ProgrammingError
+
+        from .dummy import FakeResults
+        db = self._makeOne(kw_args={})
+        db.fetch_batch_size = 2
+        desc = (('id', FIELD_TYPE.LONG, 11, 11, 11, 0, 0),
+                ('name', FIELD_TYPE.VAR_STRING, 20, 20, 20, 0, 1))
+        rows = ((1, 'a'), (2, 'b'), (3, 'c'))
+
+        def query(sql):
+            db.db.last_query = sql
+            db.db.last_results = None
+            if sql.startswith('SELECT'):
+                db.db.last_results = FakeResults(rows, desc)
+
+        db.db.query = query
+        items, columns = db.query_columns('SELECT id, name FROM t\0')
+        self.assertEqual(db.db.last_query, 'SELECT id, name FROM t')
+        self.assertEqual([item['name'] for item in items], ['id', 'name'])
+        self.assertEqual(columns, [array('l', [1, 2, 3]), ['a', 'b', 'c']])
+        self.assertEqual(db._metrics.rows, 3)
+
+        items, columns = db.query_columns('SELECT id, name FROM t', 2)
+        self.assertEqual(columns, [array('l', [1, 2]), ['a', 'b']])
+
+        self.assertEqual(db.query_columns('DELETE FROM t'), ((), ()))
+        self.assertRaises(ProgrammingError, db.query_columns,
+                          'SELECT 1\0SELECT 2')
+
+    def test_export(self):
+        import io
+
+        from Products.ZMySQLDA.db import FIELD_TYPE
+        from Products.ZMySQLDA.db import ProgrammingError
+
+        from .dummy import FakeResults
+        db = self._makeOne(kw_args={'charset': 'utf8'})
+        db.fetch_batch_size = 2
+        desc = (('id', FIELD_TYPE.LONG, 11, 11, 11, 0, 0),
+                ('name', FIELD_TYPE.VAR_STRING, 20, 20, 20, 0, 1))
+        rows = ((1, b'a'), (2, None), (3, u'\xfc'.encode('UTF-8')))
+
+        def query(sql):
+            db.db.last_query = sql
+            db.db.last_results = FakeResults(rows, desc)
+
+        db.db.query = query
+        out = io.BytesIO()
+        self.assertEqual(db.export('SELECT id, name FROM t', out), 3)
+        self.assertEqual(out.getvalue(),
+                         u'id,name\r\n1,a\r\n2,\r\n3,\xfc\r\n'.encode('UTF-8'))
+        self.assertTrue(db.db.unbuffered)
+        self.assertEqual(db._metrics.rows, 3)
+
+        out = io.BytesIO()
+        db.export('SELECT id, name FROM t', out, 'ndjson')
+        self.assertEqual(out.getvalue().split(b'\n')[1],
+                         b'{"id": 2, "name": null}')
+
+        self.assertRaises(ProgrammingError, db.export, 'SELECT 1', out, 'xml')
+
+        class BrokenFile(object):
+            def write(self, data):
+                raise IOError('client went away')
+
+        db.export_buffer_size = 1
+        self.assertRaises(IOError, db.export, 'SELECT id, name FROM t',
+                          BrokenFile())
+        self.assertEqual(db.db.last_results.next_index, 3)
+        self.assertRaises(ProgrammingError, db.export, 'DELETE FROM t', out)
+        self.assertRaises(ProgrammingError, db.export,
+                          'SELECT 1\0SELECT 2', out)
+
+        # Iterating over the data fetches the rows as they are read
+        db.export_buffer_size = 8
+        chunks = db.iter_export('SELECT id, name FROM t')
+        self.assertEqual(next(chunks), b'id,name\r\n')
+        self.assertEqual(db.db.last_results.next_index, 0)
+        self.assertEqual(next(chunks), b'1,a\r\n2,\r\n')
+        self.assertEqual(db.db.last_results.next_index, 2)
+        self.assertEqual(b''.join(chunks), u'3,\xfc\r\n'.encode('UTF-8'))
+        self.assertEqual(db._metrics.rows, 9)
+        self.assertRaises(ProgrammingError, db.iter_export, 'DELETE FROM t')
+
+    def test_query_max_result_bytes(self):
+        from Products.ZMySQLDA.db import FIELD_TYPE
+        from Products.ZMySQLDA.db import ResultTooLarge
+
+        from .dummy import FakeResults
+        db = self._makeOne(kw_args={})
+        db.fetch_batch_size = 2
+        desc = (('name', FIELD_TYPE.VAR_STRING, 20, 20, 20, 0, 1),)
+        rows = (('a' * 10,), ('b' * 10,), ('c' * 10,))
+
+        def query(sql):
+            db.db.last_query = sql
+            db.db.last_results = FakeResults(rows, desc)
+
+        db.db.query = query
+        # Values are only measured for the limit
+        db.query('SELECT name FROM t')
+        self.assertEqual(db._metrics.bytes, 0)
+        db.max_result_bytes = 30
+        items, result = db.query('SELECT name FROM t')
+        self.assertEqual(result, rows)
+        self.assertTrue(db.db.unbuffered)
+        self.assertEqual(db._metrics.bytes, 30)
+
+        db.max_result_bytes = 25
+        self.assertRaises(ResultTooLarge, db.query, 'SELECT name FROM t')
+        # The rest of the result is read, so the connection stays usable
+        self.assertEqual(db.db.last_results.next_index, 3)
+        self.assertRaises(ResultTooLarge, db.query_columns,
+                          'SELECT name FROM t')
+        self.assertEqual(db.db.last_results.next_index, 3)
+        # The budget does not apply to the rows which are not fetched
+        items, result = db.query('SELECT name FROM t', max_rows=2)
+        self.assertEqual(result, rows[:2])
+        self.assertEqual(db.db.last_results.next_index, 3)
+
+    def test_query_params(self):
+        db = self._makeOne(kw_args={'charset': 'utf8'})
+
+        db.query('SELECT a FROM t WHERE b = %s AND c LIKE %s', max_rows=5,
+                 params=(1, 'x%'))
+        self.assertEqual(db.db.queries, [
+            'SET SESSION sql_select_limit = 5',
+            b"PREPARE zmysqlda_stmt_1 FROM "
+            b"SELECT a FROM t WHERE b = ? AND c LIKE ?",
+            b"SET @zmysqlda_p0 = '1', @zmysqlda_p1 = 'x%'; "
+            b"EXECUTE zmysqlda_stmt_1 USING @zmysqlda_p0, @zmysqlda_p1; "
+            b"SET @zmysqlda_p0 = NULL, @zmysqlda_p1 = NULL"])
+        self.assertEqual(db.stats()['queries'], 1)
+
+        # The prepared statement is reused
+        del db.db.queries[:]
+        db.query('SELECT a FROM t WHERE b = %s AND c LIKE %s', max_rows=5,
+                 params=[2, 'y'])
+        self.assertEqual(len(db.db.queries), 1)
+        self.assertTrue(db.db.queries[0].startswith(b"SET @zmysqlda_p0 = '2'"))
+
+        # Statements without placeholders need no variables
+        del db.db.queries[:]
+        db.query('DELETE FROM t WHERE a LIKE "%%x"', params=())
+        self.assertEqual(db.db.queries, [
+            b'PREPARE zmysqlda_stmt_2 FROM DELETE FROM t WHERE a LIKE "%x"',
+            b'EXECUTE zmysqlda_stmt_2'])
+        self.assertTrue(db._wrote)
+
+    def test_query_params_errors(self):
+        from Products.ZMySQLDA.db import ProgrammingError
+        db = self._makeOne(kw_args={})
+
+        self.assertRaises(ProgrammingError, db.query,
+                          'SELECT a FROM t WHERE b = %s', params=())
+        self.assertRaises(ProgrammingError, db.query,
+                          'SELECT %s\0SELECT %s', params=(1, 2))
+        self.assertEqual(db.db.queries, [])
+
+        def next_result():
+            raise ProgrammingError(1242, 'Subquery returns more than 1 row')
+
+        # The values are cleared even if the statement fails
+        db.db.next_result = next_result
+        self.assertRaises(ProgrammingError, db.query,
+                          'SELECT (SELECT a FROM t) = %s', params=(1,))
+        self.assertEqual(db.db.queries[-1], b'SET @zmysqlda_p0 = NULL')
+
+    def test_query_params_cache(self):
+        db = self._makeOne(kw_args={})
+        db.prepared_cache_size = 1
+
+        db.query('DELETE FROM t WHERE a = %s', params=(1,))
+        db.query('DELETE FROM u WHERE a = %s', params=(1,))
+        self.assertIn(b'DEALLOCATE PREPARE zmysqlda_stmt_1', db.db.queries)
+        self.assertEqual(list(db._prepared.values()), [b'zmysqlda_stmt_2'])
+
+        # Prepared statements are lost with the connection
+        db._forceReconnection()
+        self.assertEqual(len(db._prepared), 0)
+
+    def test_query_params_not_preparable(self):
+        from Products.ZMySQLDA.db import ER
+        from Products.ZMySQLDA.db import ProgrammingError
+        db = self._makeOne(kw_args={})
+        query = db.db.query
+
+        def no_prepare(sql):
+            if sql.startswith(b'PREPARE'):
+                raise ProgrammingError(ER.UNSUPPORTED_PS, 'unsupported')
+            return query(sql)
+
+        db.db.query = no_prepare
+        db.query('CREATE TABLE %s (a INT)', params=('t',))
+        db.query('CREATE TABLE %s (a INT)', params=('u',))
+        self.assertEqual(db.db.queries, [b"CREATE TABLE 't' (a INT)",
+                                         b"CREATE TABLE 'u' (a INT)"])
+
+    def test_query_params_question_mark(self):
+        db = self._makeOne(kw_args={})
+
+        # A literal question mark would become a placeholder when prepared
+        db.query("SELECT a FROM t WHERE a = 'x?' AND b = %s", params=(1,))
+        db.query("SELECT a FROM t WHERE a = 'x?' AND b = %s", params=(2,))
+        self.assertEqual(db.db.queries[-2:], [
+            b"SELECT a FROM t WHERE a = 'x?' AND b = '1'",
+            b"SELECT a FROM t WHERE a = 'x?' AND b = '2'"])
+        self.assertFalse([q for q in db.db.queries
+                          if isinstance(q, bytes) and
+                          q.startswith(b'PREPARE')])
+
+    def test_stats(self):
+        db = self._makeOne(kw_args={})
+        stats = db.stats()
+        self.assertEqual(stats['reconnects'], 0)
+        self.assertEqual(stats['queries'], 0)
+        self.assertGreaterEqual(stats['age'], 0)
+        self.assertGreaterEqual(stats['idle'], 0)
+
+        db.query('SELECT 1')
+        db._forceReconnection()
+        stats = db.stats()
+        self.assertEqual(stats['reconnects'], 1)
+        self.assertEqual(stats['queries'], 1)
+
+        db._reset_counters()
+        stats = db.stats()
+        self.assertEqual(stats['reconnects'], 0)
+        self.assertEqual(stats['queries'], 0)
+
     def test__parse_connection_string_empty(self):
         db = self._makeOne(kw_args={})
 
@@ -305,6 +1497,43 @@ class DBTests(PatchedConnectionTestsBase):
         self.assertFalse(parsed['kw_args']['use_unicode'])
         self.assertFalse('charset' in parsed['kw_args'])
 
+    def test__parse_connection_string_options(self):
+        db = self._makeOne(kw_args={})
+
+        c_str = ('foo_db@db.example.com foo_user foo=pw compress=1 '
+                 'read_timeout=30 write_timeout=60 '
+                 'init_command="SET time_zone=\'+00:00\'" '
+                 'ssl_mode=VERIFY_IDENTITY ssl_ca=/etc/ca.pem')
+        parsed = db._parse_connection_string(c_str)
+        kw_args = parsed['kw_args']
+        self.assertEqual(kw_args['db'], 'foo_db')
+        self.assertEqual(kw_args['host'], 'db.example.com')
+        self.assertEqual(kw_args['user'], 'foo_user')
+        # Only known option names end the positional parts
+        self.assertEqual(kw_args['passwd'], 'foo=pw')
+        self.assertIs(kw_args['compress'], True)
+        self.assertEqual(kw_args['read_timeout'], 30)
+        self.assertEqual(kw_args['write_timeout'], 60)
+        self.assertEqual(kw_args['init_command'], "SET time_zone='+00:00'")
+        self.assertEqual(kw_args['ssl_mode'], 'VERIFY_IDENTITY')
+        self.assertEqual(kw_args['ssl'], {'ca': '/etc/ca.pem'})
+        self.assertFalse('unix_socket' in kw_args)
+
+        # The timeout setting of the connection wins
+        parsed = db._parse_connection_string('foo_db connect_timeout=5',
+                                             timeout=10)
+        self.assertEqual(parsed['kw_args']['connect_timeout'], 10)
+
+    def test__parse_connection_string_invalid_options(self):
+        db = self._makeOne(kw_args={})
+
+        for c_str in ('foo_db compress=maybe',
+                      'foo_db read_timeout=0',
+                      'foo_db write_timeout=soon',
+                      'foo_db compress=1 foo_user',
+                      'foo_db compress=1 unknown=1'):
+            self.assertRaises(ValueError, db._parse_connection_string, c_str)
+
     def test__parse_connection_string_transactions(self):
         db = self._makeOne(kw_args={})
 
@@ -377,6 +1606,27 @@ class DBTests(PatchedConnectionTestsBase):
         self.assertTrue(db._transaction_begun)
         self.assertEqual(db.db.last_query, 'BEGIN')
 
+    def test_wrote(self):
+        db = self._makeOne(kw_args={})
+        db._transactions = True
+        db._begin()
+        db.query('SELECT 1')
+        self.assertFalse(db._wrote)
+        db.query('INSERT INTO foo VALUES (1)')
+        self.assertTrue(db._wrote)
+        db._finish()
+        self.assertFalse(db._wrote)
+
+    def test_transaction_metrics(self):
+        db = self._makeOne(kw_args={})
+        db._transactions = True
+        db._begin()
+        db._finish()
+        db._begin()
+        db._abort()
+        self.assertEqual(db._metrics.transactions,
+                         {'begun': 2, 'committed': 1, 'aborted': 1})
+
     def test__begin_mysql_lock(self):
         db = self._makeOne(kw_args={})
         db._mysql_lock = 'foo_lock'
@@ -440,6 +1690,260 @@ class DBTests(PatchedConnectionTestsBase):
         self.assertFalse(db._transaction_begun)
         self.assertEqual(db.db.last_query, "SELECT RELEASE_LOCK('foo_lock')")
 
+    def test_transaction_mysql_lock_batched(self):
+        db = self._makeOne(kw_args={}, transactions=True,
+                           mysql_lock='foo_lock')
+        db._begin()
+        self.assertEqual(db.db.queries,
+                         ["BEGIN;\nSELECT GET_LOCK('foo_lock',0)"])
+        db._finish()
+        self.assertEqual(db.db.last_query,
+                         "SELECT RELEASE_LOCK('foo_lock');\nCOMMIT")
+        db._begin()
+        db._abort()
+        self.assertEqual(db.db.last_query,
+                         "SELECT RELEASE_LOCK('foo_lock');\nROLLBACK")
+        self.assertEqual(len(db.db.queries), 4)
+        self.assertEqual(db._metrics.transactions,
+                         {'begun': 2, 'committed': 1, 'aborted': 1})
+
+    def test_lock_wait_timeout(self):
+        from ZODB.POSException import ConflictError
+
+        from .dummy import FakeResults
+        db = self._makeOne(kw_args={}, transactions=True,
+                           mysql_lock='foo_lock', lock_wait_timeout=5)
+        db._begin()
+        self.assertEqual(db.db.last_query,
+                         "BEGIN;\nSELECT GET_LOCK('foo_lock',5)")
+        self.assertEqual(db._metrics.lock_waits['foo_lock'].count, 1)
+        self.assertEqual(db._metrics.lock_failures, {})
+        db._finish()
+
+        # Not getting the lock within the timeout is a conflict
+        db.db.store_result = lambda: FakeResults([(0,)])
+        self.assertRaises(ConflictError, db._begin)
+        self.assertEqual(db._metrics.lock_waits['foo_lock'].count, 2)
+        self.assertEqual(db._metrics.lock_failures, {'foo_lock': 1})
+        # A timeout of GET_LOCK returns NULL on some server versions
+        db.db.store_result = lambda: FakeResults([(None,)])
+        self.assertRaises(ConflictError, db._begin)
+        self.assertEqual(db._metrics.lock_failures, {'foo_lock': 2})
+
+    def test_conflict_errors(self):
+        from Products.ZMySQLDA.db import OperationalError
+        from ZODB.POSException import ConflictError
+
+        def query(*args, **kw):
+            raise OperationalError(1213, 'Deadlock found')
+
+        # Without transactions Zope cannot retry the request
+        db = self._makeOne(kw_args={}, transactions=False)
+        db.db.query = query
+        self.assertRaises(OperationalError, db._query, 'UPDATE a SET b = 1')
+        self.assertEqual(db._metrics.conflicts, {})
+
+        db = self._makeOne(kw_args={}, transactions=True)
+        db.db.query = query
+        self.assertRaises(ConflictError, db._query, 'UPDATE a SET b = 1')
+        self.assertEqual(db._metrics.conflicts, {1213: 1})
+
+    def test_transaction_duration(self):
+        db = self._makeOne(kw_args={}, transactions=True)
+        self.assertIsNone(db.stats()['transaction_age'])
+        db._begin()
+        self.assertIsNotNone(db.stats()['transaction_age'])
+        db._transaction_start -= 10
+        db._observe_query('SELECT', 1.5)
+        db._finish()
+        self.assertIsNone(db.stats()['transaction_age'])
+        durations = db._metrics.transaction_durations
+        self.assertEqual(durations.count, 1)
+        self.assertTrue(10 <= durations.sum < 11)
+        # The statement is the only time not spent idle
+        idle = db._metrics.transaction_idle.sum
+        self.assertTrue(durations.sum - 1.6 < idle <= durations.sum - 1.5)
+        self.assertEqual(db._metrics.slow_transactions, 0)
+
+        # Without transactions or lock there is nothing held open
+        db = self._makeOne(kw_args={}, transactions=False)
+        db._begin()
+        db._finish()
+        self.assertEqual(db._metrics.transaction_durations.count, 0)
+
+    def test_slow_transaction_log(self):
+        from Products.ZMySQLDA import db as db_module
+        db = self._makeOne(kw_args={}, transactions=True,
+                           slow_transaction_threshold=5)
+        db.max_logged_statements = 2
+        messages = []
+        old_warning = db_module.LOG.warning
+        db_module.LOG.warning = messages.append
+        try:
+            db._begin()
+            db.query('SELECT 1')
+            db.query('UPDATE a SET b = 1')
+            db.query('UPDATE a SET b = 2')
+            db._finish()
+            self.assertEqual(messages, [])
+            self.assertEqual(db._metrics.slow_transactions, 0)
+
+            db._begin()
+            db.query('SELECT 1')
+            db._transaction_start -= 10
+            db._abort()
+        finally:
+            db_module.LOG.warning = old_warning
+        self.assertEqual(db._metrics.slow_transactions, 1)
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(messages[0].startswith('Transaction open for 10.'))
+        self.assertIn('\nSELECT 1', messages[0])
+        self.assertNotIn('ROLLBACK', messages[0])
+
+    def test_xa_transaction(self):
+        from Products.ZMySQLDA.db import xa_sort_key
+        db = self._makeOne(kw_args={}, transactions=True,
+                           xa_transactions=True, path='/da')
+        self.assertEqual(db.sortKey(), xa_sort_key)
+        db._begin()
+        xid = db._xid
+        self.assertTrue(xid.startswith("'"))
+        self.assertEqual(db.db.last_query, 'XA START %s' % xid)
+        db.query('UPDATE a SET b = 1')
+        db.tpc_vote()
+        self.assertEqual(db.db.queries[-2:],
+                         ['XA END %s' % xid, 'XA PREPARE %s' % xid])
+        db.tpc_finish()
+        self.assertEqual(db.db.last_query, 'XA COMMIT %s' % xid)
+        self.assertIsNone(db._xid)
+        self.assertEqual(db._metrics.transactions['committed'], 1)
+
+        # Every transaction gets its own XID
+        db._begin()
+        self.assertNotEqual(db._xid, xid)
+
+    def test_xa_transaction_one_phase(self):
+        db = self._makeOne(kw_args={}, transactions=True,
+                           xa_transactions=True)
+        db._begin()
+        xid = db._xid
+        db.query('SELECT 1')
+        # Transactions that did not write need no prepare
+        db.tpc_vote()
+        self.assertEqual(db.db.last_query, 'XA END %s' % xid)
+        db.tpc_finish()
+        self.assertEqual(db.db.last_query, 'XA COMMIT %s ONE PHASE' % xid)
+
+    def test_xa_transaction_prepare_error(self):
+        from Products.ZMySQLDA.db import OperationalError
+        from ZODB.POSException import ConflictError
+        db = self._makeOne(kw_args={}, transactions=True,
+                           xa_transactions=True)
+        db._begin()
+        xid = db._xid
+        db.query('UPDATE a SET b = 1')
+        query = db.db.query
+
+        def prepare(sql_string):
+            if sql_string.startswith('XA PREPARE'):
+                raise OperationalError(1213, 'Deadlock found')
+            return query(sql_string)
+
+        db.db.query = prepare
+        self.assertRaises(ConflictError, db.tpc_vote)
+        # The transaction already ended, the abort only rolls it back
+        db.abort()
+        self.assertEqual(db.db.last_query, 'XA ROLLBACK %s' % xid)
+        self.assertIsNone(db._xid)
+
+    def test_xa_transaction_abort(self):
+        db = self._makeOne(kw_args={}, transactions=True,
+                           xa_transactions=True, mysql_lock='foo_lock')
+        db._begin()
+        xid = db._xid
+        self.assertEqual(db.db.last_query, "XA START %s;\n"
+                         "SELECT GET_LOCK('foo_lock',0)" % xid)
+        db.abort()
+        # The lock can only be released after the XA transaction ended
+        self.assertEqual(db.db.last_query,
+                         "XA END %s;\nXA ROLLBACK %s;\n"
+                         "SELECT RELEASE_LOCK('foo_lock')" % (xid, xid))
+
+        db._begin()
+        xid = db._xid
+        db.query('UPDATE a SET b = 1')
+        db.tpc_vote()
+        db.abort()
+        self.assertEqual(db.db.last_query, "XA ROLLBACK %s;\n"
+                         "SELECT RELEASE_LOCK('foo_lock')" % xid)
+        self.assertEqual(db._metrics.transactions['aborted'], 2)
+
+    def test_xa_transactions_need_transactions(self):
+        db = self._makeOne(kw_args={}, transactions=False,
+                           xa_transactions=True, mysql_lock='foo_lock')
+        self.assertFalse(db.xa_transactions)
+        self.assertEqual(db.sortKey(), '1')
+        db._begin()
+        self.assertIsNone(db._xid)
+        db.tpc_vote()
+        self.assertEqual(db.db.last_query, "SELECT GET_LOCK('foo_lock',0)")
+
+    def test_xa_recover(self):
+        from Products.ZMySQLDA.db import XA_FORMAT_ID
+        from Products.ZMySQLDA.db import xa_branch
+
+        from .dummy import FakeResults
+        db = self._makeOne(kw_args={}, transactions=True,
+                           xa_transactions=True, path='/da')
+        gtrid = '0' * 32
+        branch = xa_branch('/da')
+        other = xa_branch('/other')
+        db.db.store_result = lambda: FakeResults([
+            (XA_FORMAT_ID, 32, 40, (gtrid + branch).encode('latin-1')),
+            (XA_FORMAT_ID, 32, 40, gtrid + other),
+            (1, 3, 0, 'foo')])
+        xid = "'%s','%s',%d" % (gtrid, branch, XA_FORMAT_ID)
+        self.assertEqual(db.xa_recover(), [xid])
+        # In-doubt XA transactions are only reported, their outcome is
+        # up to an operator
+        self.assertEqual(db.db.queries[-1], 'XA RECOVER')
+
+    def test_conflict_error_codes(self):
+        from MySQLdb import IntegrityError
+
+        from ZODB.POSException import ConflictError
+
+        def query(*args, **kw):
+            raise IntegrityError(1062, 'Duplicate entry')
+
+        db = self._makeOne(kw_args={}, transactions=True)
+        db.db.query = query
+        self.assertRaises(IntegrityError, db._query, 'INSERT INTO a VALUES(1)')
+
+        db = self._makeOne(kw_args={}, transactions=True,
+                           conflict_error_codes=(1062,))
+        db.db.query = query
+        self.assertRaises(ConflictError, db._query, 'INSERT INTO a VALUES(1)')
+        self.assertEqual(db._metrics.conflicts, {1062: 1})
+
+    def test_transaction_batch_error(self):
+        from Products.ZMySQLDA.db import OperationalError
+        from ZODB.POSException import ConflictError
+        db = self._makeOne(kw_args={}, transactions=True,
+                           mysql_lock='foo_lock')
+        db._begin()
+
+        def next_result():
+            raise OperationalError(1205, 'Lock wait timeout exceeded')
+
+        # Errors of the statements after the first one are detected
+        db.db.next_result = next_result
+        self.assertRaises(ConflictError, db._finish)
+        self.assertEqual(db._metrics.transactions['committed'], 0)
+        db._transaction_begun = True
+        # Lock wait timeouts are conflicts in transactions
+        self.assertRaises(ConflictError, db._abort)
+
     def test_savepoint_outside_transaction(self):
         db = self._makeOne(kw_args={})
 
@@ -453,6 +1957,76 @@ class DBTests(PatchedConnectionTestsBase):
         sp = db.savepoint()
         self.assertEqual(db.db.last_query, 'SAVEPOINT %s' % sp.ident)
 
+    def test_tracing(self):
+        from Products.ZMySQLDA.db import trace_hooks
+        hook = RecordingHook()
+        db = self._makeOne(kw_args={}, path='/da')
+        db._select_limit = 1000  # no need to change the row limit
+        trace_hooks.register(hook)
+        try:
+            db.query("SELECT * FROM t WHERE a='b'")
+            db._begin()
+            db.savepoint().rollback()
+        finally:
+            trace_hooks.unregister(hook)
+        db.query('SELECT 1')
+
+        calls = [(c[0], c[1]) for c in hook.calls]
+        self.assertEqual(calls, [('before', 'query'),
+                                 ('before', 'statement'),
+                                 ('after', 'statement'),
+                                 ('after', 'query'),
+                                 ('before', 'begin'),
+                                 ('after', 'begin'),
+                                 ('before', 'savepoint'),
+                                 ('before', 'statement'),
+                                 ('after', 'statement'),
+                                 ('after', 'savepoint'),
+                                 ('before', 'savepoint_rollback'),
+                                 ('before', 'statement'),
+                                 ('after', 'statement'),
+                                 ('after', 'savepoint_rollback')])
+        info = hook.calls[3][3]
+        self.assertEqual(info['path'], '/da')
+        self.assertEqual(info['sql'], 'SELECT * FROM t WHERE a=?')
+        self.assertEqual(info['rows'], 0)
+        self.assertGreaterEqual(info['duration'], 0)
+        self.assertEqual(hook.calls[3][2], 1)
+
+    def test_tracing_keyword_sql(self):
+        from Products.ZMySQLDA.db import trace_hooks
+        hook = RecordingHook()
+        db = self._makeOne(kw_args={})
+        db._select_limit = 1000
+        trace_hooks.register(hook)
+        try:
+            db.query(sql_string="SELECT * FROM t WHERE a='b'")
+            db.query_columns(sql_string='SELECT a FROM t WHERE b = 2')
+        finally:
+            trace_hooks.unregister(hook)
+
+        queries = [(c[1], c[2]['sql']) for c in hook.calls
+                   if c[0] == 'before' and c[1] == 'query']
+        self.assertEqual(queries,
+                         [('query', 'SELECT * FROM t WHERE a=?'),
+                          ('query', 'SELECT a FROM t WHERE b = ?')])
+
+    def test_tracing_error(self):
+        from Products.ZMySQLDA.db import trace_hooks
+        hook = RecordingHook()
+        db = self._makeOne(kw_args={})
+
+        def broken(*args):
+            raise ValueError('broken')
+
+        db.db.query = broken
+        trace_hooks.register(hook)
+        try:
+            self.assertRaises(ValueError, db.query, 'SELECT 1')
+        finally:
+            trace_hooks.unregister(hook)
+        self.assertIsInstance(hook.calls[-1][3]['error'], ValueError)
+
 
 @unittest.skipUnless(have_test_database(), NO_MYSQL_MSG)
 class RealConnectionDBTests(unittest.TestCase):
@@ -501,6 +2075,28 @@ class RealConnectionDBTests(unittest.TestCase):
         # Asking for columns from a bad table should just return empty results.
         self.assertFalse(self.db.columns('notexistingtable'))
 
+    def test_query_params(self):
+        self.db = self._makeOne()
+
+        sql = 'SELECT %s FROM %s WHERE %s > %%s' % (
+            TABLE_COL_INT, TABLE_NAME, TABLE_COL_INT)
+        first = self.db.query(sql, params=(-1,))
+        second = self.db.query(sql, params=(-1,))
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.db._prepared), 1)
+
+    def test_query_limit(self):
+        self.db = self._makeOne()
+
+        sql = 'SELECT * FROM %s' % TABLE_NAME
+        self.db.query('INSERT INTO %s VALUES (1, "a"), (2, "b")' % TABLE_NAME)
+        try:
+            self.assertEqual(len(self.db.query(sql, 1)[1]), 1)
+            self.assertEqual(len(self.db.query(sql + ' LIMIT 2', 5)[1]), 2)
+            self.assertEqual(len(self.db.query(sql, 0)[1]), 2)
+        finally:
+            self.db.query('DELETE FROM %s' % TABLE_NAME)
+
     def test_query_error(self):
         try:
             from _mysql_exceptions import ProgrammingError
@@ -531,6 +2127,7 @@ class _SavePointTests(unittest.TestCase):
 
 def test_suite():
     return unittest.TestSuite((unittest.makeSuite(DbFunctionsTests),
+                               unittest.makeSuite(TraceHooksTests),
                                unittest.makeSuite(DBPoolTests),
                                unittest.makeSuite(PatchedDBPoolTests),
                                unittest.makeSuite(RealConnectionDBPoolTests),
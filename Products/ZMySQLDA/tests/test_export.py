@@ -0,0 +1,107 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Tests for the export module
+"""
+import gzip
+import io
+import json
+import unittest
+from decimal import Decimal
+
+
+ROWS = ((1, u'Gr\xfcn', Decimal('1.50')),
+        (2, b'a "quoted", value', None))
+
+
+class CSVEncoderTests(unittest.TestCase):
+
+    def _makeOne(self, names=('id', 'name', 'price'), encoding='cp1252'):
+        from Products.ZMySQLDA.export import CSVEncoder
+        return CSVEncoder(names, encoding)
+
+    def test_encode(self):
+        encoder = self._makeOne()
+        self.assertEqual(encoder.header(), b'id,name,price\r\n')
+        self.assertEqual(encoder.encode(ROWS[:1]),
+                         u'1,Gr\xfcn,1.50\r\n'.encode('UTF-8'))
+        # The buffer is emptied after every batch
+        self.assertEqual(encoder.encode(ROWS[1:]),
+                         b'2,"a ""quoted"", value",\r\n')
+
+    def test_decode_bytes(self):
+        encoder = self._makeOne(names=('name',))
+        self.assertEqual(encoder.encode(((b'Gr\xfcn',),)),
+                         u'Gr\xfcn\r\n'.encode('UTF-8'))
+
+
+class NDJSONEncoderTests(unittest.TestCase):
+
+    def _makeOne(self, names=('id', 'name', 'price'), encoding='UTF-8'):
+        from Products.ZMySQLDA.export import NDJSONEncoder
+        return NDJSONEncoder(names, encoding)
+
+    def test_encode(self):
+        encoder = self._makeOne()
+        self.assertEqual(encoder.header(), b'')
+        lines = encoder.encode(ROWS).split(b'\n')
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[2], b'')
+        self.assertEqual(json.loads(lines[0].decode('UTF-8')),
+                         {'id': 1, 'name': u'Gr\xfcn', 'price': '1.50'})
+        self.assertEqual(json.loads(lines[1].decode('UTF-8')),
+                         {'id': 2, 'name': 'a "quoted", value',
+                          'price': None})
+
+
+class OutputTests(unittest.TestCase):
+
+    def _makeOne(self, compress=False, buffer_size=10):
+        from Products.ZMySQLDA.export import Output
+
+        class DummyFile(io.BytesIO):
+            flushed = 0
+
+            def flush(self):
+                self.flushed += 1
+
+        self.out = DummyFile()
+        return Output(self.out, compress, buffer_size)
+
+    def test_buffering(self):
+        output = self._makeOne()
+        output.write(b'12345')
+        self.assertEqual(self.out.getvalue(), b'')
+        output.write(b'67890')
+        self.assertEqual(self.out.getvalue(), b'1234567890')
+        self.assertEqual(self.out.flushed, 1)
+        output.write(b'abc')
+        output.close()
+        self.assertEqual(self.out.getvalue(), b'1234567890abc')
+        self.assertEqual(output.bytes_written, 13)
+
+    def test_compress(self):
+        output = self._makeOne(compress=True)
+        data = b'a line of text\n' * 1000
+        output.write(data[:5000])
+        output.write(data[5000:])
+        output.close()
+        compressed = self.out.getvalue()
+        self.assertLess(len(compressed), len(data))
+        with gzip.GzipFile(fileobj=io.BytesIO(compressed)) as f:
+            self.assertEqual(f.read(), data)
+
+
+def test_suite():
+    return unittest.TestSuite((unittest.makeSuite(CSVEncoderTests),
+                               unittest.makeSuite(NDJSONEncoderTests),
+                               unittest.makeSuite(OutputTests)))
@@ -0,0 +1,187 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Tests for the metrics module
+"""
+import unittest
+
+
+class MetricsFunctionsTests(unittest.TestCase):
+
+    def test_result_bytes(self):
+        from Products.ZMySQLDA.metrics import result_bytes
+
+        self.assertEqual(result_bytes(()), 0)
+        self.assertEqual(result_bytes(((1, b'abc', None), (2, u'de', 1.5))),
+                         5)
+
+
+class HistogramTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from Products.ZMySQLDA.metrics import Histogram
+        return Histogram()
+
+    def test_observe(self):
+        histogram = self._makeOne()
+        histogram.observe(0.001)
+        histogram.observe(0.003)
+        histogram.observe(100)
+        self.assertEqual(histogram.count, 3)
+        self.assertEqual(histogram.counts[0], 1)
+        self.assertEqual(histogram.counts[2], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertAlmostEqual(histogram.sum, 100.004)
+
+    def test_merge(self):
+        histogram = self._makeOne()
+        other = self._makeOne()
+        histogram.observe(0.5)
+        other.observe(0.5)
+        other.observe(20)
+        histogram.merge(other)
+        self.assertEqual(histogram.count, 3)
+        self.assertAlmostEqual(histogram.sum, 21.0)
+
+
+class ConnectionMetricsTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from Products.ZMySQLDA.metrics import ConnectionMetrics
+        return ConnectionMetrics()
+
+    def test_observe_query(self):
+        metrics = self._makeOne()
+        metrics.observe_query('SELECT', 0.01, rows=3, nbytes=30)
+        metrics.observe_query('SELECT', 0.02, rows=1, nbytes=5)
+        metrics.observe_query('INSERT', 0.01)
+        self.assertEqual(metrics.queries['SELECT'].count, 2)
+        self.assertEqual(metrics.queries['INSERT'].count, 1)
+        self.assertEqual(metrics.rows, 4)
+        self.assertEqual(metrics.bytes, 35)
+
+    def test_observe_lock(self):
+        metrics = self._makeOne()
+        metrics.observe_lock('lock1', 0.01, True)
+        metrics.observe_lock('lock1', 2.0, False)
+        self.assertEqual(metrics.lock_waits['lock1'].count, 2)
+        self.assertEqual(metrics.lock_failures, {'lock1': 1})
+
+    def test_observe_conflict(self):
+        metrics = self._makeOne()
+        metrics.observe_conflict(1213)
+        metrics.observe_conflict(1213)
+        metrics.observe_conflict(1205)
+        self.assertEqual(metrics.conflicts, {1213: 2, 1205: 1})
+
+    def test_observe_transaction(self):
+        metrics = self._makeOne()
+        metrics.observe_transaction(0.5, 0.3)
+        metrics.observe_transaction(40.0, 39.0, slow=True)
+        self.assertEqual(metrics.transaction_durations.count, 2)
+        self.assertEqual(metrics.transaction_durations.sum, 40.5)
+        self.assertEqual(metrics.transaction_idle.sum, 39.3)
+        self.assertEqual(metrics.slow_transactions, 1)
+
+    def test_merge(self):
+        metrics = self._makeOne()
+        other = self._makeOne()
+        metrics.observe_query('SELECT', 0.01, rows=3)
+        other.observe_query('SELECT', 0.01, rows=1)
+        other.observe_query('UPDATE', 0.01)
+        other.reconnects = 2
+        other.transactions['begun'] = 4
+        metrics.observe_lock('lock1', 0.01, True)
+        other.observe_lock('lock1', 0.01, False)
+        other.observe_lock('lock2', 0.01, True)
+        metrics.observe_conflict(1213)
+        other.observe_conflict(1213)
+        other.observe_conflict(1205)
+        other.observe_transaction(2.0, 1.0, slow=True)
+        metrics.merge(other)
+        self.assertEqual(metrics.queries['SELECT'].count, 2)
+        self.assertEqual(metrics.queries['UPDATE'].count, 1)
+        self.assertEqual(metrics.rows, 4)
+        self.assertEqual(metrics.reconnects, 2)
+        self.assertEqual(metrics.transactions['begun'], 4)
+        self.assertEqual(metrics.lock_waits['lock1'].count, 2)
+        self.assertEqual(metrics.lock_waits['lock2'].count, 1)
+        self.assertEqual(metrics.lock_failures, {'lock1': 1})
+        self.assertEqual(metrics.conflicts, {1213: 2, 1205: 1})
+        self.assertEqual(metrics.transaction_durations.count, 1)
+        self.assertEqual(metrics.transaction_idle.sum, 1.0)
+        self.assertEqual(metrics.slow_transactions, 1)
+
+
+class RenderTests(unittest.TestCase):
+
+    def _callFUT(self, entries):
+        from Products.ZMySQLDA.metrics import render
+        return render(entries)
+
+    def test_empty(self):
+        text = self._callFUT([])
+        self.assertTrue(text.endswith('# EOF\n'))
+        self.assertIn('# TYPE zmysqlda_query_duration_seconds histogram',
+                      text)
+
+    def test_render(self):
+        from Products.ZMySQLDA.metrics import ConnectionMetrics
+        metrics = ConnectionMetrics()
+        metrics.observe_query('SELECT', 0.002, rows=2, nbytes=10)
+        metrics.observe_query('SELECT', 20)
+        metrics.transactions['committed'] = 3
+        metrics.observe_lock('lock1', 0.002, True)
+        metrics.observe_lock('lock1', 1.5, False)
+        metrics.observe_conflict(1213)
+        metrics.observe_transaction(20.0, 19.5, slow=True)
+        text = self._callFUT([('/my"da', 2, metrics)])
+        lines = text.splitlines()
+
+        self.assertIn('zmysqlda_query_duration_seconds_bucket'
+                      '{da="/my\\"da",le="0.001",qtype="SELECT"} 0', lines)
+        self.assertIn('zmysqlda_query_duration_seconds_bucket'
+                      '{da="/my\\"da",le="0.0025",qtype="SELECT"} 1', lines)
+        self.assertIn('zmysqlda_query_duration_seconds_bucket'
+                      '{da="/my\\"da",le="+Inf",qtype="SELECT"} 2', lines)
+        self.assertIn('zmysqlda_query_duration_seconds_count'
+                      '{da="/my\\"da",qtype="SELECT"} 2', lines)
+        self.assertIn('zmysqlda_transactions_total'
+                      '{da="/my\\"da",state="committed"} 3', lines)
+        self.assertIn('zmysqlda_rows_fetched_total{da="/my\\"da"} 2', lines)
+        self.assertIn('zmysqlda_fetched_bytes_total{da="/my\\"da"} 10',
+                      lines)
+        self.assertIn('zmysqlda_lock_wait_seconds_bucket'
+                      '{da="/my\\"da",le="0.0025",lock="lock1"} 1', lines)
+        self.assertIn('zmysqlda_lock_wait_seconds_count'
+                      '{da="/my\\"da",lock="lock1"} 2', lines)
+        self.assertIn('zmysqlda_lock_failures_total'
+                      '{da="/my\\"da",lock="lock1"} 1', lines)
+        self.assertIn('zmysqlda_conflict_errors_total'
+                      '{code="1213",da="/my\\"da"} 1', lines)
+        self.assertIn('zmysqlda_transaction_duration_seconds_bucket'
+                      '{da="/my\\"da",le="10.0"} 0', lines)
+        self.assertIn('zmysqlda_transaction_duration_seconds_bucket'
+                      '{da="/my\\"da",le="30.0"} 1', lines)
+        self.assertIn('zmysqlda_transaction_idle_seconds_sum'
+                      '{da="/my\\"da"} 19.5', lines)
+        self.assertIn('zmysqlda_slow_transactions_total{da="/my\\"da"} 1',
+                      lines)
+        self.assertIn('zmysqlda_pool_connections{da="/my\\"da"} 2', lines)
+        self.assertEqual(lines[-1], '# EOF')
+
+
+def test_suite():
+    return unittest.TestSuite((unittest.makeSuite(MetricsFunctionsTests),
+                               unittest.makeSuite(HistogramTests),
+                               unittest.makeSuite(ConnectionMetricsTests),
+                               unittest.makeSuite(RenderTests)))
@@ -0,0 +1,157 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Tests for the results module
+"""
+import unittest
+from array import array
+
+
+ITEMS = [{'name': 'id', 'type': 'i'}, {'name': 'price', 'type': 'n'},
+         {'name': 'name', 'type': 's'}]
+
+
+class ColumnsTests(unittest.TestCase):
+
+    def _makeOne(self, items=ITEMS):
+        from Products.ZMySQLDA.results import Columns
+        return Columns(items)
+
+    def test_extend(self):
+        columns = self._makeOne()
+        columns.extend(((1, 1.5, 'a'), (2, 2.5, 'b')))
+        columns.extend(((3, 3.5, 'c'),))
+        ids, prices, names = columns.finish()
+
+        self.assertIsInstance(ids, array)
+        self.assertEqual(ids.tolist(), [1, 2, 3])
+        self.assertIsInstance(prices, array)
+        self.assertEqual(prices.typecode, 'd')
+        self.assertEqual(prices.tolist(), [1.5, 2.5, 3.5])
+        self.assertEqual(names, ['a', 'b', 'c'])
+
+    def test_extend_nulls(self):
+        columns = self._makeOne()
+        columns.extend(((1, 1.5, 'a'),))
+        columns.extend(((2, None, 'b'), (3, 3.5, None)))
+        ids, prices, names = columns.finish()
+
+        self.assertIsInstance(ids, array)
+        self.assertEqual(prices, [1.5, None, 3.5])
+        self.assertEqual(names, ['a', 'b', None])
+
+    def test_extend_overflow(self):
+        columns = self._makeOne([{'name': 'id', 'type': 'i'}])
+        columns.extend(((1,), (2 ** 64,)))
+        self.assertEqual(columns.finish(), [[1, 2 ** 64]])
+
+    def test_finish_numpy(self):
+        from Products.ZMySQLDA import results
+        if results.numpy is None:
+            self.skipTest('NumPy is not installed')
+        columns = self._makeOne()
+        columns.extend(((1, 1.5, 'a'), (2, 2.5, 'b')))
+        ids, prices, names = columns.finish(use_numpy=True)
+
+        self.assertIsInstance(ids, results.numpy.ndarray)
+        self.assertEqual(prices.sum(), 4.0)
+        self.assertEqual(names, ['a', 'b'])
+
+
+class RowClassTests(unittest.TestCase):
+
+    def test_row_class_cached(self):
+        from Products.ZMySQLDA.results import row_class
+
+        self.assertIs(row_class(('a', 'b')), row_class(('a', 'b')))
+        self.assertIsNot(row_class(('a', 'b')), row_class(('a', 'c')))
+        self.assertIsNot(row_class(('a', 'b')),
+                         row_class(('a', 'b'), {'a': str}))
+
+    def test_row_class_bounded(self):
+        from Products.ZMySQLDA import results
+
+        old_size = results.row_classes_size
+        results.row_classes_size = 2
+        try:
+            first = results.row_class(('x1',))
+            results.row_class(('x2',))
+            results.row_class(('x3',))
+            self.assertEqual(len(results._row_classes), 2)
+            self.assertIsNot(results.row_class(('x1',)), first)
+        finally:
+            results.row_classes_size = old_size
+
+    def test_row(self):
+        from Products.ZMySQLDA.results import row_class
+
+        row = row_class(('Id', 'name'))((1, 'a'))
+        self.assertEqual(row.Id, 1)
+        self.assertEqual(row.id, 1)
+        self.assertEqual(row.ID, 1)
+        self.assertEqual(row['name'], 'a')
+        self.assertEqual(row[0], 1)
+        self.assertEqual(row[-1], 'a')
+        self.assertEqual(len(row), 2)
+        self.assertEqual(tuple(row), (1, 'a'))
+        self.assertRaises(AttributeError, getattr, row, 'other')
+        self.assertRaises(KeyError, row.__getitem__, 'other')
+        self.assertRaises(IndexError, row.__getitem__, 2)
+        self.assertFalse(hasattr(row, '__dict__'))
+
+    def test_row_converters(self):
+        from Products.ZMySQLDA.results import row_class
+
+        row = row_class(('a', 'b'), {'b': int})(('1', '2'))
+        self.assertEqual(tuple(row), ('1', 2))
+        row = row_class(('a', 'b'), {'b': int})(('1', None))
+        self.assertIsNone(row.b)
+
+
+class CompactResultsTests(unittest.TestCase):
+
+    def _makeOne(self, *args, **kw):
+        from Products.ZMySQLDA.results import CompactResults
+        return CompactResults(*args, **kw)
+
+    def test_results(self):
+        results = self._makeOne((ITEMS, ((1, 1.5, 'a'), (2, 2.5, 'b'))))
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results.names(), ['id', 'price', 'name'])
+        self.assertEqual(results.data_dictionary()['id'], ITEMS[0])
+        self.assertEqual(results[1].name, 'b')
+        self.assertEqual([row.id for row in results], [1, 2])
+        self.assertEqual(results.tuples(), [(1, 1.5, 'a'), (2, 2.5, 'b')])
+        self.assertEqual(results.dictionaries()[0],
+                         {'id': 1, 'price': 1.5, 'name': 'a'})
+        self.assertTrue(results.asRDB().startswith('id\tprice\tname\n'))
+        # Records of results with the same columns share their class
+        other = self._makeOne((ITEMS, ((3, 3.5, 'c'),)))
+        self.assertIs(other[0].__class__, results[0].__class__)
+
+    def test_results_converters(self):
+        results = self._makeOne((ITEMS, ((1, 1.5, 'a'),)),
+                                converters={'name': str.upper})
+        self.assertEqual(results[0].name, 'A')
+
+    def test_results_bad_names(self):
+        self.assertRaises(ValueError, self._makeOne,
+                          ([{'name': ' '}], ()))
+        self.assertRaises(ValueError, self._makeOne,
+                          ([{'name': 'a'}, {'name': 'a'}], ()))
+
+
+def test_suite():
+    return unittest.TestSuite((unittest.makeSuite(ColumnsTests),
+                               unittest.makeSuite(RowClassTests),
+                               unittest.makeSuite(CompactResultsTests)))
@@ -0,0 +1,106 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Tests for the tracing module
+"""
+import unittest
+
+from Products.ZMySQLDA import tracing
+
+
+class DummySpan(object):
+
+    def __init__(self, name, kind, attributes):
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes)
+        self.exceptions = []
+        self.status = None
+        self.ended = False
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_exception(self, exc):
+        self.exceptions.append(exc)
+
+    def set_status(self, status):
+        self.status = status
+
+    def end(self):
+        self.ended = True
+
+
+class DummyTracer(object):
+
+    def __init__(self):
+        self.spans = []
+
+    def start_span(self, name, kind=None, attributes=None):
+        span = DummySpan(name, kind, attributes or {})
+        self.spans.append(span)
+        return span
+
+
+class OpenTelemetryTests(unittest.TestCase):
+
+    def tearDown(self):
+        tracing.disable_opentelemetry()
+
+    def test_enable_without_opentelemetry(self):
+        from Products.ZMySQLDA.db import trace_hooks
+        old_trace = tracing.otel_trace
+        tracing.otel_trace = None
+        try:
+            self.assertFalse(tracing.enable_opentelemetry())
+        finally:
+            tracing.otel_trace = old_trace
+        self.assertFalse(trace_hooks.hooks)
+
+    @unittest.skipIf(tracing.otel_trace is None, 'needs opentelemetry-api')
+    def test_enable_disable(self):
+        from Products.ZMySQLDA.db import trace_hooks
+        self.assertTrue(tracing.enable_opentelemetry())
+        self.assertTrue(tracing.enable_opentelemetry())
+        self.assertEqual(len(trace_hooks.hooks), 1)
+        tracing.disable_opentelemetry()
+        self.assertFalse(trace_hooks.hooks)
+
+    @unittest.skipIf(tracing.otel_trace is None, 'needs opentelemetry-api')
+    def test_hook(self):
+        tracer = DummyTracer()
+        hook = tracing.OpenTelemetryHook(tracer)
+        error = ValueError('x')
+        token = hook.before('query', {'path': '/da', 'sql': 'SELECT ?'})
+        hook.after('query', token, {'rows': 1, 'error': error})
+        token = hook.before('begin', {'path': None})
+        hook.after('begin', token, {'rows': None})
+
+        query, begin = tracer.spans
+        self.assertEqual(query.name, 'mysql.query')
+        self.assertEqual(query.kind, tracing.otel_trace.SpanKind.CLIENT)
+        self.assertEqual(query.attributes, {'db.system': 'mysql',
+                                            'zope.da.path': '/da',
+                                            'db.statement': 'SELECT ?',
+                                            'db.rows': 1})
+        self.assertEqual(query.exceptions, [error])
+        self.assertEqual(query.status.status_code,
+                         tracing.otel_trace.StatusCode.ERROR)
+        self.assertTrue(query.ended)
+        self.assertEqual(begin.name, 'mysql.begin')
+        self.assertEqual(begin.attributes, {'db.system': 'mysql'})
+        self.assertIsNone(begin.status)
+        self.assertTrue(begin.ended)
+
+
+def test_suite():
+    return unittest.TestSuite((unittest.makeSuite(OpenTelemetryTests),))
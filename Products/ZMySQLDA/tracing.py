@@ -0,0 +1,82 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" OpenTelemetry adapter for the tracing hooks in the db module
+"""
+from .db import trace_hooks
+
+
+try:
+    from opentelemetry import context as otel_context
+    from opentelemetry import trace as otel_trace
+except ImportError:  # OpenTelemetry is optional
+    otel_context = otel_trace = None
+
+
+class OpenTelemetryHook(object):
+    """ Tracing hook reporting each database operation as a client span
+    """
+
+    def __init__(self, tracer=None):
+        if tracer is None:
+            tracer = otel_trace.get_tracer('Products.ZMySQLDA')
+        self.tracer = tracer
+
+    def before(self, operation, info):
+        attributes = {'db.system': 'mysql'}
+        if info.get('path'):
+            attributes['zope.da.path'] = info['path']
+        if info.get('sql'):
+            attributes['db.statement'] = info['sql']
+        span = self.tracer.start_span('mysql.%s' % operation,
+                                      kind=otel_trace.SpanKind.CLIENT,
+                                      attributes=attributes)
+        token = otel_context.attach(otel_trace.set_span_in_context(span))
+        return span, token
+
+    def after(self, operation, token, info):
+        span, context_token = token
+        otel_context.detach(context_token)
+        if info.get('rows') is not None:
+            span.set_attribute('db.rows', info['rows'])
+        error = info.get('error')
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR,
+                                              str(error)))
+        span.end()
+
+
+_hook = None
+
+
+def enable_opentelemetry(tracer=None):
+    """ Register the OpenTelemetry hook if the library is importable.
+
+    Returns ``True`` if the hook is registered.
+    """
+    global _hook
+    if otel_trace is None:
+        return False
+    if _hook is None:
+        _hook = OpenTelemetryHook(tracer)
+        trace_hooks.register(_hook)
+    return True
+
+
+def disable_opentelemetry():
+    """ Unregister the OpenTelemetry hook, if registered.
+    """
+    global _hook
+    if _hook is not None:
+        trace_hooks.unregister(_hook)
+        _hook = None
@@ -0,0 +1,113 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Compare compressed and uncompressed transfer of a large result
+
+Usage: python benchmarks/compression.py [connection string [query]]
+
+With a connection string the query, by default 100000 generated rows, is
+run over connections with ``compress=0`` and ``compress=1`` appended to
+the connection string.
+
+Without a connection string the rows are encoded as MySQL text protocol
+packets and compressed like the client library does. The transfer time is
+estimated from the bytes on the wire at several network bandwidths plus the
+time spent compressing and decompressing.
+"""
+import struct
+import sys
+import time
+import zlib
+
+from Products.ZMySQLDA.db import DB
+from Products.ZMySQLDA.db import DBPool
+
+
+ROWS = 100000
+
+QUERY = ("WITH RECURSIVE seq (n) AS (SELECT 1 UNION ALL SELECT n + 1 "
+         "FROM seq WHERE n < %d) SELECT n AS id, CONCAT('Product ', n) AS "
+         "title, REPEAT('A fine product description. ', 4) AS description, "
+         "n * 1.25 AS price, '2020-01-01 12:00:00' AS created FROM seq" % ROWS)
+
+# Bandwidths in megabits per second
+BANDWIDTHS = (100, 1000, 10000)
+
+# The client library sends packets of up to 16 MB in compressed blocks
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def lenenc(value):
+    """ Encode ``value`` as length-encoded string of the text protocol """
+    value = str(value).encode('UTF-8')
+    if len(value) < 251:
+        return struct.pack('<B', len(value)) + value
+    return b'\xfc' + struct.pack('<H', len(value)) + value
+
+
+def wire_data(rows):
+    """ Return the result rows as MySQL row packets """
+    packets = []
+    for i, row in enumerate(rows):
+        payload = b''.join(lenenc(value) for value in row)
+        header = struct.pack('<I', len(payload))[:3] + struct.pack('<B',
+                                                                   i % 256)
+        packets.append(header + payload)
+    return b''.join(packets)
+
+
+def stand_in():
+    rows = [(i, 'Product %d' % i, 'A fine product description. ' * 4,
+             i * 1.25, '2020-01-01 12:00:00') for i in range(ROWS)]
+    data = wire_data(rows)
+
+    start = time.time()
+    blocks = [zlib.compress(data[i:i + BLOCK_SIZE])
+              for i in range(0, len(data), BLOCK_SIZE)]
+    compressed = sum(len(block) for block in blocks)
+    for block in blocks:
+        zlib.decompress(block)
+    cpu = time.time() - start
+
+    print('%d rows, %.1f MB uncompressed, %.1f MB compressed (%.0f%%), '
+          '%.3f s to compress and decompress' % (
+              ROWS, len(data) / 1e6, compressed / 1e6,
+              100.0 * compressed / len(data), cpu))
+    for bandwidth in BANDWIDTHS:
+        bytes_per_second = bandwidth * 1e6 / 8
+        print('%6d Mbit/s  uncompressed %7.3f s  compressed %7.3f s' % (
+            bandwidth, len(data) / bytes_per_second,
+            compressed / bytes_per_second + cpu))
+
+
+def transfer(connection, query, compress):
+    pool = DBPool(DB)(connection + ' compress=%d' % compress)
+    try:
+        start = time.time()
+        items, rows = pool.query(query, max_rows=0)
+        return time.time() - start, len(rows)
+    finally:
+        pool.close()
+
+
+def main(connection=None, query=QUERY):
+    if connection is None:
+        stand_in()
+        return
+    for compress in (0, 1):
+        seconds, rows = min(transfer(connection, query, compress)
+                            for i in range(3))
+        print('compress=%d %8.3f s for %d rows' % (compress, seconds, rows))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
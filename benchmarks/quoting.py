@@ -0,0 +1,78 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Compare the ways of quoting values for a query
+
+Usage: python benchmarks/quoting.py [connection string]
+
+Without a connection string the MySQL connection is replaced by a dummy,
+which isolates the overhead added by ZMySQLDA.
+"""
+import sys
+import timeit
+
+from Products.ZMySQLDA.db import DB
+from Products.ZMySQLDA.db import DBPool
+
+
+VALUES = [u'value %d with an apostrophe\'s escape' % i for i in range(500)]
+
+
+class DummyConnection(object):
+    """ Stands in for a mysqlclient 2.x connection """
+
+    server_capabilities = 0
+
+    def ping(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def string_literal(self, value):
+        return b"'" + value.replace(b"'", b"\\'") + b"'"
+
+
+def old_sql_quote(pool, value):
+    """ The ``sql_quote__`` implementation of ZMySQLDA 4.8 """
+    encoded = pool.unicode_literal(value)
+    return encoded.decode(pool.encoding)
+
+
+def main(connection=None):
+    if connection is None:
+        from Products.ZMySQLDA.db import MySQLdb
+        MySQLdb.connect = lambda **kw: DummyConnection()
+        connection = 'test'
+    pool = DBPool(DB, use_unicode=True, charset='utf8')
+    pool = pool(connection)
+
+    def old():
+        return [old_sql_quote(pool, value) for value in VALUES]
+
+    def per_value():
+        return [pool.quoter()(value) for value in VALUES]
+
+    def batch():
+        quote = pool.quoter()
+        return [quote(value) for value in VALUES]
+
+    for name, func in (('sql_quote__ 4.8', old),
+                       ('sql_quote__', per_value),
+                       ('sql_quote_many', batch)):
+        seconds = min(timeit.repeat(func, number=100, repeat=5))
+        print('%-16s %8.2f us per value' % (
+            name, seconds / 100 / len(VALUES) * 1e6))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
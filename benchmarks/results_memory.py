@@ -0,0 +1,58 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Compare the memory used by the records of ZRDB and compact results
+
+Usage: python benchmarks/results_memory.py [rows]
+
+Measures the memory held by a list of all records of a five column result,
+as built by code that keeps the records around, e.g. for sorting. The ZRDB
+records are wrapped in their parent like those returned by ZSQL methods.
+"""
+import sys
+import tracemalloc
+
+from Acquisition import Implicit
+from Products.ZMySQLDA.results import CompactResults
+from Shared.DC.ZRDB.Results import Results
+
+
+ITEMS = [{'name': name, 'type': 's'}
+         for name in ('id', 'title', 'price', 'stock', 'created')]
+
+
+class Parent(Implicit):
+    pass
+
+
+def measure(results_class, data):
+    results = results_class((ITEMS, data), parent=Parent())
+    tracemalloc.start()
+    records = [results[i] for i in range(len(results))]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return size
+
+
+def main(rows=100000):
+    rows = int(rows)
+    data = tuple((i, 'title %d' % i, i * 1.5, i % 7, '2020-01-01')
+                 for i in range(rows))
+    for name, results_class in (('ZRDB Results', Results),
+                                ('CompactResults', CompactResults)):
+        size = measure(results_class, data)
+        print('%-16s %6.1f bytes per row' % (name, float(size) / rows))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
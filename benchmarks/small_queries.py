@@ -0,0 +1,75 @@
+##############################################################################
+#
+# Copyright (c) 2001 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Measure the fixed overhead of ``DB.query`` for a small result
+
+Usage: python benchmarks/small_queries.py
+
+The MySQL connection is replaced by a dummy returning one row of twelve
+columns, so only the work done by ZMySQLDA is measured.
+"""
+import timeit
+
+from Products.ZMySQLDA.db import DB
+from Products.ZMySQLDA.db import FIELD_TYPE
+
+
+DESCRIPTION = tuple(('column%d' % i, FIELD_TYPE.LONG, 11, 11, 11, 0, 1)
+                    for i in range(12))
+
+ROWS = (tuple(range(12)),)
+
+
+class DummyResult(object):
+
+    def describe(self):
+        return DESCRIPTION
+
+    def fetch_row(self, count):
+        return ROWS
+
+
+class DummyConnection(object):
+
+    def ping(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def query(self, sql):
+        pass
+
+    def store_result(self):
+        return DummyResult()
+
+
+def main():
+    from Products.ZMySQLDA.db import MySQLdb
+    MySQLdb.connect = lambda **kw: DummyConnection()
+    db = DB(kw_args={})
+
+    def uncached():
+        db._items_cache.clear()
+        db.query('SELECT * FROM t WHERE id = 1')
+
+    def cached():
+        db.query('SELECT * FROM t WHERE id = 1')
+
+    for name, func in (('uncached items', uncached),
+                       ('cached items', cached)):
+        seconds = min(timeit.repeat(func, number=10000, repeat=5))
+        print('%-16s %6.2f us per query' % (name, seconds / 10000 * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -72,5 +72,7 @@ setup(
     ],
     extras_require={
       'docs': ['Sphinx', 'repoze.sphinx.autointerface'],
+      'opentelemetry': ['opentelemetry-api'],
+      'numpy': ['numpy'],
       },
 )